@@ -86,7 +86,8 @@ def main(*args, **kwargs):
         known_flags = set(["tn5", "help", "himar1", "protocol", "primer", "reads1",
                            "reads2", "bwa", "ref", "maxreads", "output", "mismatches", "flags",
                            "barseq_catalog_in", "barseq_catalog_out",
-                           "window-size", "bwa-alg", "replicon-ids","primer-start-window"])
+                           "window-size", "bwa-alg", "replicon-ids","primer-start-window",
+                           "debug", "gzip", "cpus", "no-sam"])
         unknown_flags = set(kwargs.keys()) - known_flags
         if unknown_flags:
             print("error: unrecognized flags:", ", ".join(unknown_flags))
@@ -25,7 +25,14 @@ import sys, re, shutil
 import platform
 import gzip
 import subprocess
-from collections import defaultdict
+import numpy
+import multiprocessing
+import threading
+import itertools
+from array import array
+from collections import defaultdict, deque
+
+CHUNK_SIZE = 20000 # reads sent to a worker process at a time, with -cpus
 
 def cleanargs(rawargs):
     #TODO: Write docstring
@@ -79,80 +86,59 @@ def analyze_dataset(wigfile):
 
 #############################################################################
 
-def fastq2reads(infile,outfile,maxreads):
-  output = open(outfile,"w")
-  cnt,tot = 0,0
-  for line in open(infile):
-    if cnt==0 and line[0]=='@':
-        tot += 1
-        if tot%1000000==0: message("%s reads processed" % tot)
-    if maxreads > -1:
-        if tot > maxreads:
-            break
-    if cnt==0:
-      h = line[1:] # strip off '@'
-      #h = h.replace(' ','_')
-      output.write(">%s" % h)
-    if cnt==1: output.write(line)
-    cnt = (cnt+1)%4
-  output.close()
+# open a reads file for text I/O, transparently (de)compressing it if the name ends in .gz
 
-# the headers for each pair must be identical up to /1 and /2 at the ends
-# if the variable character with the read number occurs in the middle, move it to the end
+def open_reads(filename,mode="r"):
+  if filename.endswith(".gz"): return gzip.open(filename,mode+"t")
+  return open(filename,mode)
+
+# iterate over the reads in a .fastq or .fasta file (possibly gzipped) as (header,seq) pairs
+# headers are returned in fasta format (starting with '>'); stops after maxreads reads (if > -1)
 
-def fix_paired_headers_for_bwa(reads1,reads2):
-  a = open(reads1)
-  b = open(reads2)
-  temp1 = reads1+".temp"
-  temp2 = reads2+".temp"
-  c = open(temp1,"w")
-  d = open(temp2,"w")
+def read_records(filename,maxreads=-1):
+  fil = open_reads(filename)
+  first = fil.readline()
   tot = 0
-  try:
-   # Check to make sure that headers differ only by 1 character. (Read number. 1 can be single read or Read 2 of paired-end)
-   while True:
-    e = a.readline().rstrip()
-    f = b.readline().rstrip()
-    if len(e)<=2 or len(f)<=2: break
-    if e[0]=='>':
+  if first.startswith('>'):
+    header = first.rstrip()
+    for line in fil:
+      line = line.rstrip()
+      if not line: continue
+      if line[0]=='>': header = line; continue
+      if tot==maxreads: break
       tot += 1
-      if tot%1000000==0: message("%s reads processed" % tot)
-      # find first position where there is a difference
-      i,n = 0,len(e)
-      if len(f)!=n: raise Exception('Error: unexpected format of headers in .fastq files')
-      while i<n and e[i]==f[i]: i += 1
-      # if i==n: raise Exception('Error: unexpected format of headers in .fastq files')
-      e = e.replace(' ','_')
-      f = f.replace(' ','_')
-      e = e.replace('/','_') # this was neceesary for bwa 0.7.10 but not 0.7.12
-      f = f.replace('/','_')
-      #if i<n-1:
-      if e[i+1:]!=f[i+1:]: raise Exception('Error: unexpected format of headers in .fastq files')
-      e,f = e[:-1],f[:-1] # strip EOL
-      # needed for bwa 0.7.12? which apparently trims off last 2 chars to make ids identical
-      # "/[1|2]" are automatically trimmed, but not /3
-      e = e[:i]+e[i+1:]
-      f = f[:i]+f[i+1:]
-    c.write(e+"\n")
-    d.write(f+"\n")
-  except Exception as ex:
-    a.close(); b.close(); c.close(); d.close()
-    error(ex.args[0])
-  a.close(); b.close(); c.close(); d.close()
-
-  if(os.path.exists(reads1)): os.remove(reads1)
-  if(os.path.exists(reads2)): os.remove(reads2)
-  os.rename(temp1, reads1)
-  os.rename(temp2, reads2)
-
-  '''
-  if platform.platform == 'win32':
-	  os.system("move %s %s" % (temp1,reads1))
-	  os.system("move %s %s" % (temp2,reads2))
+      yield header,line
   else:
-	  os.system("mv %s %s"%(temp1, reads1))
-	  os.system("mv %s %s" % (temp2, reads2))
-  '''
+    header = first
+    while header and tot!=maxreads:
+      seq = fil.readline()
+      fil.readline(); fil.readline() # '+' line and qualities
+      tot += 1
+      yield ">"+header[1:].rstrip(),seq.rstrip()
+      header = fil.readline()
+  fil.close()
+
+# the headers for each pair must be identical up to /1 and /2 at the ends
+# if the variable character with the read number occurs in the middle, move it to the end
+
+def fix_paired_headers(e,f):
+  # find first position where there is a difference
+  i,n = 0,len(e)
+  if len(f)!=n: raise Exception('Error: unexpected format of headers in .fastq files')
+  while i<n and e[i]==f[i]: i += 1
+  # if i==n: raise Exception('Error: unexpected format of headers in .fastq files')
+  e = e.replace(' ','_')
+  f = f.replace(' ','_')
+  e = e.replace('/','_') # this was neceesary for bwa 0.7.10 but not 0.7.12
+  f = f.replace('/','_')
+  #if i<n-1:
+  if e[i+1:]!=f[i+1:]: raise Exception('Error: unexpected format of headers in .fastq files')
+  e,f = e[:-1],f[:-1] # strip EOL
+  # needed for bwa 0.7.12? which apparently trims off last 2 chars to make ids identical
+  # "/[1|2]" are automatically trimmed, but not /3
+  e = e[:i]+e[i+1:]
+  f = f[:i]+f[i+1:]
+  return e,f
 
 ##############################
 
@@ -237,7 +223,62 @@ def mmfind2(G,n,H,m,max): # lengths; assume n>m
 
 # TRI (10/20/2021): I switched back to mmfind1(), since 
 #   mmfind2() wasn't working right; increasing -mismatches caused fewer reads to be recognized with prefix and trimmed
+# (mmfind2 only handles max of 1 or 2, and ignores n)
+
+# bit-parallel (Shift-And) search with Hamming distance; returns the same as mmfind1() for any max:
+#   the first exact match in G[:n], else the first i<n-m where H[:m] matches G[i:i+m] with up to max mismatches
+# bit k of R[d] is set if H[:k+1] matches the text ending at j with up to d mismatches
 
+def mmfind3(G,n,H,m,max):
+  a = G[:n].find(H[:m])
+  if a!=-1 or m==0: return a # shortcut for perfect matches
+  B = {}
+  for k in range(m): B[H[k]] = B.get(H[k],0) | (1<<k)
+  top = 1<<(m-1)
+  R = [0]*(max+1)
+  for j in range(n-1): # a match ending at n-1 would start at n-m
+    b = B.get(G[j],0)
+    prev = 0
+    for d in range(max+1):
+      r = R[d]
+      R[d] = (((r<<1)|1) & b) | prev
+      prev = (r<<1)|1 # substitution: extend the match with up to d-1 mismatches by a mismatching char
+    if R[max] & top: return j-m+1
+  return -1
+
+# mmfind3() for a list of reads at once (each searched over its full length), vectorized over the reads;
+# returns an array with the start of the match in each read (or -1)
+
+def mmfind_batch(reads,H,max):
+  m,N = len(H),len(reads)
+  if m==0: return numpy.zeros(N,dtype=int)
+  if m>64 or N==0: return numpy.array([mmfind1(G,len(G),H,m,max) for G in reads],dtype=int)
+  lens = numpy.array([len(G) for G in reads])
+  L = lens.max()
+  text = numpy.zeros((N,L),dtype=numpy.uint8) # padded with 0, which mismatches everything in H
+  for i,G in enumerate(reads): text[i,:len(G)] = numpy.frombuffer(G.encode("latin-1"),dtype=numpy.uint8)
+  B = numpy.zeros(256,dtype=numpy.uint64)
+  for k,c in enumerate(H.encode("latin-1")): B[c] |= numpy.uint64(1<<k)
+  S = B[text]
+  one,top = numpy.uint64(1),numpy.uint64(1<<(m-1))
+  R = [numpy.zeros(N,dtype=numpy.uint64) for d in range(max+1)]
+  exact = numpy.full(N,-1)
+  approx = numpy.full(N,-1)
+  for j in range(L):
+    b = S[:,j]
+    prev = 0
+    for d in range(max+1):
+      r = R[d]
+      R[d] = (((r<<one)|one) & b) | prev
+      prev = (r<<one)|one
+    if j<m-1: continue
+    hit = ((R[0] & top)!=0) & (exact==-1) & (j<lens)
+    exact[hit] = j-m+1
+    hit = ((R[max] & top)!=0) & (approx==-1) & (j<lens-1)
+    approx[hit] = j-m+1
+  return numpy.where(exact!=-1,exact,approx)
+
+# mmfind3() is exact, but not faster than mmfind1() one read at a time in python; reads are trimmed with mmfind_batch()
 
 def mmfind(G,n,H,m,max): return mmfind1(G,n,H,m,max)
 
@@ -249,12 +290,9 @@ def windowize(origin, window_size):                         # Generate P,Q value
                                                             #                   1: 28, 29
     return lower_bound, upper_bound                         #                   2: 27, 29 etc.
 
-def extract_staggered(infile,outfile,vars):
+def prefix_window(vars):
+  # returns P,Q such that the Tn prefix is expected to start at positions P..Q in read 1
   Tn = vars.prefix
-  message("prefix sequence: %s" % vars.prefix)
-  lenTn = len(Tn)
-  ADAPTER2 = "TACCACGACCA"
-  lenADAP = len(ADAPTER2)
 
   #P,Q = 0,15
   #P,Q = 0,50 # relax this, because it has caused problems for various users; shouldn't matter, if prefix is long enough to make random occurences unlikely
@@ -268,55 +306,105 @@ def extract_staggered(infile,outfile,vars):
     P,Q = windowize(origin, vars.window_size)
 
   if vars.barseq_catalog_out!=None: P,Q = 0,100 # relax for barseq
-  vars.tot_tgtta = 0
-  vars.truncated_reads = 0
-  output = open(outfile,"w")
-  output_failed = open(outfile+'_failed_trim',"w")                          # [WM] [add]
   if vars.window_size!=-1: message("Looking for start of Tn prefix with P,Q = %d,%d (origin = %d, window size = %d)" % (P,Q,origin,vars.window_size)) # [RJ] Outputting P,Q values and origin/window size
   else: message("Looking for start of Tn prefix within P,Q = [%d,%d]" % (P,Q))
+  return P,Q
+
+ADAPTER2 = "TACCACGACCA"
+BARSEQ1 = "TGCAGGGATGTCCACGAGGTCTCT" # const regions surrounding barcode
+BARSEQ2 = "CGTACGCTGCAGGTCGACGGCCGG"
+
+# returns a list of (genomic,truncated,barcode) for reads 1, where genomic is the part of the read after the Tn prefix
+#   (and before the adapter, if truncated), "" if that is too short, or None if the prefix is not found in P..Q;
+#   barcode is the barseq barcode (or None, if not looking for barcodes)
+
+def trim_reads(seqs,Tn,P,Q,mm1,minReadLen,barseq):
+  A = mmfind_batch(seqs,Tn,mm1).tolist() # allow some mismatches
+  B = mmfind_batch(seqs,ADAPTER2,1).tolist() # look for end of short frags
+  if barseq:
+    C = mmfind_batch(seqs,BARSEQ1,mm1).tolist() # Tn prefix is at the end of the read, so search the whole read
+    D = mmfind_batch(seqs,BARSEQ2,mm1).tolist()
+  results = []
+  for i,line in enumerate(seqs):
+    a,b = A[i],B[i]
+    genomic,truncated,barcode = None,False,None
+    if a>=P and a<=Q:
+      gstart,gend = a+len(Tn),len(line)
+      if b!=-1: gend = b; truncated = True
+      if gend-gstart < minReadLen: results.append(("",truncated,None)); continue # too short # I should make this a param
+      genomic = line[gstart:gend]
+    if barseq:
+      c,d = C[i],D[i]
+      barcode = "XXXXXXXXXXXXXXXXXXXX"
+      if c!=-1 and d!=-1:
+        size = d-c-len(BARSEQ1)
+        if size>=15 and size<=25: barcode = line[c+len(BARSEQ1):d]
+    results.append((genomic,truncated,barcode))
+  return results
+
+trim_params = []
+
+def init_trim_worker(*params):
+  trim_params[:] = params
+
+def trim_reads_worker(seqs):
+  return trim_reads(seqs,*trim_params)
+
+# yields (record,(genomic,truncated,barcode)) for each record, in order, trimming chunks of CHUNK_SIZE reads at a time;
+# with cpus>1, the chunks are trimmed in worker processes
+
+def trim_records(records,params,cpus=1):
+  records = iter(records)
+  if cpus<=1:
+    while True:
+      chunk = list(itertools.islice(records,CHUNK_SIZE))
+      if not chunk: return
+      for item in zip(chunk,trim_reads([record[1] for record in chunk],*params)): yield item
+  pool = multiprocessing.Pool(cpus,initializer=init_trim_worker,initargs=params)
+  pending = deque()
+  try:
+    while True:
+      chunk = list(itertools.islice(records,CHUNK_SIZE))
+      if chunk: pending.append((chunk,pool.apply_async(trim_reads_worker,([record[1] for record in chunk],))))
+      # keep a bounded number of chunks in flight
+      while pending and (len(pending)>2*cpus or not chunk):
+        done,result = pending.popleft()
+        for item in zip(done,result.get()): yield item
+      if not chunk: break
+    pool.close()
+    pool.join()
+  finally:
+    pool.terminate()
+
+# trims the Tn prefix (and the adapter at the end of short fragments) off a stream of reads
+# records are tuples starting with (header,seq); for each one, yields (record,genomic), where genomic is
+#   the genomic part of the read, "" if it is too short, or None if the read lacks the Tn prefix
+# sets vars.tot_reads, vars.tot_tgtta and vars.truncated_reads when the stream is exhausted
+
+def extract_staggered_records(records,vars):
+  message("prefix sequence: %s" % vars.prefix)
+  P,Q = prefix_window(vars)
+  minReadLen = 15 if vars.protocol.lower() == "mme1" else 20
+  barseq = vars.barseq_catalog_out!=None
+  params = (vars.prefix,P,Q,vars.mm1,minReadLen,barseq)
+  if vars.cpus>1: message("trimming reads in %d worker processes" % vars.cpus)
+
+  vars.tot_tgtta = 0
+  vars.truncated_reads = 0
   tot = 0
-  #print(infile)
-  if vars.barseq_catalog_out!=None:
+  if barseq:
     barcodes_file = vars.base+".barseq" # I could define this in vars
     catalog = open(barcodes_file,"w")
-    barseq1 = "TGCAGGGATGTCCACGAGGTCTCT" # const regions surrounding barcode
-    barseq2 = "CGTACGCTGCAGGTCGACGGCCGG"
-    barseq1len,barseq2len = len(barseq1),len(barseq2)
-  for line in open(infile):
-    #print(line)
-    line = line.rstrip()
-    if not line: continue
-    if line[0]=='>': header = line; continue
+  for record,(genomic,truncated,barcode) in trim_records(records,params,vars.cpus):
     tot += 1
     if tot%1000000==0: message("%s reads processed" % tot)
-    readlen = len(line)
-    a = mmfind(line,readlen,Tn,lenTn,vars.mm1) # allow some mismatches
-    b = mmfind(line,readlen,ADAPTER2,lenADAP, 1) # look for end of short frags
-    if a>=P and a<=Q:
-      gstart,gend = a+lenTn,readlen
-      if b!=-1: gend = b; vars.truncated_reads += 1
-      minReadLen = 15 if vars.protocol.lower() == "mme1" else 20
-      if gend-gstart < minReadLen: continue # too short # I should make this a param
-      output.write(header+"\n")
-      output.write(line[gstart:gend]+"\n")
-      vars.tot_tgtta += 1
-    else:                                               # [WM] [add]
-      #Output reads that failed to be trimmed.          # [WM] [add]
-      output_failed.write(header+"\n")                  # [WM] [add]
-      output_failed.write(line+"\n")                    # [WM] [add]
-    if vars.barseq_catalog_out!=None:
-      n = max(a,readlen)
-      c = mmfind(line,n,barseq1,barseq1len,vars.mm1) # only have to search as far as Tn prefix
-      d = mmfind(line,n,barseq2,barseq2len,vars.mm1)
-      seq = "XXXXXXXXXXXXXXXXXXXX"
-      if c!=-1 and d!=-1:
-        size = d-c-barseq1len
-        if size>=15 and size<=25: seq = line[c+barseq1len:d]
-      catalog.write(header+"\n")
-      catalog.write(seq+"\n")
-  if vars.barseq_catalog_out!=None: catalog.close()
-  output.close()
-  output_failed.close()                                 # [WM] [add]
+    if truncated: vars.truncated_reads += 1
+    if genomic: vars.tot_tgtta += 1
+    yield record,genomic
+    if barcode!=None:
+      catalog.write(record[0]+"\n")
+      catalog.write(barcode+"\n")
+  if barseq: catalog.close()
   if vars.tot_tgtta == 0:
     raise ValueError("Error: Input files did not contain any reads matching prefix sequence with %d mismatches" % vars.mm1)
   vars.tot_reads = tot
@@ -326,49 +414,6 @@ def message(s):
   #sys.stdout.flush()
   sys.stderr.write("[tn_preprocess] "+s+"\n")
 
-def get_id(line):
-  a,b = line.find(":")+1,line.rfind("#")
-  if b==-1: b = line.rfind("_")
-  return line[a:b]
-
-# select the reads from infile that have headers occuring in goodreads
-
-def select_reads(goodreads,infile,outfile):
-  hash = {}
-  for line in open(goodreads):
-    if line[0]=='>':
-      #id = line[line.find(":")+1:line.rfind("#")]
-      id = get_id(line)
-      hash[id] = 1
-
-  output = open(outfile,"w")
-  for line in open(infile):
-    if line[0]=='>':
-      header = line
-      id = get_id(line)
-    else:
-      if id in hash:
-        output.write(header)
-        output.write(line)
-  output.close()
-
-def replace_ids(infile1,infile2,outfile):
-  f = open(infile1)
-  g = open(infile2)
-  h = open(outfile,"w")
-
-  while True:
-    a = f.readline()
-    b = g.readline()
-    if len(a)<2: break
-    if a[0]=='>': header = a
-    else:
-      h.write(header)
-      h.write(b)
-  f.close()
-  g.close()
-  h.close()
-
 # indexes i and j are 1-based and inclusive (could be -1)
 
 def select_cycles(infile,i,j,outfile):
@@ -397,16 +442,10 @@ def read_genome(filename, replicon_index):
   return s.upper()
 
 
-def parse_sam_header(sam_filename):
+def parse_sam_header_lines(lines):
     parsed_header = {}
     
-    f = open(sam_filename, "r")
-    for line in f:
-
-        # Stop parsing once end of SAM header is reached
-        if not line[0] == '@':
-            break
-        
+    for line in lines:
         header_line = line.split()
         at_sign_sam_tag = header_line[0]
         if at_sign_sam_tag not in parsed_header:
@@ -419,12 +458,23 @@ def parse_sam_header(sam_filename):
             tag_value = ':'.join(tag_pair[1:])  # in case the value of the tag contains ':', which we used as delimiter for split
             tag_line[tag_name] = tag_value
         parsed_header[at_sign_sam_tag].append(tag_line)
-    
-    f.close()
 
     return parsed_header
 
 
+# sam is the name of a SAM file (possibly gzipped) or an iterable over its lines (like bwa_sam_lines())
+# returns the parsed header and an iterator over the remaining lines (the alignments)
+
+def read_sam(sam):
+    lines = iter(open_reads(sam) if isinstance(sam, str) else sam)
+    header_lines = []
+    for line in lines:
+        if line[0] != '@':
+            return parse_sam_header_lines(header_lines), itertools.chain([line], lines)
+        header_lines.append(line)
+    return parse_sam_header_lines(header_lines), lines
+
+
 def get_replicon_names_from_sam_header(sam_header):
     
     if "@SQ" not in sam_header:
@@ -441,18 +491,7 @@ def get_replicon_names_from_sam_header(sam_header):
     return replicon_names
 
 
-def count_sam_header_lines(sam_header):
-    
-    num_sam_header_lines = 0
-
-    for at_sign_sam_tag in sam_header:
-        for line in sam_header[at_sign_sam_tag]:
-            num_sam_header_lines += 1
-
-    return num_sam_header_lines
-
-
-# convert to bistring (16 bits; bit 0 is low-order bit)
+# SAM flag bits (bit 0 is low-order bit)
 #
 # Bit Description
 # 0 0x1 template having multiple segments in sequencing
@@ -464,19 +503,36 @@ def count_sam_header_lines(sam_header):
 # 6 0x40 the first segment in the template
 # 7 0x80 the last segment in the template
 #
-# code[6]=1 means read1
-# code[4]=1 means reverse strand
+# test flags directly, e.g. int(flag) & REVERSE
+PAIRED,PROPER_PAIR,UNMAPPED,MATE_UNMAPPED,REVERSE,MATE_REVERSE,READ1,READ2 = 0x1,0x2,0x4,0x8,0x10,0x20,0x40,0x80
+
+# returns the coordinates (1-based) of the insertion sites in the genome (TAs for Himar1, every position for Tn5),
+# and an array mapping each coordinate 0..len(genome) to the index of its site in coords (or -1)
+
+def get_insertion_sites(genome, transposon):
+    if transposon=="Himar1":
+        seq = numpy.frombuffer(genome.encode("latin-1"), dtype=numpy.uint8)
+        coords = numpy.flatnonzero((seq[:-1]==ord('T')) & (seq[1:]==ord('A'))) + 1
+    else: coords = numpy.arange(1, len(genome))
+    site_index = numpy.full(len(genome)+1, -1, dtype=numpy.int32)
+    site_index[coords] = numpy.arange(len(coords), dtype=numpy.int32)
+    return coords,site_index
+
+# returns the index of the site at coordinate pos (or -1)
+
+def get_site(site_index, pos):
+    if pos<=0 or pos>=len(site_index): return -1
+    return int(site_index[pos])
+
+# rows of (coord, Fwd_Rd_Ct, Fwd_Templ_Ct, Rev_Rd_Ct, Rev_Templ_Ct, Tot_Rd_Ct, Tot_Templ_Ct),
+# given the read and template counts at each site on each strand (arrays of 2 x sites, Fwd then Rev)
 
-def samcode(num): 
-    num = int(num)
-    binary_num = bin(num)
-    truncated_0b_binary_num = binary_num[2:]
-    zero_padded_binary_num = truncated_0b_binary_num.zfill(16)
-    rev = zero_padded_binary_num[::-1]
-    return rev
+def site_counts_table(coords, reads, templates):
+    return numpy.column_stack((coords, reads[0], templates[0], reads[1], templates[1], reads.sum(axis=0), templates.sum(axis=0)))
 
 def template_counts(ref,sam,bcfile,vars):
   vars.mapped = vars.r1 = vars.r2 = 0
+  sam_header,alignments = read_sam(sam) # if sam is bwa's output, this starts the mapping
 
   barcodes = {}
   for line in open(bcfile):
@@ -484,124 +540,102 @@ def template_counts(ref,sam,bcfile,vars):
     if line[0]=='>': id = line[1:]
     else: barcodes[id] = line
   
-  hits = {}
-  sam_header = parse_sam_header(sam)
+  # for each replicon: site coords, index of site at each coord, read counts at each site on each strand,
+  #   and the templates (2*site+strand, size, barcode id) of the reads
   replicon_names = get_replicon_names_from_sam_header(sam_header)
-  for replicon in replicon_names:
-    hits[replicon] = {}
+  sites = {}
+  for replicon_index in range(vars.num_replicons):
+    coords,site_index = get_insertion_sites(read_genome(ref, replicon_index), vars.transposon)
+    reads = numpy.zeros((2,len(coords)), dtype=numpy.int64)
+    sites[replicon_names[replicon_index]] = (coords,site_index,reads,(array('q'),array('q'),array('q')))
+  barcode_ids = {}
   
-  skip = count_sam_header_lines(sam_header)
-  for line in open(sam):
-    #if line[0]=='@': continue
-    if skip>0: skip -= 1; continue
-    else:
+  for line in alignments:
       w = line.split('\t')
       bc = barcodes[w[0]]
-      code = samcode(w[1])
+      flag = int(w[1])
       if 'S' in w[5]: continue # eliminate softclipped reads
-      if code[6]=="1" and code[2]=="0": vars.r1 += 1
-      if code[6]=="1" and code[3]=="0": vars.r2 += 1
+      if flag & READ1 and not flag & UNMAPPED: vars.r1 += 1
+      if flag & READ1 and not flag & MATE_UNMAPPED: vars.r2 += 1
       if bc=="XXXXXXXXXX": continue
-      if code[6]=="1" and code[1]=="1": # both reads map properly (83 or 99) and has legit barcode
+      if flag & READ1 and flag & PROPER_PAIR: # both reads map properly (83 or 99) and has legit barcode
         vars.mapped += 1
         readlen = len(w[9])
         pos,size = int(w[3]),int(w[8]) # note: size could be negative
-        strand,delta = 'F',-2
-        if code[4]=="1": strand,delta = 'R',readlen
+        strand,delta = 0,-2
+        if flag & REVERSE: strand,delta = 1,readlen
 
         pos += delta
-        replicon_name = w[2]
-        if pos not in hits[replicon_name]: hits[replicon_name][pos] = []
-        hits[replicon_name][pos].append((strand,size,bc))
+        if w[2] not in sites: continue
+        coords,site_index,reads,(keys,sizes,bcs) = sites[w[2]]
+        i = get_site(site_index,pos)
+        if i==-1: continue
+        reads[strand,i] += 1
+        keys.append(2*i+strand)
+        sizes.append(size)
+        bcs.append(barcode_ids.setdefault(bc,len(barcode_ids)))
 
   sites_list = []
   for replicon_index in range(vars.num_replicons):
-    sites = []
-    genome = read_genome(ref, replicon_index)
-    for i in range(len(genome)-1):
-      #if genome[i:i+2].upper()=="TA":
-      if vars.transposon=="Himar1" and genome[i:i+2].upper()!="TA": continue 
-      else:
-        pos = i+1
-        h = hits[replicon_names[replicon_index]].get(pos,[])
-        f = list(filter(lambda x: x[0]=='F',h))
-        r = list(filter(lambda x: x[0]=='R',h))
-        u = list(set(h))
-        uf = list(filter(lambda x: x[0]=='F',u))
-        ur = list(filter(lambda x: x[0]=='R',u))
-        data = [pos,len(f),len(uf),len(r),len(ur),len(f)+len(r),len(uf)+len(ur)]
-        sites.append(data)    
-    sites_list.append(sites)
-
-  return sites_list     # list of (coord, Fwd_Rd_Ct, Fwd_Templ_Ct, Rev_Rd_Ct, Rev_Templ_Ct, Tot_Rd_Ct, Tot_Templ_Ct)
+    coords,site_index,reads,(keys,sizes,bcs) = sites[replicon_names[replicon_index]]
+    # templates are the distinct (strand,size,barcode) at each site
+    keys,sizes,bcs = numpy.array(keys,dtype=numpy.int64),numpy.array(sizes,dtype=numpy.int64),numpy.array(bcs,dtype=numpy.int64)
+    order = numpy.lexsort((bcs,sizes,keys))
+    keys,sizes,bcs = keys[order],sizes[order],bcs[order]
+    distinct = numpy.ones(len(keys), dtype=bool)
+    distinct[1:] = (keys[1:]!=keys[:-1]) | (sizes[1:]!=sizes[:-1]) | (bcs[1:]!=bcs[:-1])
+    templates = numpy.bincount(keys[distinct], minlength=2*len(coords)).reshape(-1,2).T
+    sites_list.append(site_counts_table(coords,reads,templates))
+
+  return sites_list     # list of arrays with rows (coord, Fwd_Rd_Ct, Fwd_Templ_Ct, Rev_Rd_Ct, Rev_Templ_Ct, Tot_Rd_Ct, Tot_Templ_Ct)
 
 # pretend that all reads count as unique templates
 
-def increase_counts(pos,sites, strand):
-        if strand == "F":
-            sites[pos][1] += 1  #if read has been found before, tally 1 more in R reads
-            sites[pos][2] += 1  #if read has been found before, tally 1 more in R reads
-        if strand == "R":
-            sites[pos][3] += 1  #if read has been found before, tally 1 more in R reads
-            sites[pos][4] += 1  #if read has been found before, tally 1 more in R reads
-        sites[pos][5] += 1  #if read has been found before, tally 1 more in R reads
-        sites[pos][6] += 1  #if read has been found before, tally 1 more in R reads
-
-
 def read_counts(ref,sam,vars):
-    sites_dict = {}
-    sam_header = parse_sam_header(sam)
+    sam_header,alignments = read_sam(sam) # if sam is bwa's output, this starts the mapping
     replicon_names = get_replicon_names_from_sam_header(sam_header)
     
+    # for each replicon: site coords, index of site at each coord, and read counts at each site on each strand
+    sites = {}
     for replicon_names_index in range(vars.num_replicons):
-        sites = {}
-        genome = read_genome(ref, replicon_names_index)
-        for i in range(len(genome)-1):
-            #if genome[i:i+2]=="TA" or vars.transposon=='Tn5':
-            if vars.transposon=='Himar1' and genome[i:i+2]!="TA": continue
-            pos = i+1
-            sites[pos] = [pos,0,0,0,0,0,0]
-            sites_dict[replicon_names[replicon_names_index]] = sites
+        coords,site_index = get_insertion_sites(read_genome(ref, replicon_names_index), vars.transposon)
+        reads = numpy.zeros((2,len(coords)), dtype=numpy.int64)
+        sites[replicon_names[replicon_names_index]] = (coords,site_index,reads)
 
     vars.tot_tgtta = 0
     vars.mapped = 0
     vars.r1 = vars.r2 = 0
-    for line in open(sam):
-        if line[0]=='@': continue
-        else:
+    mme1 = vars.protocol.lower() == "mme1"
+    for line in alignments:
             w = line.split('\t')
-            code,icode = samcode(w[1]),int(w[1])
+            flag = int(w[1])
             vars.tot_tgtta += 1
-            if icode==0 or icode==16:
+            if flag==0 or flag==REVERSE:
                 vars.r1 += 1
                 vars.mapped += 1
                 readlen = len(w[9])
                 pos = int(w[3])
-                replicon_name = w[2]
+                coords,site_index,reads = sites[w[2]]
 
-                if vars.protocol.lower() == "mme1":
-                    strand,delta = 'F',readlen
-                    if code[4]=="1": strand,delta = 'R',1
+                if mme1:
+                    strand,delta = 0,readlen
+                    if flag & REVERSE: strand,delta = 1,1
                     site1 = pos + delta - 2 #if on + strand, take column 3 position and add 1bp,
                     site2 = pos + delta - 1 #check one off just in case it enzyme chewed too much
-                    if site1 in sites_dict[replicon_name]:
-                        increase_counts(site1, sites_dict[replicon_name], strand)
-                    if site2 in sites_dict[replicon_name]:
-                        increase_counts(site2, sites_dict[replicon_name], strand)
+                    for i in [get_site(site_index,site1),get_site(site_index,site2)]:
+                        if i!=-1: reads[strand,i] += 1
                 else:
-                    strand,delta = 'F',-2
-                    if code[4]=="1": strand,delta = 'R',readlen
+                    strand,delta = 0,-2
+                    if flag & REVERSE: strand,delta = 1,readlen
                     site1 = pos + delta #if on + strand, take column 3 position and add 1bp)
-                    if site1 in sites_dict[replicon_name]:
-                        increase_counts(site1, sites_dict[replicon_name], strand)
+                    i = get_site(site_index,site1)
+                    if i!=-1: reads[strand,i] += 1
 
     results_list = []
     for replicon_index in range(vars.num_replicons):
-        results = []
-        for key in sorted(sites_dict[replicon_names[replicon_index]].keys()):
-            results.append(sites_dict[replicon_names[replicon_index]][key])
-        results_list.append(results)
-    return results_list # list of (coord, Fwd_Rd_Ct, Fwd_Templ_Ct, Rev_Rd_Ct, Rev_Templ_Ct, Tot_Rd_Ct, Tot_Templ_Ct)
+        coords,site_index,reads = sites[replicon_names[replicon_index]]
+        results_list.append(site_counts_table(coords,reads,reads)) # each read counts as a template
+    return results_list # list of arrays with rows (coord, Fwd_Rd_Ct, Fwd_Templ_Ct, Rev_Rd_Ct, Rev_Templ_Ct, Tot_Rd_Ct, Tot_Templ_Ct)
 
 
 def driver(vars):
@@ -613,11 +647,15 @@ def driver(vars):
   vars.barcodes1 = vars.base+".barcodes1"
   vars.barcodes2 = vars.base+".barcodes2"
   vars.genomic2 = vars.base+".genomic2"         # Final fastq for read 2 is stored in this file
+  if vars.gzip: vars.trimmed1,vars.genomic2 = vars.trimmed1+".gz",vars.genomic2+".gz" # bwa reads .gz directly
 
   # [RJ] These variables are for the run_bwa() step (reference genome involved)
   vars.sai1 = vars.base+".sai1"                 # [RJ] SAI only used when using bwa_alg 'aln'
   vars.sai2 = vars.base+".sai2"
   vars.sam = vars.base+".sam"
+  if vars.gzip: vars.sam += ".gz"
+  if vars.no_sam and vars.barseq_catalog_out==None: vars.sam = None # counts are made from bwa's output directly
+  vars.sam_command = None
 
   # [RJ] These variables are for the generate_output() step
   vars.tc = []
@@ -700,96 +738,68 @@ def driver(vars):
 
   message("Done.")
 
-# gunzip <fastq>.gz file, written to <fastq>
-
-def uncompress(filename):
-   newfname = filename[0:-3]
-   print("uncompressing %s" % filename)
-   outfil = open(newfname, "wb+")
-   for line in gzip.open(filename):
-      outfil.write(line)
-   return newfname
-
-def copy_fasta(infile,outfile,maxreads=-1):
-  a = open(infile)
-  b = open(outfile,"w")
-  cnt = 0
-  while True:
-    hdr = a.readline()
-    seq = a.readline()
-    if len(hdr)==0: break
-    b.write(hdr)
-    b.write(seq)
-    cnt += 1
-    if maxreads>0 and cnt>=maxreads:break
-  a.close()
-  b.close()
+def write_read(fil,header,seq):
+  fil.write(header+"\n")
+  fil.write(seq+"\n")
+
+# reads1 (and reads2) are streamed once, directly from the .fastq/.fasta (or .gz) input files;
+# intermediate files (reads1, reads2, trimmed2, barcodes2, trimmed1_failed_trim) are only written with -debug
 
 def extract_reads(vars):
     message("extracting reads...")
 
-    if vars.fq1.endswith('.gz'):
-       vars.fq1 = uncompress(vars.fq1)
-
-    if vars.fq2.endswith('.gz'):
-       vars.fq2 = uncompress(vars.fq2)
-
-    flag = ['','']
-    for idx, name in enumerate([vars.fq1, vars.fq2]):
-        print(name)
-        if idx==1 and vars.single_end==True: continue
-        fil = open(name)
-        for line in fil:
-            if line[0] == '>':
-                flag[idx] = 'FASTA'
-                break
-            flag[idx] = 'FASTQ'
-            break
-        fil.close()
-
-    if(flag[0] == 'FASTQ'):
-        message("fastq2reads: %s -> %s" % (vars.fq1,vars.reads1))
-        fastq2reads(vars.fq1,vars.reads1,vars.maxreads)
-    else:
-        #shutil.copyfile(vars.fq1, vars.reads1)
-        copy_fasta(vars.fq1, vars.reads1, vars.maxreads)
-
+    records = read_records(vars.fq1,vars.maxreads)
     if vars.single_end==True:
       message("assuming single-ended reads")
-      message("creating %s" % vars.trimmed1)
-      extract_staggered(vars.reads1,vars.trimmed1,vars)
-
-      return
-
-    if(flag[1] == 'FASTQ'):
-        message("fastq2reads: %s -> %s" % (vars.fq2,vars.reads2))
-        fastq2reads(vars.fq2,vars.reads2,vars.maxreads)
     else:
-        #shutil.copyfile(vars.fq2, vars.reads2)
-        copy_fasta(vars.fq2, vars.reads2, vars.maxreads)
-
-    message("fixing headers of paired reads for bwa...")
-    fix_paired_headers_for_bwa(vars.reads1,vars.reads2)
-
-    message("extracting barcodes and genomic parts of reads...")
-
-    message("creating %s" % vars.trimmed1)
-    extract_staggered(vars.reads1,vars.trimmed1,vars)
-
-    message("creating %s" % vars.trimmed2)
-    select_reads(vars.trimmed1,vars.reads2,vars.trimmed2)
-    #message("creating %s" % vars.barcodes2)
-    #select_cycles(vars.trimmed2,22,30,vars.barcodes2)
-    #message("creating %s" % vars.genomic2)
-    #select_cycles(vars.trimmed2,43,-1,vars.genomic2)
-
-    # instead of using select_cycles, do these both in one shot by looking for constant seqs
-    message("creating %s" % vars.barcodes2)
-    message("creating %s" % vars.genomic2)
-    extract_barcodes(vars.trimmed2,vars.barcodes2,vars.genomic2, vars.mm1)
-
-    message("creating %s" % vars.barcodes1)
-    replace_ids(vars.trimmed1,vars.barcodes2,vars.barcodes1)
+      message("extracting barcodes and genomic parts of reads...")
+      records = paired_records(records,read_records(vars.fq2,vars.maxreads))
+
+    outfiles = [vars.trimmed1]
+    if vars.single_end==False: outfiles += [vars.genomic2,vars.barcodes1]
+    if vars.debug: 
+      outfiles += [vars.reads1,vars.trimmed1+"_failed_trim"]
+      if vars.single_end==False: outfiles += [vars.reads2,vars.trimmed2,vars.barcodes2]
+    for fname in outfiles: message("creating %s" % fname)
+    files = dict((fname,open_reads(fname,"w")) for fname in outfiles)
+
+    vars.read_length = 0
+    trimmed = extract_staggered_records(records,vars)
+    while True:
+     chunk = list(itertools.islice(trimmed,CHUNK_SIZE))
+     if not chunk: break
+     if vars.single_end==False: # barcodes for the reads 2 paired with trimmed reads 1
+       barcodes = iter(extract_barcode_batch([record[3] for (record,genomic) in chunk if genomic],vars.mm1))
+     for record,genomic in chunk:
+      h1,r1 = record[0],record[1]
+      if vars.read_length==0: vars.read_length = len(r1)
+      if vars.debug:
+        write_read(files[vars.reads1],h1,r1)
+        if vars.single_end==False: write_read(files[vars.reads2],record[2],record[3])
+      if genomic:
+        write_read(files[vars.trimmed1],h1,genomic)
+        if vars.single_end==False:
+          h2,r2 = record[2],record[3]
+          bstart,barcode,gstart,genomic2 = next(barcodes)
+          write_read(files[vars.genomic2],h2,genomic2)
+          write_read(files[vars.barcodes1],h1,barcode)
+          if vars.debug:
+            write_read(files[vars.trimmed2],h2,r2)
+            write_read(files[vars.barcodes2],h2,barcode)
+      elif genomic==None and vars.debug:
+        write_read(files[vars.trimmed1+"_failed_trim"],h1,r1)
+    for fil in files.values(): fil.close()
+
+# pair up the reads from 2 streams as (header1,seq1,header2,seq2), with headers fixed for bwa
+
+def paired_records(records1,records2):
+  tot = 0
+  for (h1,r1),(h2,r2) in zip(records1,records2):
+    tot += 1
+    if tot%1000000==0: message("%s reads processed" % tot)
+    try: h1,h2 = fix_paired_headers(h1,h2)
+    except Exception as ex: error(ex.args[0])
+    yield h1,r1,h2,r2
 
 #  pattern for read 2...
 #    TAGTGGATGATGGCCGGTGGATTTGTG GTAATTACCA TGGTCGTGGTAT CCCAGCGCGACTTCTTCGGCGCACACACC TAACAGGTTGGCTGATAAGTCCCCG?AGAT AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGTAGATCTCGGT
@@ -798,75 +808,83 @@ def extract_reads(vars):
 #    if genomic part is too short, just output at least 20bp of const so as not to mess up BWA
 #    could the start of these be shifted slightly?
 
-def extract_barcodes(fn_tgtta2,fn_barcodes2,fn_genomic2,mm1):
-  const1 = "GATGGCCGGTGGATTTGTG"
-  const2 = "TGGTCGTGGTAT"
-  const3 = "TAACAGGTTGGCTGATAAG"
-  nconst1,nconst2,nconst3 = len(const1),len(const2),len(const3)
-  fl_barcodes2 = open(fn_barcodes2,"w")
-  fl_genomic2 = open(fn_genomic2,"w")
-  tot,DEBUG = 0,0
-  for line in open(fn_tgtta2):
-    line = line.rstrip()
-    if line[0]=='>': header = line
-    else:
-      tot += 1
-      if tot%1000000==0: message("%s reads processed" % tot)
-      #a  = line.find(const1)
-      #b  = line.find(const2)
-      #c  = line.find(const3)
-      a  = mmfind(line,len(line),const1,nconst1, mm1)
-      b  = mmfind(line,len(line),const2,nconst2, mm1)
-      c  = mmfind(line,len(line),const3,nconst3, mm1)
-      bstart,bend = a+nconst1,b
-      gstart,gend = b+nconst2,len(line)
-      if c!=-1 and c-gstart>20: gend = c
-      if a==-1 or bend<bstart+5 or bend>bstart+15:
-        # you can't just reject these, beacuse they are paired with R1
-        # but setting the genomic part to the first 20 cycles should prevent it from mapping
-        bstart,bend = 0,10
-        gstart,gend = 0,20
-        barcode,genomic = "XXXXXXXXXX","XXXXXXXXXX"
-      else: barcode,genomic = line[bstart:bend],line[gstart:gend]
-      if len(genomic)==0:
-          genomic = "XXX" #Necessary to avoid a bizarre error with bwa when there is an empty line.
-      if DEBUG==1:
-        fl_barcodes2.write(header+"\n")
-        fl_barcodes2.write(line+"\n")
-        #fl_barcodes2.write((" "*bstart)+line[bstart:bend]+"\n")
-        fl_barcodes2.write((" "*bstart)+barcode+"\n")
-        fl_genomic2.write(header+"\n")
-        fl_genomic2.write(line+"\n")
-        #fl_genomic2.write((" "*gstart)+line[gstart:gend]+"\n")
-        fl_genomic2.write((" "*gstart)+genomic+"\n")
-      else:
-        fl_barcodes2.write(header+"\n")
-        #fl_barcodes2.write(line[bstart:bend]+"\n")
-        fl_barcodes2.write(barcode+"\n")
-        fl_genomic2.write(header+"\n")
-        #fl_genomic2.write(line[gstart:gend]+"\n")
-        fl_genomic2.write(genomic+"\n")
-  fl_barcodes2.close()
-  fl_genomic2.close()
-  if DEBUG==1: sys.exit(0)
-
-
+CONST1 = "GATGGCCGGTGGATTTGTG"
+CONST2 = "TGGTCGTGGTAT"
+CONST3 = "TAACAGGTTGGCTGATAAG"
+
+# returns a list of (bstart,barcode,gstart,genomic) for reads 2
+
+def extract_barcode_batch(seqs,mm1):
+  nconst1,nconst2 = len(CONST1),len(CONST2)
+  #a  = line.find(const1)
+  #b  = line.find(const2)
+  #c  = line.find(const3)
+  A = mmfind_batch(seqs,CONST1,mm1).tolist()
+  B = mmfind_batch(seqs,CONST2,mm1).tolist()
+  C = mmfind_batch(seqs,CONST3,mm1).tolist()
+  results = []
+  for line,a,b,c in zip(seqs,A,B,C):
+    bstart,bend = a+nconst1,b
+    gstart,gend = b+nconst2,len(line)
+    if c!=-1 and c-gstart>20: gend = c
+    if a==-1 or bend<bstart+5 or bend>bstart+15:
+      # you can't just reject these, beacuse they are paired with R1
+      # but setting the genomic part to the first 20 cycles should prevent it from mapping
+      bstart,bend = 0,10
+      gstart,gend = 0,20
+      barcode,genomic = "XXXXXXXXXX","XXXXXXXXXX"
+    else: barcode,genomic = line[bstart:bend],line[gstart:gend]
+    if len(genomic)==0:
+        genomic = "XXX" #Necessary to avoid a bizarre error with bwa when there is an empty line.
+    results.append((bstart,barcode,gstart,genomic))
+  return results
+
+# copies bwa's messages to the log as they come, collecting errors to raise once bwa is done
+
+def log_bwa_stderr(stderr, errors):
+    for line in stderr:
+        if "Permission denied" in line:
+            errors.append(IOError("Error: BWA encountered a permissions error: \n\n%s" % line))
+        if "invalid option" in line:
+            errors.append(ValueError("Error: Unrecognized flag for BWA: %s" % (line.split()[-1])))
+        sys.stderr.write("%s\n" % line.strip())
 
 def bwa_subprocess(command, outfile):
     commandstr = " ".join(command)
     if outfile.name != "<stdout>":
         commandstr += " > %s" % outfile.name
     message(commandstr)
-    process = subprocess.Popen(command, stdout=outfile, stderr=subprocess.PIPE)
-    #process.wait()
-    (pout,perr) = process.communicate()
-    #for line in iter(process.stderr.readline, ''):
-    for line in perr.split(b'\n'): # returned by communicate()
-        if b"Permission denied" in line:
-            raise IOError("Error: BWA encountered a permissions error: \n\n%s" % line)
-        if b"invalid option" in line:
-            raise ValueError("Error: Unrecognized flag for BWA: %s" % (line.split()[-1]))
-        sys.stderr.write("%s\n" % line.strip())
+    process = subprocess.Popen(command, stdout=outfile, stderr=subprocess.PIPE, universal_newlines=True)
+    errors = []
+    log_bwa_stderr(process.stderr, errors)
+    process.wait()
+    if errors: raise errors[0]
+
+# runs the bwa command producing the alignments, yielding its output (SAM) line by line as bwa writes it;
+# a copy is saved to samfile (gzipped if it ends in .gz), unless samfile is None
+
+def bwa_sam_lines(command, samfile=None):
+    commandstr = " ".join(command)
+    if samfile: commandstr += " > %s" % samfile
+    message(commandstr)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    errors = []
+    logger = threading.Thread(target=log_bwa_stderr, args=(process.stderr, errors))
+    logger.daemon = True
+    logger.start()
+    output = open_reads(samfile, "w") if samfile else None
+    try:
+        for line in process.stdout:
+            if output: output.write(line)
+            yield line
+    except BaseException: # stopped early (e.g. error in counting)
+        process.kill()
+        raise
+    finally:
+        if output: output.close()
+        process.wait()
+        logger.join()
+    if errors: raise errors[0]
 
 
 
@@ -888,9 +906,7 @@ def run_bwa(vars):
     if vars.bwa_alg == "mem":
         if vars.single_end == False:
             cmd.extend([vars.genomic2])
-        outfile = open(vars.sam, "w")
-        bwa_subprocess(cmd, outfile)
-        outfile.close()
+        vars.sam_command = cmd
 
     elif vars.bwa_alg == "aln":
         outfile = open(vars.sai1, "w")
@@ -898,10 +914,7 @@ def run_bwa(vars):
         outfile.close()
 
         if vars.single_end==True:
-            cmd = [vars.bwa, "samse", vars.ref, vars.sai1, vars.trimmed1]
-            outfile = open(vars.sam, "w")
-            bwa_subprocess(cmd, outfile)
-            outfile.close()
+            vars.sam_command = [vars.bwa, "samse", vars.ref, vars.sai1, vars.trimmed1]
 
         else:
             cmd = [vars.bwa, vars.bwa_alg]
@@ -913,20 +926,23 @@ def run_bwa(vars):
             bwa_subprocess(cmd, outfile)
             outfile.close()
             
-            cmd = [vars.bwa, "sampe", vars.ref, vars.sai1, vars.sai2, vars.trimmed1, vars.genomic2]
-            outfile = open(vars.sam, "w")
-            bwa_subprocess(cmd, outfile)
-            outfile.close()
+            vars.sam_command = [vars.bwa, "sampe", vars.ref, vars.sai1, vars.sai2, vars.trimmed1, vars.genomic2]
     else:
         raise ValueError("Error: Invalid BWA algorithm '%s' specified, acceptable algorithms are 'aln' and 'mem'" % vars.bwa_alg)
 
+    # the alignments (vars.sam_command) are streamed into the counting in generate_output() as bwa produces them,
+    # except for the barseq catalog, which needs the .sam file first
+    if vars.barseq_catalog_out!=None:
+        for line in bwa_sam_lines(vars.sam_command, vars.sam): pass
+        vars.sam_command = None
+
 
 def stats(vals):
+  vals = numpy.asarray(vals,dtype=float)
   N = float(len(vals))
-  tot,ss = 0,0
   if N == 0:
       return 0, 0
-  for x in vals: tot += x; ss += x*x
+  tot,ss = vals.sum(),(vals*vals).sum()
   mean = tot/N
   var = ss/N-mean*mean
   stdev = math.sqrt(var)
@@ -939,22 +955,13 @@ def corr(X,Y):
   if sdX == 0 or sdY == 0:
     raise ValueError("Warning: Standard deviations of counts is zero.")
 
-  cX = [x-muX for x in X]
-  cY = [y-muY for y in Y]
-  s = sum([x*y for (x,y) in zip(cX,cY)])
+  cX = numpy.asarray(X,dtype=float)-muX
+  cY = numpy.asarray(Y,dtype=float)-muY
+  s = (cX*cY).sum()
   return s/(float(len(X))*sdX*sdY)
 
-def get_read_length(filename):
-   fil = open(filename)
-   i = 0
-   for line in fil:
-      if i == 1:
-         #print("reads1 line: " + line)
-         return len(line.strip())
-      i+=1
-
 def get_genomic_portion(filename):
-   fil = open(filename)
+   fil = open_reads(filename)
    i = 0
    tot_len = 0.0
    n = 1
@@ -988,7 +995,7 @@ def create_barseq_catalog(vars, replicon_index):
     else: barcodes[header] = line.split('\n')[0]
 
   sites,nreads = {},0
-  for line in open(vars.sam):
+  for line in open_reads(vars.sam):
     if line[0]=='@': continue
     w = line.split('\t')
     samcode = int(w[1])
@@ -1053,12 +1060,18 @@ def generate_output(vars):
 
   message("tabulating template counts and statistics for reference genome %s" % vars.ref)
   # message("tabulating template counts and statistics...")
-  if vars.single_end==True: counts = read_counts(vars.ref,vars.sam,vars) # return read counts copied as template counts
-  else: counts = template_counts(vars.ref,vars.sam,vars.barcodes1,vars)
+  sam = vars.sam
+  if vars.sam_command!=None: sam = bwa_sam_lines(vars.sam_command,vars.sam) # count the reads while bwa maps them
+  try:
+    if vars.single_end==True: counts = read_counts(vars.ref,sam,vars) # return read counts copied as template counts
+    else: counts = template_counts(vars.ref,sam,vars.barcodes1,vars)
+  finally:
+    if vars.sam_command!=None: sam.close() # stops bwa, if counting failed
+
   for replicon_index in range(vars.num_replicons):
     tcfile = open(vars.tc[replicon_index],"w")
     tcfile.write('\t'.join("coord Fwd_Rd_Ct Fwd_Templ_Ct Rev_Rd_Ct Rev_Templ_Ct Tot_Rd_Ct Tot_Templ_Ct".split())+"\n")
-    for data in counts[replicon_index]: tcfile.write('\t'.join([str(x) for x in data])+"\n")
+    numpy.savetxt(tcfile, counts[replicon_index], fmt="%d", delimiter="\t")
     tcfile.close()
 
     if vars.mapped == 0:
@@ -1075,28 +1088,29 @@ def generate_output(vars):
     if vars.num_replicons > 1:
       output.write(", replicon=%d" % replicon_index)
     output.write("\n")
-    for data in counts[replicon_index]: output.write("%s %s\n" % (data[0],data[-1]))    # This is where the wig is actually written
+    numpy.savetxt(output, counts[replicon_index][:,[0,-1]], fmt="%d")    # This is where the wig is actually written
     output.close()
 
-    cur_rcounts = [x[5] for x in counts[replicon_index]]
-    cur_tcounts = [x[6] for x in counts[replicon_index]]
-    cur_rc = sum(cur_rcounts)
-    cur_tc = sum(cur_tcounts)
+    cur_counts = counts[replicon_index]
+    cur_rcounts = cur_counts[:,5]
+    cur_tcounts = cur_counts[:,6]
+    cur_rc = int(cur_rcounts.sum())
+    cur_tc = int(cur_tcounts.sum())
     cur_ratio = cur_rc/float(cur_tc) if (cur_rc != 0 and cur_tc !=0) else 0
     cur_ta_sites = len(cur_rcounts)
-    cur_tas_hit = len(list(filter(lambda x: x>0,cur_rcounts)))
+    cur_tas_hit = int(numpy.count_nonzero(cur_rcounts))
     cur_density = cur_tas_hit/float(cur_ta_sites) if cur_tas_hit != 0 else 0
-    counts[replicon_index].sort(key=lambda x: x[-1])
-    cur_max_tc = counts[replicon_index][-1][6]
-    cur_max_coord = counts[replicon_index][-1][0]
+    imax = len(cur_tcounts)-1-numpy.argmax(cur_tcounts[::-1]) # last of the sites with the most templates
+    cur_max_tc = int(cur_counts[imax,6])
+    cur_max_coord = int(cur_counts[imax,0])
     cur_NZmean = cur_tc/float(cur_tas_hit) if cur_tas_hit != 0 else 0
 
     try:
-      cur_FR_corr = corr([x[1] for x in counts[replicon_index]],[x[3] for x in counts[replicon_index]])
+      cur_FR_corr = corr(cur_counts[:,1],cur_counts[:,3])
     except ValueError:
       cur_FR_corr = float("nan")
     try:
-      cur_BC_corr = corr([x for x in cur_rcounts if x!=0],[x for x in cur_tcounts if x!=0])
+      cur_BC_corr = corr(cur_rcounts[cur_rcounts!=0],cur_tcounts[cur_tcounts!=0])
     except ValueError:
       cur_BC_corr = float("nan")
     
@@ -1115,9 +1129,9 @@ def generate_output(vars):
     BC_corr.append(cur_BC_corr)
 
   tot_reads = vars.tot_reads
-  read_length = get_read_length(vars.base + ".reads1")
-  mean_r1_genomic = get_genomic_portion(vars.base + ".trimmed1")
-  if vars.single_end==False: mean_r2_genomic = get_genomic_portion(vars.base + ".genomic2")
+  read_length = vars.read_length
+  mean_r1_genomic = get_genomic_portion(vars.trimmed1)
+  if vars.single_end==False: mean_r2_genomic = get_genomic_portion(vars.genomic2)
 
   output = open(vars.stats,"w")
   version = "1.0"
@@ -1194,7 +1208,7 @@ def generate_output(vars):
   ADAPTER2 = "TACCACGACCA" # rc of const2 region of R2, between barcode and genomic; these reads will be truncated here
   Himar1 = "ACTTATCAGCCAACCTGTTA"
   trimmed_reads,nprimer,nvector,nadapter,misprimed,ntruncated = 0,0,0,0,0,0
-  for line in open(vars.trimmed1):
+  for line in open_reads(vars.trimmed1):
     if line[0]=='>': trimmed_reads += 1; continue
     if primer in line: nprimer += 1
     if vector in line: nvector += 1
@@ -1340,6 +1354,10 @@ def initialize_globals(vars, args=[], kwargs={}):
     vars.primer_start_window = 0,20
     vars.window = None
     vars.bwa_alg = "mem"
+    vars.debug = False # keep intermediate files (reads1, reads2, trimmed2, ...)
+    vars.gzip = False # write trimmed reads (input to bwa) and .sam file gzipped
+    vars.cpus = 1 # worker processes for trimming reads
+    vars.no_sam = False # don't save bwa's output (.sam file)
     
     # Update defaults
     protocol = kwargs.get("protocol", "").lower()
@@ -1381,6 +1399,16 @@ def initialize_globals(vars, args=[], kwargs={}):
         vars.barseq_catalog_out = kwargs["barseq_catalog_out"]
     if "flags" in kwargs:
         vars.flags = kwargs["flags"]
+    if "debug" in kwargs:
+        vars.debug = True
+    if "gzip" in kwargs:
+        vars.gzip = True
+    if "no-sam" in kwargs:
+        vars.no_sam = True
+    if "cpus" in kwargs:
+        vars.cpus = int(kwargs["cpus"])
+        if vars.cpus < 1:
+            raise ValueError("Error: cpus must be at least 1")
 
     if "window-size" in kwargs:                             # [RJ] Adding support for window-size, which is the tolerance of positions for the Tn prefix
         vars.window_size = int(kwargs["window-size"])
@@ -1469,6 +1497,10 @@ def show_help():
   print('    -barseq_catalog_in|-barseq_catalog_out <file>')
   print('    -replicon-ids <comma_separated_list_of_names> # if multiple replicons/genomes/contigs/sequences were provided in -ref, give them names.')
   print('                                                  # Enter \'auto\' for autogenerated ids.')
+  print('    -gzip              # write trimmed reads for BWA and the .sam file as .gz files')
+  print('    -no-sam            # don\'t save the .sam file (reads are counted directly from BWA\'s output)')
+  print('    -cpus <INT>        # number of worker processes for finding the Tn prefix in reads; default is 1')
+  print('    -debug             # keep intermediate files (.reads1, .reads2, .trimmed2, .barcodes2, .trimmed1_failed_trim)')
 
 class Globals:
   pass
@@ -1,4 +1,5 @@
 import scipy
+import scipy.stats
 import numpy
 import heapq
 import math
@@ -110,12 +111,79 @@ class AnovaMethod(base.MultiConditionMethod):
             Gene :: {start, end, rv, gene, strand}
             Condition :: String
         """
+        (offsets, index) = self.site_segments(RvSiteindexesMap, genes)
+        (condNames, condIndex) = self.condition_index(conditions)
+        nsites = numpy.diff(offsets)
+
+        # Counts are winsorized within each condition before taking the mean
+        means = numpy.zeros((len(condNames), len(genes)))
+        for (lo, hi) in self.gene_blocks(offsets):
+            counts = data[:, index[offsets[lo]:offsets[hi]]]
+            block = offsets[lo:hi+1] - offsets[lo]
+            for c in range(len(condNames)):
+                wigs = condIndex == c
+                sums = self.segment_sum(self.winsorize_segments(counts[wigs], block), block).sum(0)
+                with numpy.errstate(divide="ignore", invalid="ignore"):
+                    means[c, lo:hi] = numpy.where(nsites[lo:hi] > 0, sums/(numpy.sum(wigs)*nsites[lo:hi]), 0)
+
         MeansByRv = {}
-        for gene in genes:
-            Rv = gene["rv"]
-            MeansByRv[Rv] = self.means_by_condition_for_gene(RvSiteindexesMap[Rv], conditions, data)
+        for (g, gene) in enumerate(genes):
+            MeansByRv[gene["rv"]] = dict(zip(condNames, means[:, g]))
         return MeansByRv
 
+    def site_segments(self, RvSiteindexesMap, genes):
+        """
+            Returns the TA sites of all genes in CSR form: the sites of genes[i] are index[offsets[i]:offsets[i+1]].
+            ({Rv: [SiteIndex]}, [Gene]) -> Tuple([Number], [SiteIndex])
+        """
+        lengths = [len(RvSiteindexesMap[gene["rv"]]) for gene in genes]
+        offsets = numpy.zeros(len(genes) + 1, dtype=int)
+        numpy.cumsum(lengths, out=offsets[1:])
+        index = numpy.array([i for gene in genes for i in RvSiteindexesMap[gene["rv"]]], dtype=int)
+        return (offsets, index)
+
+    def condition_index(self, conditions):
+        """
+            Returns the distinct conditions (in order of appearance) and the index of the condition of each wig.
+            [Condition] -> Tuple([Condition], [Number])
+        """
+        condNames = list(collections.OrderedDict.fromkeys(conditions))
+        return (condNames, numpy.array([condNames.index(c) for c in conditions], dtype=int))
+
+    def gene_blocks(self, offsets, maxsites=20000):
+        """
+            Yields ranges (lo, hi) of consecutive genes with about maxsites TA sites in total, to bound memory use.
+        """
+        G = len(offsets) - 1
+        lo = 0
+        while lo < G:
+            hi = max(lo + 1, numpy.searchsorted(offsets, offsets[lo] + maxsites, "right") - 1)
+            hi = min(hi, G)
+            yield (lo, hi)
+            lo = hi
+
+    def segment_sum(self, counts, offsets, ufunc=numpy.add):
+        """
+            Reduces each segment of columns offsets[i]:offsets[i+1] of counts (wigs x sites) with ufunc; empty segments give 0.
+        """
+        nonempty = offsets[1:] > offsets[:-1]
+        result = numpy.zeros((counts.shape[0], len(offsets) - 1))
+        if counts.shape[0] and numpy.any(nonempty):
+            result[:, nonempty] = ufunc.reduceat(counts, offsets[:-1][nonempty], axis=1)
+        return result
+
+    def winsorize_segments(self, counts, offsets):
+        """
+            Vectorized winsorize() for all genes: within each segment of columns,
+            the highest count is replaced by the second highest distinct count.
+        """
+        if counts.size == 0: return counts
+        geneIndex = numpy.repeat(numpy.arange(len(offsets) - 1), numpy.diff(offsets))
+        highest = self.segment_sum(counts, offsets, numpy.maximum).max(0)[geneIndex]
+        isHighest = counts == highest
+        second = self.segment_sum(numpy.where(isHighest, -numpy.inf, counts), offsets, numpy.maximum).max(0)[geneIndex]
+        return numpy.where(isHighest & (second > -numpy.inf), second, counts)
+
     def group_by_condition(self, wigList, conditions):
         """
             Returns array of datasets, where each dataset corresponds to one condition.
@@ -153,56 +221,49 @@ class AnovaMethod(base.MultiConditionMethod):
             SiteIndex: Integer
             Condition :: String
         """
-        count = 0
-        self.progress_range(len(genes))
-
-        MSR,MSE,Fstats,pvals,Rvs,status = [],[],[],[],[],[]
-        for gene in genes:
-            count += 1
-            Rv = gene["rv"]
-            if (len(RvSiteindexesMap[Rv]) <= 1):
-                status.append("TA sites <= 1")
-                msr,mse,Fstat,pval = 0,0,-1,1
-            else:
-                countSum, countsVec = self.group_by_condition(list(map(lambda wigData: wigData[RvSiteindexesMap[Rv]], data)), conditions)
-                if self.winz: countsVec = self.winsorize(countsVec)
-
-                if (countSum == 0):
-                    msr,mse,Fstat,pval = 0,0,-1,1
-                    status.append("No counts in all conditions")
-                else:
-                    Fstat,pval = scipy.stats.f_oneway(*countsVec)
-                    status.append("-")
-                    # countsVec is a list of numpy arrays, or could be a list of lists
-                    # pooled counts for each condition, over TAs in gene and replicates
-                    if isinstance(countsVec[0],numpy.ndarray): 
-                      countsVecAsArrays = countsVec
-                      countsVecAsLists = [grp.tolist() for grp in countsVec]
-                    else:
-                      countsVecAsArrays = [numpy.array(grp) for grp in countsVec]
-                      countsVecAsLists = countsVec
-                    allcounts = [item for sublist in countsVecAsLists for item in sublist]
-                    grandmean = numpy.mean(allcounts)
-                    groupmeans = [numpy.mean(grp) for grp in countsVecAsArrays]
-                    k,n = len(countsVec),len(allcounts)
-                    dfBetween,dfWithin = k-1,n-k
-                    msr,mse = 0,0
-                    for grp in countsVecAsArrays: msr += grp.size*(numpy.mean(grp)-grandmean)**2/float(dfBetween)
-                    for grp,mn in zip(countsVecAsArrays,groupmeans): mse += numpy.sum((grp-mn)**2) 
-                    mse /= float(dfWithin)
-                    mse = mse+self.alpha ### moderation
-                    Fmod = msr/float(mse)
-                    Pmod = scipy.stats.f.sf(Fmod,dfBetween,dfWithin)
-                    Fstat,pval = Fmod,Pmod
-            pvals.append(pval)   
-            Fstats.append(Fstat) 
-            MSR.append(msr)
-            MSE.append(mse)
-            Rvs.append(Rv)
-
-            # Update progress
-            text = "Running Anova Method... %5.1f%%" % (100.0*count/len(genes))
-            self.progress_update(text, count)
+        (offsets, index) = self.site_segments(RvSiteindexesMap, genes)
+        (condNames, condIndex) = self.condition_index(conditions)
+        K,G = len(conditions),len(genes)
+        nsites = numpy.diff(offsets)
+        k,n = len(condNames),K*nsites
+        dfBetween,dfWithin = k-1,n-k
+        groupSize = numpy.bincount(condIndex, minlength=k)[:,None] * nsites
+
+        # Per gene and condition sums, then the sum of squares within groups
+        countSum = numpy.zeros(G)
+        groupSum = numpy.zeros((k, G))
+        ssWithin = numpy.zeros(G)
+        self.progress_range(G)
+        for (lo, hi) in self.gene_blocks(offsets):
+            counts = data[:, index[offsets[lo]:offsets[hi]]].astype(float)
+            block = offsets[lo:hi+1] - offsets[lo]
+            countSum[lo:hi] = self.segment_sum(counts, block).sum(0)
+            if self.winz: counts = self.winsorize_segments(counts, block)
+            for c in range(k):
+                groupSum[c, lo:hi] = self.segment_sum(counts[condIndex == c], block).sum(0)
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                groupMean = groupSum[:, lo:hi] / groupSize[:, lo:hi]
+            geneIndex = numpy.repeat(numpy.arange(hi - lo), numpy.diff(block))
+            deviations = counts - groupMean[condIndex][:, geneIndex]
+            ssWithin[lo:hi] = self.segment_sum(deviations**2, block).sum(0)
+
+            text = "Running Anova Method... %5.1f%%" % (100.0*hi/G)
+            self.progress_update(text, hi)
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            grandMean = groupSum.sum(0) / n
+            msr = numpy.sum(groupSize * (groupSum / groupSize - grandMean)**2, 0) / float(dfBetween)
+            mse = ssWithin / dfWithin + self.alpha ### moderation
+            Fstats = msr / mse
+        pvals = scipy.stats.f.sf(Fstats, dfBetween, dfWithin)
+
+        status = numpy.full(G, "-", dtype=object)
+        noCounts = countSum == 0
+        fewSites = nsites <= 1
+        status[noCounts] = "No counts in all conditions"
+        status[fewSites] = "TA sites <= 1"
+        for x,v in [(msr,0),(mse,0),(Fstats,-1),(pvals,1)]: x[noCounts | fewSites] = v
+        MSR,MSE,Rvs = msr,mse,[gene["rv"] for gene in genes]
 
         pvals = numpy.array(pvals)
         mask = numpy.isfinite(pvals)
@@ -20,6 +20,7 @@ import math
 import random
 import numpy
 import scipy.stats
+import scipy.special
 import datetime
 
 from pytransit.analysis import base
@@ -130,6 +131,27 @@ class BinomialGUI(base.AnalysisGUI):
 
 
 
+########## DENSITIES #######################
+
+# Closed-form log-densities used by the sampler, in place of the scipy.stats
+# pdf calls (whose per-call overhead dominated each iteration).
+
+def beta_loglik(a, b, n, sum_logx, sum_log1mx):
+    """ Sum of log Beta(a,b) densities of n values x, given sum(log(x)) and sum(log(1-x)). """
+    return (a-1)*sum_logx + (b-1)*sum_log1mx - n*scipy.special.betaln(a, b)
+
+def beta_logpdf(x, a, b):
+    if x <= 0 or x >= 1: return -numpy.inf
+    return beta_loglik(a, b, 1, math.log(x), math.log1p(-x))
+
+def gamma_logpdf(x, a, loc):
+    # Same as numpy.log(scipy.stats.gamma.pdf(x, a, loc)), i.e. shape a, location loc, scale 1
+    x = x - loc
+    if x <= 0: return -numpy.inf
+    return (a-1)*math.log(x) - x - scipy.special.gammaln(a)
+
+
+
 ########## CLASS #######################
 
 class BinomialMethod(base.SingleConditionMethod):
@@ -320,13 +342,14 @@ class BinomialMethod(base.SingleConditionMethod):
         sample_size = self.samples+self.burnin
         numReps = len(self.ctrldata)
 
-        theta = numpy.zeros((Ngenes, sample_size))
+        # theta and Z are (Ngenes x sample_size); store them compactly for long chains
+        theta = numpy.zeros((Ngenes, sample_size), dtype=numpy.float32)
         theta[:,0] = 0.10
 
         rho0 = numpy.zeros(sample_size); rho0[0] = 0.5;  Kp0 = numpy.zeros(sample_size); Kp0[0] = 10;
         rho1 = numpy.zeros(sample_size); rho1[0] = 0.10; Kp1 = numpy.zeros(sample_size); Kp1[0] = 3;
 
-        Z = numpy.zeros((Ngenes, sample_size))
+        Z = numpy.zeros((Ngenes, sample_size), dtype=numpy.int8)
         pz1 = numpy.zeros(sample_size);
         n1 = 0
 
@@ -337,17 +360,15 @@ class BinomialMethod(base.SingleConditionMethod):
 
         #
         self.transit_message("Setting Initial Values")
-        K = numpy.array([sum([1 for x in gene.reads.flatten() if x> 0]) for gene in G])
-        N = numpy.array([len(gene.reads.flatten()) for gene in G])
-
-        for g,gene in enumerate(G):
-            if N[g] == 0: theta[g][0] = 0.5
-            elif K[g]/float(N[g]) == 0: theta[g][0] = 0.001
-            elif K[g]/float(N[g]) == 1: theta[g][0] = 0.001
-            else: theta[g][0] = K[g]/float(N[g])
+        K = numpy.array([numpy.sum(gene.reads > 0) for gene in G])
+        N = numpy.array([gene.reads.size for gene in G])
 
-            #print(g, ORF[g], K[g], N[g], theta[g][0])
-            Z[g][0] = scipy.stats.bernoulli.rvs(1-theta[g][0])
+        theta0 = numpy.full(Ngenes, 0.5)
+        ii = N > 0
+        theta0[ii] = K[ii]/N[ii].astype(float)
+        theta0[ii & ((K == 0) | (K == N))] = 0.001
+        theta[:,0] = theta0
+        Z[:,0] = numpy.random.binomial(1, 1-theta0)
 
 
         acc_p0 = 0; acc_k0 = 0;
@@ -359,6 +380,12 @@ class BinomialMethod(base.SingleConditionMethod):
         rho1c_std = 0.009
         kp1c_std = 1.1
 
+        # Scalar proposals and acceptance draws for the whole chain
+        rho0_step = numpy.random.normal(0, rho0c_std, sample_size)
+        Kp0_step = numpy.random.normal(0, kp0c_std, sample_size)
+        rho1_step = numpy.random.normal(0, rho1c_std, sample_size)
+        Kp1_step = numpy.random.normal(0, kp1c_std, sample_size)
+        log_u = numpy.log(numpy.random.random((sample_size, 4)))
 
         numpy.seterr(divide='ignore')
         for i in range(1, sample_size):
@@ -366,21 +393,28 @@ class BinomialMethod(base.SingleConditionMethod):
             i0 = Z[:,i-1] == 0; n0 = numpy.sum(i0);
             i1 = Z[:,i-1] == 1; n1 = numpy.sum(i1);
 
-            theta[i0,i] = scipy.stats.beta.rvs(Kp0[i-1]*rho0[i-1] + K[i0],  Kp0[i-1]*(1-rho0[i-1]) + N[i0] - K[i0])
-            theta[i1,i] = scipy.stats.beta.rvs(Kp1[i-1]*rho1[i-1] + K[i1],  Kp1[i-1]*(1-rho1[i-1]) + N[i1] - K[i1])
+            theta_i = numpy.zeros(Ngenes)
+            theta_i[i0] = numpy.random.beta(Kp0[i-1]*rho0[i-1] + K[i0],  Kp0[i-1]*(1-rho0[i-1]) + N[i0] - K[i0])
+            theta_i[i1] = numpy.random.beta(Kp1[i-1]*rho1[i-1] + K[i1],  Kp1[i-1]*(1-rho1[i-1]) + N[i1] - K[i1])
+            theta[:,i] = theta_i
+
+            # Sufficient statistics of theta for the beta likelihoods of each class
+            logx = numpy.log(theta_i); log1mx = numpy.log1p(-theta_i)
+            (slogx0, slog1mx0) = (numpy.sum(logx[i0]), numpy.sum(log1mx[i0]))
+            (slogx1, slog1mx1) = (numpy.sum(logx[i1]), numpy.sum(log1mx[i1]))
             
-            rho0_c = rho0[i-1] + scipy.stats.norm.rvs(0, rho0c_std)
-            Kp0_c = Kp0[i-1] + scipy.stats.norm.rvs(0, kp0c_std)
+            rho0_c = rho0[i-1] + rho0_step[i]
+            Kp0_c = Kp0[i-1] + Kp0_step[i]
 
 
             if rho0_c <= 0: rho0[i] = rho0[i-1]
             else:
-                fc = numpy.log(scipy.stats.beta.pdf(rho0_c, self.M0*self.pi0, self.M0*(1.0-self.pi0)))
-                f0 = numpy.log(scipy.stats.beta.pdf(rho0[i-1], self.M0*self.pi0, self.M0*(1.0-self.pi0)))
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0[i-1]*rho0_c, Kp0[i-1]*(1-rho0_c))))
-                f0 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0[i-1]*rho0[i-1], Kp0[i-1]*(1-rho0[i-1]))))
+                fc = beta_logpdf(rho0_c, self.M0*self.pi0, self.M0*(1.0-self.pi0))
+                f0 = beta_logpdf(rho0[i-1], self.M0*self.pi0, self.M0*(1.0-self.pi0))
+                fc += beta_loglik(Kp0[i-1]*rho0_c, Kp0[i-1]*(1-rho0_c), n0, slogx0, slog1mx0)
+                f0 += beta_loglik(Kp0[i-1]*rho0[i-1], Kp0[i-1]*(1-rho0[i-1]), n0, slogx0, slog1mx0)
     
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f0:
+                if log_u[i,0] < fc - f0:
                     rho0[i] = rho0_c
                     acc_p0+=1
                 else: rho0[i] = rho0[i-1]
@@ -388,29 +422,29 @@ class BinomialMethod(base.SingleConditionMethod):
 
             if Kp0_c <= 0: Kp0[i] = Kp0[i-1]
             else:
-                fc = numpy.log(scipy.stats.gamma.pdf(Kp0_c, self.a0, self.b0));
-                f0 = numpy.log(scipy.stats.gamma.pdf(Kp0[i-1], self.a0, self.b0));
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0_c*rho0[i], Kp0_c*(1-rho0[i]))))
-                f0 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0[i-1]*rho0[i], Kp0[i-1]*(1-rho0[i]))))
+                fc = gamma_logpdf(Kp0_c, self.a0, self.b0);
+                f0 = gamma_logpdf(Kp0[i-1], self.a0, self.b0);
+                fc += beta_loglik(Kp0_c*rho0[i], Kp0_c*(1-rho0[i]), n0, slogx0, slog1mx0)
+                f0 += beta_loglik(Kp0[i-1]*rho0[i], Kp0[i-1]*(1-rho0[i]), n0, slogx0, slog1mx0)
     
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f0:
+                if log_u[i,1] < fc - f0:
                     Kp0[i] = Kp0_c
                     acc_k0+=1
                 else: Kp0[i] = Kp0[i-1]
 
-            rho1_c = rho1[i-1] + scipy.stats.norm.rvs(0, rho1c_std)
-            Kp1_c = Kp1[i-1] + scipy.stats.norm.rvs(0, kp1c_std)
+            rho1_c = rho1[i-1] + rho1_step[i]
+            Kp1_c = Kp1[i-1] + Kp1_step[i]
 
 
             if rho1_c <= 0:
                 rho1[i] = rho1[i-1]
             else:
-                fc = numpy.log(scipy.stats.beta.pdf(rho1_c, self.M1*self.pi1, self.M1*(1-self.pi1)))
-                f1 = numpy.log(scipy.stats.beta.pdf(rho1[i-1], self.M1*self.pi1, self.M1*(1-self.pi1)))
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1[i-1]*rho1_c, Kp1[i-1]*(1-rho1_c))))
-                f1 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1[i-1]*rho1[i-1], Kp1[i-1]*(1-rho1[i-1]))))
+                fc = beta_logpdf(rho1_c, self.M1*self.pi1, self.M1*(1-self.pi1))
+                f1 = beta_logpdf(rho1[i-1], self.M1*self.pi1, self.M1*(1-self.pi1))
+                fc += beta_loglik(Kp1[i-1]*rho1_c, Kp1[i-1]*(1-rho1_c), n1, slogx1, slog1mx1)
+                f1 += beta_loglik(Kp1[i-1]*rho1[i-1], Kp1[i-1]*(1-rho1[i-1]), n1, slogx1, slog1mx1)
     
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f1:
+                if log_u[i,2] < fc - f1:
                     rho1[i] = rho1_c
                     acc_p1+=1
                 else: rho1[i] = rho1[i-1]
@@ -418,37 +452,32 @@ class BinomialMethod(base.SingleConditionMethod):
             if Kp1_c <= 0: Kp1[i] = Kp1[i-1]
             else:
                 
-                fc = numpy.log(scipy.stats.gamma.pdf(Kp1_c, self.a1, self.b1));
-                f1 = numpy.log(scipy.stats.gamma.pdf(Kp1[i-1], self.a1, self.b1));
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1_c*rho1[i], Kp1_c*(1-rho1[i]))))
-                f1 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1[i-1]*rho1[i], Kp1[i-1]*(1-rho1[i]))))
+                fc = gamma_logpdf(Kp1_c, self.a1, self.b1);
+                f1 = gamma_logpdf(Kp1[i-1], self.a1, self.b1);
+                fc += beta_loglik(Kp1_c*rho1[i], Kp1_c*(1-rho1[i]), n1, slogx1, slog1mx1)
+                f1 += beta_loglik(Kp1[i-1]*rho1[i], Kp1[i-1]*(1-rho1[i]), n1, slogx1, slog1mx1)
 
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f1:
+                if log_u[i,3] < fc - f1:
                     Kp1[i] = Kp1_c
                     acc_k1+=1
                 else: Kp1[i] = Kp1[i-1]
 
 
-            g0 = scipy.stats.beta.pdf(theta[:,i], Kp0[i]*rho0[i], Kp0[i]*(1-rho0[i])) * (1-w1)
-            g1 = scipy.stats.beta.pdf(theta[:,i], Kp1[i]*rho1[i], Kp1[i]*(1-rho1[i])) * (w1)
-            p1 = g1/(g0+g1)
+            (a0, b0) = (Kp0[i]*rho0[i], Kp0[i]*(1-rho0[i]))
+            (a1, b1) = (Kp1[i]*rho1[i], Kp1[i]*(1-rho1[i]))
+            g0 = (a0-1)*logx + (b0-1)*log1mx - scipy.special.betaln(a0, b0) + math.log(1-w1)
+            g1 = (a1-1)*logx + (b1-1)*log1mx - scipy.special.betaln(a1, b1) + math.log(w1)
+            with numpy.errstate(invalid='ignore'):
+                p1 = scipy.special.expit(g1 - g0)
             p1 = numpy.nan_to_num(p1)
 
-            
-            try:
-                Z[:,i] = scipy.stats.bernoulli.rvs(p1)
-            except:
-                inan = numpy.isnan(p1)
-                sys.stderr.write("K=\t", K[inan],"\n")
-                sys.stderr.write("N=\t", N[inan],"\n")
-                sys.stderr.write("theta=", theta[inan,i],'\n')
-                sys.exit()
+            Z[:,i] = numpy.random.random(Ngenes) < p1
             pz1[i] = p1[0]
 
 
             i1 = Z[:,i] == 1; n1 = numpy.sum(i1);
             #w1 = 0.15
-            w1 = scipy.stats.beta.rvs(self.alpha_w + n1, self.beta_w + Ngenes - n1)
+            w1 = numpy.random.beta(self.alpha_w + n1, self.beta_w + Ngenes - n1)
             W1[i] = w1
 
 
@@ -458,8 +487,8 @@ class BinomialMethod(base.SingleConditionMethod):
 
         numpy.seterr(divide='warn')
 
-        z_bar = numpy.apply_along_axis(numpy.mean, 1, Z[:, self.burnin:])
-        theta_bar = numpy.apply_along_axis(numpy.mean, 1, theta[:, self.burnin:])
+        z_bar = numpy.mean(Z[:, self.burnin:], axis=1, dtype=numpy.float64)
+        theta_bar = numpy.mean(theta[:, self.burnin:], axis=1, dtype=numpy.float64)
         #(ess_threshold, noness_threshold) = stat_tools.fdr_post_prob(z_bar)
         (ess_threshold, noness_threshold) = stat_tools.bayesian_ess_thresholds(z_bar)
 
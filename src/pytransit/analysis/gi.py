@@ -44,6 +44,9 @@ NOTE: This method requires 4 groups of datasets. Use the main interface to add d
 """
 
 transposons = ["himar1"]
+# Maximum number of posterior samples (genes X samples) drawn at a time
+MAX_BLOCK_SIZE = 1000000
+
 columns = ["Orf","Name","Number of TA Sites","Mean count (Strain A Condition 1)","Mean count (Strain A Condition 2)","Mean count (Strain B Condition 1)","Mean count (Strain B Condition 2)", "Mean logFC (Strain A)", "Mean logFC (Strain B)", "Mean delta logFC","Lower Bound delta logFC","Upper Bound delta logFC", "Prob. of delta-logFC being within ROPE", "Adjusted Probability", "Is HDI outside ROPE?", "Type of Interaction"]
 
 
@@ -630,6 +633,22 @@ class GIMethod(base.QuadConditionMethod):
 
 
 
+    @staticmethod
+    def gene_moments(G):
+        """
+            Returns the number of observations (replicates X TA sites), mean,
+            and variance (ddof=0 and ddof=1) of the counts of each gene of G.
+        """
+        (K, N) = (len(G.data), len(G))
+        nsites = numpy.diff(G.gene_offsets)
+        owner = numpy.tile(numpy.repeat(numpy.arange(N), nsites), K)
+        values = G.data[:, G.site_index].flatten()
+        nobs = nsites*K
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            mean = numpy.bincount(owner, weights=values, minlength=N)/nobs
+            ss = numpy.bincount(owner, weights=(values - mean[owner])**2, minlength=N)
+            return (nobs, mean, ss/nobs, ss/(nobs - 1))
+
     def Run(self):
 
 
@@ -666,159 +685,78 @@ class GIMethod(base.QuadConditionMethod):
         G_A2 = tnseq_tools.Genes([], self.annotation_path, data=data[(Na1+Nb1):(Na1+Nb1+Na2)], position=position,nterm=self.NTerminus,cterm=self.CTerminus)
         G_B2 = tnseq_tools.Genes([], self.annotation_path, data=data[(Na1+Nb1+Na2):], position=position,nterm=self.NTerminus,cterm=self.CTerminus)
 
-        means_list_a1 = []
-        means_list_b1 = []
-        means_list_a2 = []
-        means_list_b2 = []
-
-        var_list_a1 = []
-        var_list_a2 = []
-        var_list_b1 = []
-        var_list_b2 = []
+        #            Time-1   Time-2
+        #
+        #  Strain-A     A       C
+        #
+        #  Strain-B     B       D
 
+        groups = [G_A1, G_B1, G_A2, G_B2]
+        moments = [self.gene_moments(G) for G in groups]
 
         # Base priors on empirical observations across genes.
-        for gene in sorted(G_A1):
-            if gene.n > 1:
-                A1_data = G_A1[gene.orf].reads.flatten()
-                B1_data = G_B1[gene.orf].reads.flatten()
-                A2_data = G_A2[gene.orf].reads.flatten()
-                B2_data = G_B2[gene.orf].reads.flatten()
-
-                means_list_a1.append(numpy.mean(A1_data))
-                var_list_a1.append(numpy.var(A1_data))
-
-                means_list_b1.append(numpy.mean(B1_data))
-                var_list_b1.append(numpy.var(B1_data))
-
-                means_list_a2.append(numpy.mean(A2_data))
-                var_list_a2.append(numpy.var(A2_data))
-
-                means_list_b2.append(numpy.mean(B2_data))
-                var_list_b2.append(numpy.var(B2_data))
-
-        # Priors
-        mu0_A1 = scipy.stats.trim_mean(means_list_a1, 0.01)
-        mu0_B1 = scipy.stats.trim_mean(means_list_b1, 0.01)
-        mu0_A2 = scipy.stats.trim_mean(means_list_a2, 0.01)
-        mu0_B2 = scipy.stats.trim_mean(means_list_b2, 0.01)
-
-        s20_A1 = scipy.stats.trim_mean(var_list_a1, 0.01)
-        s20_B1 = scipy.stats.trim_mean(var_list_b1, 0.01)
-        s20_A2 = scipy.stats.trim_mean(var_list_a2, 0.01)
-        s20_B2 = scipy.stats.trim_mean(var_list_b2, 0.01)
+        ii = G_A1.n > 1
+        mu0 = [scipy.stats.trim_mean(mean[ii], 0.01) for (nobs, mean, var, s2) in moments]
+        s20 = [scipy.stats.trim_mean(var[ii], 0.01) for (nobs, mean, var, s2) in moments]
 
         k0=1.0
         nu0=1.0
         data = []
 
         postprob = []
-        count = 0
         N = len(G_A1)
         self.progress_range(N)
-        # Perform actual analysis
-        for gene in G_A1:
-
-            # If there is some data
-            if gene.n > 0:
-                A1_data = G_A1[gene.orf].reads.flatten()
-                B1_data = G_B1[gene.orf].reads.flatten()
-                A2_data = G_A2[gene.orf].reads.flatten()
-                B2_data = G_B2[gene.orf].reads.flatten()
-
-
-            #            Time-1   Time-2
-            #
-            #  Strain-A     A       C
-            #
-            #  Strain-B     B       D
-
-                try:
-                    muA1_post, varA1_post = stat_tools.sample_trunc_norm_post(A1_data, self.samples,
-                        mu0_A1, s20_A1, k0, nu0)
-                    muB1_post, varB1_post = stat_tools.sample_trunc_norm_post(B1_data, self.samples,
-                        mu0_B1, s20_B1, k0, nu0)
-                    muA2_post, varA2_post = stat_tools.sample_trunc_norm_post(A2_data, self.samples,
-                        mu0_A2, s20_A2, k0, nu0)
-                    muB2_post, varB2_post = stat_tools.sample_trunc_norm_post(B2_data, self.samples,
-                        mu0_B2, s20_B2, k0, nu0)
-
-                except Exception as e:
-                    muA1_post = varA1_post = numpy.ones(self.samples)
-                    muB1_post = varB1_post = numpy.ones(self.samples)
-                    muA2_post = varA2_post = numpy.ones(self.samples)
-                    muB2_post = varB2_post = numpy.ones(self.samples)
-
-                logFC_A_post = numpy.log2(muA2_post/muA1_post)
-                logFC_B_post = numpy.log2(muB2_post/muB1_post)
-                delta_logFC_post = logFC_B_post - logFC_A_post
-
-                alpha = 0.05
-
-                # Get Bounds of the HDI
-                l_logFC_A, u_logFC_A = stat_tools.HDI_from_MCMC(logFC_A_post, 1-alpha)
-
-                l_logFC_B, u_logFC_B = stat_tools.HDI_from_MCMC(logFC_B_post, 1-alpha)
-
-                l_delta_logFC, u_delta_logFC = stat_tools.HDI_from_MCMC(delta_logFC_post, 1-alpha)
-
-
-                mean_logFC_A = numpy.mean(logFC_A_post)
-                mean_logFC_B = numpy.mean(logFC_B_post)
-                mean_delta_logFC = numpy.mean(delta_logFC_post)
-
-                # Is HDI significantly different than ROPE? (i.e. no overlap)
-                not_HDI_overlap_bit = l_delta_logFC > self.rope or u_delta_logFC < -self.rope
-
-                # Probability of posterior overlaping with ROPE
-                probROPE = numpy.mean(numpy.logical_and(delta_logFC_post>=0.0-self.rope,  delta_logFC_post<=0.0+self.rope))
-
-            # If there is no data, assume empty defaults
-            else:
-                A1_data = [0,0]
-                B1_data = [0,0]
-                A2_data = [0,0]
-                B2_data = [0,0]
-                muA1_post = varA1_post = numpy.ones(self.samples)
-                muB1_post = varB1_post = numpy.ones(self.samples)
-                muA2_post = varA2_post = numpy.ones(self.samples)
-                muB2_post = varB2_post = numpy.ones(self.samples)
-                logFC_A_post = numpy.log2(muA2_post/muA1_post)
-                logFC_B_post = numpy.log2(muB2_post/muB1_post)
-                delta_logFC_post = logFC_B_post - logFC_A_post
-
-                mean_logFC_A = 0
-                mean_logFC_B = 0
-                mean_delta_logFC = 0
-                l_logFC_A = 0
-                u_logFC_A = 0
-                l_logFC_B = 0
-                u_logFC_B = 0
-                l_delta_logFC = 0
-                u_delta_logFC = 0
-                probROPE = 1.0
-
-
-            if numpy.isnan(l_logFC_A):
-                l_logFC_A = -10
-                u_logFC_A = 10
-            if numpy.isnan(l_logFC_B):
-                l_logFC_B = -10
-                u_logFC_B = 10
-            if numpy.isnan(l_delta_logFC):
-                l_delta_logFC = -10
-                u_delta_logFC = 10
-
-
-            postprob.append(probROPE)
-            data.append((gene.orf, gene.name, gene.n, numpy.mean(muA1_post), numpy.mean(muA2_post), numpy.mean(muB1_post), numpy.mean(muB2_post), mean_logFC_A, mean_logFC_B, mean_delta_logFC, l_delta_logFC, u_delta_logFC, probROPE, not_HDI_overlap_bit))
-
-
-            text = "Running GI Method... %2.0f%%" % (100.0*(count+1)/N)
+        alpha = 0.05
+        # Perform actual analysis, drawing the posteriors of a block of genes at a time
+        chunk = max(1, MAX_BLOCK_SIZE // self.samples)
+        for start in range(0, N, chunk):
+            genes = numpy.arange(start, min(start+chunk, N))
+
+            # If there is no data, assume empty defaults (posterior means of 1)
+            mu_post = [numpy.ones((len(genes), self.samples)) for G in groups]
+            hasdata = genes[G_A1.n[genes] > 0]
+            if len(hasdata):
+                posts = [stat_tools.sample_trunc_norm_post_batch(nobs[hasdata], mean[hasdata], s2[hasdata], self.samples, mu0[i], s20[i], k0, nu0)[0]
+                            for (i, (nobs, mean, var, s2)) in enumerate(moments)]
+                failed = numpy.any([numpy.isnan(post).any(1) for post in posts], 0)
+                for (i, post) in enumerate(posts):
+                    post[failed] = 1.0
+                    mu_post[i][hasdata - start] = post
+            (muA1_post, muB1_post, muA2_post, muB2_post) = mu_post
+
+            logFC_A_post = numpy.log2(muA2_post/muA1_post)
+            logFC_B_post = numpy.log2(muB2_post/muB1_post)
+            delta_logFC_post = logFC_B_post - logFC_A_post
+
+            # Get Bounds of the HDI
+            l_delta_logFC, u_delta_logFC = stat_tools.HDI_from_MCMC_batch(delta_logFC_post, 1-alpha)
+            empty = G_A1.n[genes] == 0
+            l_delta_logFC[empty] = u_delta_logFC[empty] = 0
+
+            mean_logFC_A = numpy.mean(logFC_A_post, 1)
+            mean_logFC_B = numpy.mean(logFC_B_post, 1)
+            mean_delta_logFC = numpy.mean(delta_logFC_post, 1)
+
+            # Is HDI significantly different than ROPE? (i.e. no overlap)
+            not_HDI_overlap_bit = (l_delta_logFC > self.rope) | (u_delta_logFC < -self.rope)
+
+            # Probability of posterior overlaping with ROPE
+            probROPE = numpy.mean(numpy.logical_and(delta_logFC_post>=0.0-self.rope,  delta_logFC_post<=0.0+self.rope), 1)
+
+            missing = numpy.isnan(l_delta_logFC)
+            l_delta_logFC[missing] = -10
+            u_delta_logFC[missing] = 10
+
+            means = [numpy.mean(post, 1) for post in mu_post]
+            for (j, g) in enumerate(genes):
+                gene = G_A1[int(g)]
+                postprob.append(probROPE[j])
+                data.append((gene.orf, gene.name, gene.n, means[0][j], means[2][j], means[1][j], means[3][j], mean_logFC_A[j], mean_logFC_B[j], mean_delta_logFC[j], l_delta_logFC[j], u_delta_logFC[j], probROPE[j], bool(not_HDI_overlap_bit[j])))
+
+            count = genes[-1] + 1
+            text = "Running GI Method... %2.0f%%" % (100.0*count/N)
             self.progress_update(text, count)
-            #self.transit_message_inplace("Running Export Method... %1.1f%%" % (100.0*count/(N-1)))
-            self.transit_message("analyzing %s (%1.1f%% done)" % (gene.orf,100.0*count/(N-1)))
-            count+=1
+            self.transit_message("analyzed %d genes (%1.1f%% done)" % (count, 100.0*count/N))
 
         # for HDI, maybe I should sort on abs(mean_delta_logFC); however, need to sort by prob to calculate BFDR
         probcol = -2 # probROPEs
@@ -23,6 +23,7 @@ import numpy
 import scipy.stats
 import datetime
 import warnings
+import multiprocessing
 
 from pytransit.analysis import base
 import pytransit.transit_tools as transit_tools
@@ -146,6 +147,131 @@ EXACT = 20
 
 ALPHA = 1
 BETA = 1
+
+# Closed forms of scipy.stats.gumbel_r.logpdf and scipy.stats.norm.pdf, which
+# are evaluated over all genes at every MCMC iteration; the scipy versions
+# spend most of their time on argument checking.
+def gumbel_logpdf(x, mu, sigma):
+    z = (x - mu)/sigma
+    return -z - numpy.exp(-z) - math.log(sigma)
+
+def norm_pdf(x, mu, sigma):
+    z = (x - mu)/sigma
+    return numpy.exp(-0.5*z*z)/(math.sqrt(2*math.pi)*sigma)
+
+
+def gumbel_mu(p, N, cache=None):
+    """
+        Location of the Gumbel distribution of the maximum run for each gene, given
+        P_nonins p and the number of sites N. Genes with fewer than EXACT sites use the
+        exact expected maximum run, looked up from a table computed once for p.
+    """
+    q = 1.0 - p
+    BetaGamma = tnseq_tools.getGamma()/math.log(1/p)
+    mu = numpy.log(N*q) / numpy.log(1/p)
+    small = N < EXACT # estimate more accurately based on expected run len, using exact calc for small genes
+    if numpy.any(small):
+      if cache is None: cache = {}
+      if p not in cache:
+        if len(cache) > 100: cache.clear()
+        cache[p] = tnseq_tools.ExpectedRuns_table(EXACT-1, p)
+      mu[small] = cache[p][N[small].astype(int)] - BetaGamma
+    return mu
+
+def F_non(p, N, R, cache=None): # pass in P_nonins as p
+    total = numpy.log(scipy.stats.beta.pdf(p,ALPHA,BETA))
+    mu = gumbel_mu(p, N, cache)
+    sigma = 1/math.log(1/p);
+    #for i in range(len(N)): print('\t'.join([str(x) for x in N[i],R[i],self.ExpectedRuns_cached(int(N[i]),q),mu[i],scipy.stats.gumbel_r.pdf(R[i], mu[i], sigma)]))
+    total += numpy.sum(gumbel_logpdf(R, mu, sigma))
+    return(total)
+
+def sample_Z(p, w1, N, R, S, T, mu_s, sigma_s, SIG, cache=None):
+    G = len(N)
+    mu = gumbel_mu(p, N, cache)
+    sigma = 1.0/math.log(1.0/p);
+    h0 = ((numpy.exp(gumbel_logpdf(R,mu,sigma))) * norm_pdf(S, mu_s*R, sigma_s)  * (1-w1))
+    h1 = SIG * w1
+    h1 += 1e-10; h0 += 1e-10 # to prevent div-by-zero; if neither class is probable, p(z1) should be ~0.5
+    p_z1 = h1/(h0+h1)
+    return numpy.random.binomial(1, p_z1, size=G)
+
+
+########## WORKERS #######################
+
+def sample_chain(params, progress=None):
+    """
+        Runs one Metropolis-within-Gibbs chain for phi, Z and w1.
+        params :: {parameter: value} with the gene data (N, R, S, T, SIG), the regression
+                  parameters (mu_s, sigma_s), the initial classes Z0 and the options
+                  (samples, burnin, trim) of the GumbelMethod
+        progress :: optional function called with the iteration count after each iteration
+        Returns (phi_sample, Z_sample, acctot, count). Raises ValueError on poor data.
+    """
+    (N, R, S, T, SIG) = (params["N"], params["R"], params["S"], params["T"], params["SIG"])
+    (mu_s, sigma_s) = (params["mu_s"], params["sigma_s"])
+    (samples, burnin, trim) = (params["samples"], params["burnin"], params["trim"])
+    cache = {}
+
+    #Set Default parameter values
+    w1 = 0.15
+    w0 = 1.0 - w1
+    ALPHA_w = 600
+    BETA_w = 3400
+    mu_c = 0
+    acctot = 0.0
+    phi_start = 0.3
+    sigma_c = 0.01 
+
+    N_GOOD = len(N)
+    Z_sample = numpy.zeros((N_GOOD, samples))
+    Z_sample[:,0] = params["Z0"]
+    N_ESS = numpy.sum(Z_sample[:,0] == 1)
+    
+    phi_sample = numpy.zeros(samples) #[]
+    phi_sample[0] = phi_start
+    phi_old = phi_start
+    phi_new = 0.00
+
+    i = 1; count = 0;
+    while i < samples:
+
+        # PHI
+        acc = 1.0
+        phi_new  = phi_old + random.gauss(mu_c, sigma_c)
+        i0 = Z_sample[:,i-1] == 0
+        if phi_new > 1 or phi_new <= 0 or (F_non(phi_new, N[i0], R[i0], cache) - F_non(phi_old, N[i0], R[i0], cache)) < math.log(random.uniform(0,1)):
+            phi_new = phi_old
+            acc = 0.0
+            flag = 0
+    
+        # Z
+        Z = sample_Z(phi_new, w1, N, R, S, T, mu_s, sigma_s, SIG, cache)
+    
+        # w1
+        N_ESS = numpy.sum(Z == 1)
+        w1 = scipy.stats.beta.rvs(N_ESS + ALPHA_w, N_GOOD - N_ESS + BETA_w)
+    
+        count +=1
+        acctot+=acc
+    
+        if (count > burnin) and (count % trim == 0):
+            phi_sample[i] = phi_new
+            Z_sample[:,i] = Z
+            i+=1
+
+        phi_old = phi_new
+        if progress: progress(count)
+
+    return (phi_sample, Z_sample, acctot, count)
+
+def sample_chains(args):
+    # Runs one chain in a worker process, with its own seed
+    (params, seed) = args
+    random.seed(seed)
+    numpy.random.seed(seed)
+    return sample_chain(params)
+
 class GumbelMethod(base.SingleConditionMethod):
     """   
     Gumbel
@@ -164,17 +290,20 @@ class GumbelMethod(base.SingleConditionMethod):
                 LOESS=False,
                 ignoreCodon=True,
                 NTerminus=0.0,
-                CTerminus=0.0, wxobj=None):
+                CTerminus=0.0, wxobj=None,
+                chains=1):
 
         base.SingleConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldata, annotation_path, output_file, replicates=replicates, normalization=normalization, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
         self.samples = samples
         self.burnin = burnin
         self.trim = trim
         self.minread = minread
+        self.chains = chains
       
 
         self.cache_nn = {}
         self.cache_expruns = {}
+        self.cache_exprun_tables = {}
 
     @classmethod
     def fromGUI(self, wxobj):
@@ -287,6 +416,7 @@ class GumbelMethod(base.SingleConditionMethod):
         ignoreCodon = True
         NTerminus = float(kwargs.get("iN", 0.0))
         CTerminus = float(kwargs.get("iC", 0.0))
+        chains = int(kwargs.get("chains", 1))
 
         return self(ctrldata,
                 annotationPath,
@@ -300,27 +430,16 @@ class GumbelMethod(base.SingleConditionMethod):
                 LOESS,
                 ignoreCodon,
                 NTerminus,
-                CTerminus)
+                CTerminus,
+                chains=chains)
 
     def Run(self):
 
         self.status_message("Starting Gumbel Method")
 
-        #Set Default parameter values
-        w1 = 0.15
-        w0 = 1.0 - w1
-        ALPHA = 1
-        BETA = 1
-        ALPHA_w = 600
-        BETA_w = 3400
-        mu_c = 0
-        acctot = 0.0
-        phi_start = 0.3
-        sigma_c = 0.01 
-        
         start_time = time.time()
        
-        self.progress_range(self.samples+self.burnin)
+        self.progress_range(self.samples+self.burnin*self.chains)
         
         #Get orf data
         self.transit_message("Reading Annotation")
@@ -359,15 +478,7 @@ class GumbelMethod(base.SingleConditionMethod):
         N_GOOD = sum(ii_good)
 
         self.transit_message("Setting Initial Class")
-        Z_sample = numpy.zeros((N_GOOD, self.samples))
-        Z = [self.classify(g.n, g.r, 0.5)   for g in G if self.good_orf(g)]
-        Z_sample[:,0] = Z
-        N_ESS = numpy.sum(Z_sample[:,0] == 1)
-        
-        phi_sample = numpy.zeros(self.samples) #[]
-        phi_sample[0] = phi_start
-        phi_old = phi_start
-        phi_new = 0.00
+        Z0 = numpy.array([self.classify(g.n, g.r, 0.5)   for g in G if self.good_orf(g)])
         
         SIG = numpy.array([self.sigmoid(g.s, g.t) * scipy.stats.norm.pdf(g.r, mu_r*g.s, sigma_r) for g in G if self.good_orf(g)])
 
@@ -376,48 +487,55 @@ class GumbelMethod(base.SingleConditionMethod):
 #          if G[i].name=="glf": idxG = i
 #          if ii_good[i]==True: idxN += 1 # could do sum(ii_good[:idxG])
 
-        i = 1; count = 0;
-        while i < self.samples:
-
-            try:
-                # PHI
-                acc = 1.0
-                phi_new  = phi_old + random.gauss(mu_c, sigma_c)
-                i0 = Z_sample[:,i-1] == 0
-                if phi_new > 1 or phi_new <= 0 or (self.F_non(phi_new, N[i0], R[i0]) - self.F_non(phi_old, N[i0], R[i0])) < math.log(random.uniform(0,1)):
-                    phi_new = phi_old
-                    acc = 0.0
-                    flag = 0
-            
-                # Z
-                Z = self.sample_Z(phi_new, w1, N, R, S, T, mu_s, sigma_s, SIG)
-            
-                # w1
-                N_ESS = sum(Z == 1)
-                w1 = scipy.stats.beta.rvs(N_ESS + ALPHA_w, N_GOOD - N_ESS + BETA_w)
-            
-                count +=1
-                acctot+=acc
-            
-                if (count > self.burnin) and (count % self.trim == 0):
-                    phi_sample[i] = phi_new
-                    Z_sample[:,i] = Z
-                    i+=1
-
-            except ValueError as e:
-                self.transit_message("Error: %s" % e) 
-                self.transit_message("This is likely to have been caused by poor data (e.g. too sparse).") 
-                self.transit_message("If the density of the dataset is too low, the Gumbel method will not work.") 
-                self.transit_message("Quitting.") 
-                return
-
-#            print(i,phi_new,w1,G[idxG].name,N[idxN],R[idxN],Z[idxN])
-            
-            phi_old = phi_new
-            #Update progress
-            text = "Running Gumbel Method with Binomial Essentiality Calls... %5.1f%%" % (100.0*(count+1)/(self.samples+self.burnin))
-            self.progress_update(text, count)
+        params = {"N": N, "R": R, "S": S, "T": T, "SIG": SIG, "mu_s": mu_s, "sigma_s": sigma_s, "Z0": Z0,
+                  "samples": self.samples, "burnin": self.burnin, "trim": self.trim}
 
+        try:
+            if self.chains > 1:
+                # Each chain draws its share of the samples, after its own burn-in
+                self.transit_message("Running %d chains in parallel" % self.chains)
+                params["samples"] = int(math.ceil(self.samples/float(self.chains)))
+                seeds = numpy.random.randint(0, 2**31-1, self.chains)
+                pool = multiprocessing.Pool(self.chains)
+                chains = []
+                try:
+                    for chain in pool.imap(sample_chains, [(params, int(seed)) for seed in seeds]):
+                        chains.append(chain)
+                        count = sum([c[3] for c in chains])
+                        text = "Running Gumbel Method with Binomial Essentiality Calls... %5.1f%%" % (100.0*(count+1)/(self.samples+self.burnin*self.chains))
+                        self.progress_update(text, count)
+                    pool.close()
+                    pool.join()
+                finally:
+                    pool.terminate()
+            else:
+                def progress(count):
+                    #Update progress
+                    text = "Running Gumbel Method with Binomial Essentiality Calls... %5.1f%%" % (100.0*(count+1)/(self.samples+self.burnin))
+                    self.progress_update(text, count)
+                chains = [sample_chain(params, progress)]
+
+        except ValueError as e:
+            self.transit_message("Error: %s" % e) 
+            self.transit_message("This is likely to have been caused by poor data (e.g. too sparse).") 
+            self.transit_message("If the density of the dataset is too low, the Gumbel method will not work.") 
+            self.transit_message("Quitting.") 
+            return
+
+        if self.chains > 1:
+            # Pool the draws of all chains, leaving out each chain's starting values
+            phi_sample = numpy.concatenate([c[0][1:] for c in chains])
+            Z_sample = numpy.hstack([c[1][:,1:] for c in chains])
+        else:
+            phi_sample, Z_sample = chains[0][0], chains[0][1]
+        acctot = sum([c[2] for c in chains])
+        count = sum([c[3] for c in chains])
+        i = len(phi_sample)
+
+        # Convergence of phi, leaving out the starting value of each chain
+        phi_chains = numpy.array([c[0][1:] for c in chains])
+        phi_rhat = stat_tools.rhat(phi_chains)
+        phi_ess = stat_tools.effective_sample_size(phi_chains)
 
         ZBAR = numpy.apply_along_axis(numpy.mean, 1, Z_sample)
         (ess_t, non_t) = stat_tools.bayesian_ess_thresholds(ZBAR)
@@ -444,11 +562,15 @@ class GumbelMethod(base.SingleConditionMethod):
         self.output.write("#Total number of TA sites: %s\n" % nsites)
         self.output.write("#Genome-wide saturation: %s\n" % (round(sat,3))) # datasets merged
         self.output.write("#phi estimate:\t%f (non-insertion probability in non-essential regions)\n" % numpy.average(phi_sample))
+        self.output.write("#phi R-hat:\t%f (%d chains; values near 1.0 indicate convergence)\n" % (phi_rhat, self.chains))
+        self.output.write("#phi effective sample size:\t%1.1f\n" % phi_ess)
         self.output.write("#Minimum number of TA sites with 0 insertions to be classified as essential by Binomial: \t%0.3f\n" % binomial_n)
         self.output.write("#Time: %s s\n" % (round(time.time()-start_time,1)))
 
         i = 0
         data,calls = [],[]
+        local_sites = G.local_sites()
+        local_thetas = G.local_thetas()
         for j,g in enumerate(G):
             if not self.good_orf(g):
                 zbar = -1.0
@@ -457,7 +579,7 @@ class GumbelMethod(base.SingleConditionMethod):
                 i+=1
             if zbar > ess_t:
                 call = "E"
-            elif G.local_sites()[j]>binomial_n and G.local_thetas()[j]==0.0:
+            elif local_sites[j]>binomial_n and local_thetas[j]==0.0:
                 call = "EB"
             elif non_t <= zbar <= ess_t:
                 call = "U"
@@ -499,6 +621,7 @@ class GumbelMethod(base.SingleConditionMethod):
         -r <string>     :=  How to handle replicates. Sum or Mean. Default: -r Sum
         -iN <float>     :=  Ignore TAs occuring within given percentage (as integer) of the N terminus. Default: -iN 0
         -iC <float>     :=  Ignore TAs occuring within given percentage (as integer) of the C terminus. Default: -iC 0
+        -chains <int>   :=  Number of independent chains, run in parallel processes. The samples (-s) are divided among the chains, each with its own burn-in. Default: -chains 1
         """ % (sys.argv[0])
 
     def good_orf(self, gene):
@@ -520,31 +643,14 @@ class GumbelMethod(base.SingleConditionMethod):
         if pval < 0.05: return(1)
         else: return(0)
 
+    def gumbel_mu(self, p, N):
+        return gumbel_mu(p, N, self.cache_exprun_tables)
+
     def F_non(self, p, N, R): # pass in P_nonins as p
-        q = 1.0 - p; 
-        BetaGamma = tnseq_tools.getGamma()/math.log(1/p)
-        total = numpy.log(scipy.stats.beta.pdf(p,ALPHA,BETA))
-        mu = numpy.log(N*q) / numpy.log(1/p)
-        for i in range(len(N)): # estimate more accurately based on expected run len, using exact calc for small genes
-          if N[i]<EXACT: mu[i] = self.ExpectedRuns_cached(int(N[i]),p)-BetaGamma
-        sigma = 1/math.log(1/p);
-        #for i in range(len(N)): print('\t'.join([str(x) for x in N[i],R[i],self.ExpectedRuns_cached(int(N[i]),q),mu[i],scipy.stats.gumbel_r.pdf(R[i], mu[i], sigma)]))
-        total += numpy.sum(scipy.stats.gumbel_r.logpdf(R, mu, sigma))
-        return(total)
+        return F_non(p, N, R, self.cache_exprun_tables)
     
     def sample_Z(self, p, w1, N, R, S, T, mu_s, sigma_s, SIG):
-        G = len(N)
-        q = 1.0-p
-        BetaGamma = tnseq_tools.getGamma()/math.log(1/p)
-        mu = numpy.log(N*q) / numpy.log(1/p)
-        for i in range(len(N)): # estimate more accurately based on expected run len, using exact calc for small genes
-          if N[i]<EXACT: mu[i] = self.ExpectedRuns_cached(int(N[i]),p)-BetaGamma
-        sigma = 1.0/math.log(1.0/p);
-        h0 = ((numpy.exp(scipy.stats.gumbel_r.logpdf(R,mu,sigma))) * scipy.stats.norm.pdf(S, mu_s*R, sigma_s)  * (1-w1))
-        h1 = SIG * w1
-        h1 += 1e-10; h0 += 1e-10 # to prevent div-by-zero; if neither class is probable, p(z1) should be ~0.5
-        p_z1 = h1/(h0+h1)
-        return scipy.stats.binom.rvs(1, p_z1, size=G)
+        return sample_Z(p, w1, N, R, S, T, mu_s, sigma_s, SIG, self.cache_exprun_tables)
 
     def sigmoid(self,d,n):
         Kn = 0.1
@@ -552,12 +658,10 @@ class GumbelMethod(base.SingleConditionMethod):
 
         if d == 0: return(0.00)
         f = 1./(1.+math.exp(Kn*(MEAN_DOMAIN_SPAN-d)))
-        #if n in self.cache_nn: return f/self.cache_nn[n]
-        tot = 0
-        N = int(n+1)
-        for i in range(1,N): tot += 1.0/(1.0+math.exp(Kn*(MEAN_DOMAIN_SPAN-i)))
-        self.cache_nn[n] = tot
-        return f/tot
+        if n not in self.cache_nn:
+          i = numpy.arange(1,int(n+1))
+          self.cache_nn[n] = numpy.sum(1.0/(1.0+numpy.exp(Kn*(MEAN_DOMAIN_SPAN-i))))
+        return f/self.cache_nn[n]
 
 
 
@@ -29,9 +29,127 @@ import pytransit.tnseq_tools as tnseq_tools
 import pytransit.norm_tools as norm_tools
 import pytransit.stat_tools as stat_tools
 
+try:
+    import numba
+    hasNumba = True
+except Exception as e:
+    hasNumba = False
+
 #method_name = "hmm"
 
 
+############# KERNELS ##################
+
+# The recursions below run over every site, so they are written as plain loops
+# over preallocated (T x Nstates) arrays. If numba is installed they are
+# compiled; otherwise they run as regular python/numpy code.
+
+def jit(f):
+    if hasNumba:
+        return numba.njit(cache=True)(f)
+    return f
+
+MAX_FLOAT = numpy.finfo(numpy.float64).max
+
+@jit
+def forward_kernel(A, b, PI):
+    """
+        Scaled forward pass; b is the (T x Nstates) matrix of emission probabilities.
+        Returns alpha (T x Nstates) and the scaling factors C (T).
+    """
+    (T, N) = b.shape
+    alpha = numpy.zeros((T, N))
+    C = numpy.zeros(T)
+
+    alpha[0] = PI * b[0]
+    C[0] = 1.0/numpy.sum(alpha[0])
+    alpha[0] = C[0] * alpha[0]
+
+    for t in range(1, T):
+        alpha[t] = numpy.dot(alpha[t-1], A) * b[t]
+
+        total = numpy.sum(alpha[t])
+        C[t] = 1.0/total if total > 0 else MAX_FLOAT
+        alpha[t] = alpha[t] * C[t]
+
+        if numpy.sum(alpha[t]) == 0:
+            alpha[t] = 0.0000000000001
+    return (alpha, C)
+
+@jit
+def backward_kernel(A, b, C):
+    """
+        Scaled backward pass; b is the (T x Nstates) matrix of emission probabilities
+        (at the current site, as in the original implementation), C the scaling
+        factors from the forward pass (or empty).
+    """
+    (T, N) = b.shape
+    beta = numpy.zeros((T, N))
+    scaled = len(C) > 0 and numpy.any(C != 0)
+
+    beta[T-1] = 1.0
+    if scaled: beta[T-1] = beta[T-1] * C[T-1]
+
+    for t in range(T-2, -1, -1):
+        beta[t] = numpy.dot(A, b[t] * beta[t+1])
+
+        if numpy.sum(beta[t]) == 0:
+            beta[t] = 0.0000000000001
+
+        if scaled:
+            beta[t] = beta[t] * C[t]
+    return beta
+
+@jit
+def viterbi_kernel(A, logb, logPI):
+    """
+        Viterbi pass in log-space; A and logb are log-probabilities, logb is (T x Nstates).
+        Returns the optimal path, delta (T x Nstates) and backpointers Q (T x Nstates).
+    """
+    (T, N) = logb.shape
+    delta = numpy.zeros((T, N))
+    Q = numpy.zeros((T, N), dtype=numpy.int64)
+
+    delta[0] = logPI + logb[0]
+    for t in range(1, T):
+        for i in range(N):
+            best = 0
+            for j in range(1, N):
+                if delta[t-1, j] + A[j, i] > delta[t-1, best] + A[best, i]: best = j
+            Q[t, i] = best
+            delta[t, i] = delta[t-1, best] + A[best, i] + logb[t, i]
+
+    Q_opt = numpy.zeros(T, dtype=numpy.int64)
+    Q_opt[T-1] = numpy.argmax(delta[T-1])
+    for t in range(T-2, -1, -1):
+        Q_opt[t] = Q[t+1, Q_opt[t+1]]
+    return (Q_opt, delta, Q)
+
+@jit
+def reestimate_kernel(A, b, alpha, C):
+    """
+        Backward pass for Baum-Welch re-estimation, using the scaled alpha (T x Nstates)
+        and C from forward_kernel. Returns the state posteriors gamma (T x Nstates) and
+        the expected transition counts xi, summed over all sites (Nstates x Nstates).
+    """
+    (T, N) = b.shape
+    gamma = numpy.zeros((T, N))
+    xi = numpy.zeros((N, N))
+
+    beta = numpy.ones(N) * C[T-1]
+    gamma[T-1] = alpha[T-1] * beta
+    for t in range(T-2, -1, -1):
+        bb = b[t+1] * beta
+        xi += numpy.outer(alpha[t], bb) * A
+        beta = numpy.dot(A, bb) * C[t]
+        gamma[t] = alpha[t] * beta
+
+    for t in range(T):
+        total = numpy.sum(gamma[t])
+        if total > 0: gamma[t] = gamma[t] / total
+    return (gamma, xi)
+
+
 ############# GUI ELEMENTS ##################
 
 short_name = "hmm"
@@ -138,8 +256,8 @@ class HMMGUI(base.AnalysisGUI):
 
 
         # REPLICATE
-        hmmRepChoiceChoices = [ u"Sum", u"Mean" ]
-        (hmmRepLabel, self.wxobj.hmmRepChoice, repSizer) = self.defineChoiceBox(hmmPanel, u"Replicates:", hmmRepChoiceChoices, "Determines how to handle replicates, and their read-counts. When using many replicates, using 'Mean' may be recommended over 'Sum'")
+        hmmRepChoiceChoices = [ u"Sum", u"Mean", u"Product" ]
+        (hmmRepLabel, self.wxobj.hmmRepChoice, repSizer) = self.defineChoiceBox(hmmPanel, u"Replicates:", hmmRepChoiceChoices, "Determines how to handle replicates, and their read-counts. When using many replicates, using 'Mean' may be recommended over 'Sum'. 'Product' uses the likelihood of each replicate rather than combining them.")
         hmmSizer1.Add(repSizer, 1, wx.EXPAND, 5 )
 
 
@@ -186,7 +304,8 @@ class HMMMethod(base.SingleConditionMethod):
                 LOESS=False,
                 ignoreCodon=True,
                 NTerminus=0.0,
-                CTerminus=0.0, wxobj=None):
+                CTerminus=0.0, wxobj=None,
+                iterations=0):
 
         base.SingleConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldata, annotation_path, output_file, replicates=replicates, normalization=normalization, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
 
@@ -196,6 +315,7 @@ class HMMMethod(base.SingleConditionMethod):
         except:
             self.maxiterations = 100
         self.count = 1
+        self.iterations = iterations
 
 
     @classmethod
@@ -263,6 +383,7 @@ class HMMMethod(base.SingleConditionMethod):
         ignoreCodon = True
         NTerminus = float(kwargs.get("iN", 0.0))
         CTerminus = float(kwargs.get("iC", 0.0))
+        iterations = int(kwargs.get("bw", 0))
 
         return self(ctrldata,
                 annotationPath,
@@ -272,7 +393,8 @@ class HMMMethod(base.SingleConditionMethod):
                 LOESS,
                 ignoreCodon,
                 NTerminus,
-                CTerminus)
+                CTerminus,
+                iterations=iterations)
 
     def Run(self):
 
@@ -296,18 +418,27 @@ class HMMMethod(base.SingleConditionMethod):
                 data[j] = stat_tools.loess_correction(position, data[j])
 
 
-        hash = transit_tools.get_pos_hash(self.annotation_path)
+        index = tnseq_tools.get_annotation_index(self.annotation_path)
         rv2info = transit_tools.get_gene_info(self.annotation_path)
 
-        if len(self.ctrldata) > 1:
-            self.transit_message("Combining Replicates as '%s'" % self.replicates)
-        O = tnseq_tools.combine_replicates(data, method=self.replicates) + 1 # Adding 1 to because of shifted geometric in scipy
+        if self.replicates == "Product":
+            # Emissions use every replicate; the combined (mean) track is used
+            # for the heuristic starting parameters and the reported counts.
+            if len(self.ctrldata) > 1:
+                self.transit_message("Using the likelihood of each replicate (Product)")
+            O = numpy.round(data) + 1 # Adding 1 to because of shifted geometric in scipy
+            combined = tnseq_tools.combine_replicates(data, method="Mean")
+        else:
+            if len(self.ctrldata) > 1:
+                self.transit_message("Combining Replicates as '%s'" % self.replicates)
+            O = tnseq_tools.combine_replicates(data, method=self.replicates) + 1 # Adding 1 to because of shifted geometric in scipy
+            combined = O-1
 
         #Parameters
         Nstates = 4
         label = {0:"ES", 1:"GD", 2:"NE",3:"GA"}
 
-        reads = O-1
+        reads = combined
         reads_nz = sorted(reads[reads !=0 ])
         size = len(reads_nz)
         mean_r = numpy.average(reads_nz[:int(0.95 * size)])
@@ -318,8 +449,8 @@ class HMMMethod(base.SingleConditionMethod):
         for i in range(Nstates):
             B.append(scipy.stats.geom(L[i]).pmf)
 
-        pins = self.calculate_pins(O-1)
-        pins_obs = sum([1 for rd in O if rd >=2])/float(len(O))
+        pins = self.calculate_pins(reads)
+        pins_obs = sum([1 for rd in reads if rd >=1])/float(len(reads))
         pnon = 1.0 - pins
         pnon_obs = 1.0 - pins_obs
 
@@ -337,7 +468,18 @@ class HMMMethod(base.SingleConditionMethod):
         PI[0] = 0.7; PI[1:] = 0.3/(Nstates-1);
 
 
+        if self.iterations > 0:
+            self.maxiterations = len(reads)*(4 + 2*self.iterations) + 1
         self.progress_range(self.maxiterations)
+
+        ###################
+        ### BAUM-WELCH ###
+        if self.iterations > 0:
+            (A, L, PI, iterations) = self.baum_welch(numpy.exp(A), L, PI, O, self.iterations)
+            A = numpy.log(A)
+            mu = 1.0/L
+            B = [scipy.stats.geom(L[i]).pmf for i in range(Nstates)]
+        ###################
         
 
         ###############
@@ -355,11 +497,8 @@ class HMMMethod(base.SingleConditionMethod):
         beta = self.backward_procedure(numpy.exp(A), B, PI, O, C)
         #################
 
-        T = len(O); total=0; state2count = dict.fromkeys(range(Nstates),0)
-        for t in range(T):
-            state = Q_opt[t]
-            state2count[state] +=1
-            total+=1
+        T = len(reads); total = T
+        state2count = dict(enumerate(numpy.bincount(Q_opt, minlength=Nstates).tolist()))
  
             
        
@@ -383,6 +522,8 @@ class HMMMethod(base.SingleConditionMethod):
         self.output.write("# pins (obs):\t%f\n" % pins_obs)
         self.output.write("# pins (est):\t%f\n" % pins)
         self.output.write("# Run length (r):\t%d\n" % r)
+        if self.iterations > 0:
+            self.output.write("# Baum-Welch iterations:\t%d\n" % iterations)
         self.output.write("# State means:\n")
         self.output.write("#    %s\n" % "   ".join(["%s: %8.4f" % (label[i], mu[i]) for i in range(Nstates)]))
         self.output.write("# Self-Transition Prob:\n")
@@ -394,16 +535,19 @@ class HMMMethod(base.SingleConditionMethod):
          
 
         states = [int(Q_opt[t]) for t in range(T)]
+        genes_at_positions = index.genes_at_positions(position)
+        gamma = alpha * beta
+        gamma = (gamma / gamma.sum(0)).T
         last_orf = ""
         for t in range(T):
             s_lab = label.get(states[t], "Unknown State")
-            gamma_t = (alpha[:,t] * beta[:,t])/numpy.sum(alpha[:,t] * beta[:,t])
-            genes_at_site = hash.get(position[t], [""])
+            gamma_t = gamma[t]
+            genes_at_site = genes_at_positions[t] or [""]
             genestr = ""
             if not (len(genes_at_site) == 1 and not genes_at_site[0]):
                 genestr = ",".join(["%s_(%s)" % (g,rv2info.get(g, "-")[0]) for g in genes_at_site])
 
-            self.output.write("%s\t%s\t%s\t%s\t%s\n" % (int(position[t]), int(O[t])-1, "\t".join(["%-9.2e" % g for g in gamma_t]), s_lab, genestr))
+            self.output.write("%s\t%s\t%s\t%s\t%s\n" % (int(position[t]), int(reads[t]), "\t".join(["%-9.2e" % g for g in gamma_t]), s_lab, genestr))
 
         self.output.close()
 
@@ -416,8 +560,8 @@ class HMMMethod(base.SingleConditionMethod):
         self.transit_message("Creating HMM Genes Level Output")
         genes_path = ".".join(self.output.name.split(".")[:-1]) + "_genes." + self.output.name.split(".")[-1] 
 
-        tempObs = numpy.zeros((1,len(O)))
-        tempObs[0,:] = O - 1
+        tempObs = numpy.zeros((1,len(reads)))
+        tempObs[0,:] = reads
         self.post_process_genes(tempObs, position, states, genes_path)
 
 
@@ -432,111 +576,126 @@ class HMMMethod(base.SingleConditionMethod):
         return """python3 %s hmm <comma-separated .wig files> <annotation .prot_table or GFF3> <output file>
 
         Optional Arguments:
-            -r <string>     :=  How to handle replicates. Sum, Mean. Default: -r Mean
+            -r <string>     :=  How to handle replicates. Sum, Mean, Product. Product uses the likelihood of every replicate instead of combining them. Default: -r Mean
             -n <string>     :=  Normalization method. Default: -n TTR
             -l              :=  Perform LOESS Correction; Helps remove possible genomic position bias. Default: Off.
             -iN <float>     :=  Ignore TAs occuring within given percentage (as integer) of the N terminus. Default: -iN 0
             -iC <float>     :=  Ignore TAs occuring within given percentage (as integer) of the C terminus. Default: -iC 0
+            -bw <int>       :=  Maximum number of Baum-Welch iterations used to re-estimate the parameters. Default: -bw 0 (use the heuristic parameters)
         """ % (sys.argv[0])
 
 
 
-    def forward_procedure(self, A, B, PI, O):
-        T = len(O)
-        N = len(B)
-        alpha = numpy.zeros((N,  T))
-        C = numpy.zeros(T)
-
-        alpha[:,0] = PI * [B[i](O[0]) for i in range(N)]
-
-        C[0] = 1.0/numpy.sum(alpha[:,0])
-        alpha[:,0] = C[0] * alpha[:,0]
+    def log_emission_matrix(self, B, O):
+        """
+            Returns the (Nstates x T) matrix of emission log-likelihoods, log(B[i](O[t])).
+            If O is a (K x T) matrix of replicates, the (Nstates x K x T) per-replicate
+            log-likelihoods are summed over K (i.e. product of the likelihoods).
+        """
+        O = numpy.asarray(O)
+        with numpy.errstate(divide='ignore'):
+            logb = numpy.log(numpy.array([B[i](O) for i in range(len(B))], dtype=float))
+        if O.ndim > 1:
+            logb = logb.sum(1)
+        return logb
+
+    def emission_matrix(self, B, O):
+        """
+            Returns the (Nstates x T) matrix of emission probabilities, B[i](O[t]),
+            evaluating each state's distribution once over all the sites, and the
+            log of the factor they were scaled by. With replicates (O is K x T),
+            each site is rescaled by its largest likelihood to avoid underflow.
+        """
+        O = numpy.asarray(O)
+        if O.ndim == 1:
+            return (numpy.array([B[i](O) for i in range(len(B))], dtype=float), 0.0)
+
+        logb = self.log_emission_matrix(B, O)
+        shift = logb.max(0)
+        shift[~numpy.isfinite(shift)] = 0.0
+        return (numpy.exp(logb - shift), numpy.sum(shift))
 
-        for t in range(1, T):
-            #B[i](O[:,t])  =>  numpy.prod(B[i](O[:,t]))
-            #b_o = numpy.array([numpy.prod(B[i](O[:,t])) for i in range(N)])
-            b_o = [B[i](O[t]) for i in range(N)]
-        
-            alpha[:,t] = numpy.dot(alpha[:,t-1], A) * b_o
-            
-            C[t] = numpy.nan_to_num(1.0/numpy.sum(alpha[:,t]))
-            alpha[:,t] = numpy.nan_to_num(alpha[:,t] * C[t])
+    def forward_procedure(self, A, B, PI, O):
+        T = numpy.shape(O)[-1]
+        (b, log_scale) = self.emission_matrix(B, O)
+        (alpha, C) = forward_kernel(numpy.asarray(A, dtype=float), numpy.ascontiguousarray(b.T), numpy.asarray(PI, dtype=float))
 
-            if numpy.sum(alpha[:,t]) == 0:
-                alpha[:,t] = 0.0000000000001
-           
-            text = "Running HMM Method... %1.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
-            self.count+=1
-            #print(t, O[:,t], alpha[:,t])
+        self.count += T-1
+        text = "Running HMM Method... %1.1f%%" % (100.0*self.count/self.maxiterations)
+        self.progress_update(text, self.count)
 
-        log_Prob_Obs = - (numpy.sum(numpy.log(C)))
-        return(( log_Prob_Obs, alpha, C ))
+        log_Prob_Obs = - (numpy.sum(numpy.log(C))) + log_scale
+        return(( log_Prob_Obs, alpha.T, C ))
 
     def backward_procedure(self, A, B, PI, O, C=numpy.array([])):
+        T = numpy.shape(O)[-1]
+        (b, log_scale) = self.emission_matrix(B, O)
+        beta = backward_kernel(numpy.asarray(A, dtype=float), numpy.ascontiguousarray(b.T), numpy.asarray(C, dtype=float))
 
-        N = len(B)
-        T = len(O)
-        beta = numpy.zeros((N,T))
-
-        beta[:,T-1] = 1.0
-        if C.any(): beta[:,T-1] = beta[:,T-1] * C[T-1]
-
-        for t in range(T-2, -1, -1):
-            #B[i](O[:,t])  =>  numpy.prod(B[i](O[:,t]))
-            #b_o = numpy.array([numpy.prod(B[i](O[:,t])) for i in range(N)])
-            b_o = [B[i](O[t]) for i in range(N)]
-
-            beta[:,t] = numpy.nan_to_num(numpy.dot(A, (b_o * beta[:,t+1] ) ))
-
-            if sum(beta[:,t]) == 0:
-                beta[:,t] = 0.0000000000001
+        self.count += T-1
+        text = "Running HMM Method... %1.1f%%" % (100.0*self.count/self.maxiterations)
+        self.progress_update(text, self.count)
 
-            if C.any():
-                beta[:,t] = beta[:,t] * C[t]
+        return(beta.T)
 
-            text = "Running HMM Method... %1.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
-            self.count+=1
 
-        return(beta)
 
+    def viterbi(self, A, B, PI, O):
+        T = numpy.shape(O)[-1]
+        logb = self.log_emission_matrix(B, O)
 
+        with numpy.errstate(divide='ignore'):
+            logPI = numpy.log(PI)
+        (Q_opt, delta, Q) = viterbi_kernel(numpy.asarray(A, dtype=float), numpy.ascontiguousarray(logb.T), logPI)
 
-    def viterbi(self, A, B, PI, O):
-        N=len(B)
-        T = len(O)
-        delta = numpy.zeros((N, T))
-
-        b_o = [B[i](O[0]) for i in range(N)]
-        delta[:,0] = numpy.log(PI) + numpy.log(b_o)
-
-        Q = numpy.zeros((N, T), dtype=int)
-
-        numpy.seterr(divide='ignore')
-        for t in range(1, T):
-            b_o = [B[i](O[t]) for i in range(N)]
-            #nus = delta[:, t-1] + numpy.log(A)
-            nus = delta[:, t-1] + A
-            delta[:,t] = nus.max(1) + numpy.log(b_o)
-            Q[:,t] = nus.argmax(1)
-            text = "Running HMM Method... %5.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
-            self.count+=1
-
-        Q_opt = [int(numpy.argmax(delta[:,T-1]))]
-        for t in range(T-2, -1, -1):
-            Q_opt.insert(0, Q[Q_opt[0],t+1])
-
-            text = "Running HMM Method... %5.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
-            self.count+=1
-
-        numpy.seterr(divide='warn')
+        self.count += 2*(T-1)
         text = "Running HMM Method... %5.1f%%" % (100.0*self.count/self.maxiterations)
         self.progress_update(text, self.count)
 
-        return((Q_opt, delta, Q))
+        return((Q_opt.tolist(), delta.T, Q.T))
+
+
+    def baum_welch(self, A, L, PI, O, maxiter, tolerance=1e-3):
+        """
+            Re-estimates the transition matrix A, the geometric parameters L and the
+            initial distribution PI with the Baum-Welch algorithm, until the change in
+            log-likelihood falls below the tolerance or maxiter iterations are done.
+            The ES state keeps its parameter. O is T, or (K x T) for replicates.
+            Returns (A, L, PI, iterations).
+        """
+        O = numpy.asarray(O, dtype=float)
+        K = O.shape[0] if O.ndim > 1 else 1
+        Osum = O.sum(0) if O.ndim > 1 else O
+        T = len(Osum)
+        (A, L, PI) = (numpy.array(A, dtype=float), numpy.array(L, dtype=float), numpy.array(PI, dtype=float))
+
+        prev_Prob_Obs = None
+        for it in range(1, maxiter+1):
+            start = time.time()
+            B = [scipy.stats.geom(L[i]).pmf for i in range(len(L))]
+            (b, log_scale) = self.emission_matrix(B, O)
+            b = numpy.ascontiguousarray(b.T)
+            (alpha, C) = forward_kernel(A, b, PI)
+            (gamma, xi) = reestimate_kernel(A, b, alpha, C)
+            log_Prob_Obs = - (numpy.sum(numpy.log(C))) + log_scale
+
+            # M-step
+            PI = gamma[0]
+            rows = xi.sum(1)
+            A[rows > 0] = xi[rows > 0] / rows[rows > 0, None]
+            weights = gamma.sum(0)
+            totals = numpy.dot(Osum, gamma)
+            for i in range(1, len(L)):
+                if totals[i] > 0: L[i] = min(K*weights[i]/totals[i], 1.0)
+
+            self.count += 2*(T-1)
+            self.progress_update("Running HMM Method... %1.1f%%" % (100.0*self.count/self.maxiterations), self.count)
+            self.transit_message("Baum-Welch iteration %d: log-likelihood = %1.4f (%1.2fs)" % (it, log_Prob_Obs, time.time() - start))
+
+            if prev_Prob_Obs is not None and abs(log_Prob_Obs - prev_Prob_Obs) < tolerance: break
+            prev_Prob_Obs = log_Prob_Obs
+
+        return (A, L, PI, it)
 
 
     def calculate_pins(self, reads):
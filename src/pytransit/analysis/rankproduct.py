@@ -282,11 +282,8 @@ class RankProductMethod(base.DualConditionMethod):
         obsRP = numpy.power(numpy.prod(rank,0), 1.0/Kctrl)
 
 
-        permutations = numpy.zeros((self.samples, Ngenes))
-        tempranks = scipy.array([numpy.arange(1,Ngenes+1) for rep in range(Kctrl)])
-        for s in range(self.samples):
-            rankperm = numpy.array([numpy.random.permutation(tr) for tr in tempranks])
-            permutations[s] = numpy.power(numpy.prod(rankperm,0), 1.0/Kctrl)
+        # Number of permuted rank products (self.samples x Ngenes) <= each observed one
+        countsbetter = stat_tools.rank_product_null_counts(obsRP, Kctrl, self.samples)
 
         rankRP = numpy.argsort(obsRP) + 1
 
@@ -302,7 +299,7 @@ class RankProductMethod(base.DualConditionMethod):
             meanctrl = numpy.mean(Gctrl[i].reads)
             meanexp = numpy.mean(Gexp[i].reads)
             log2fc = numpy.log2((meanexp+0.0001)/(meanctrl+0.0001))
-            countbetter = numpy.sum(permutations <= obsRP[i])
+            countbetter = countsbetter[i]
             
             pval = countbetter/float(self.samples*Ngenes)
             e_val = countbetter/float(self.samples)
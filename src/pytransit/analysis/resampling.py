@@ -24,6 +24,7 @@ import numpy
 import scipy.stats
 import datetime
 import heapq
+import multiprocessing
 
 from pytransit.analysis import base
 import pytransit
@@ -199,6 +200,88 @@ class ResamplingGUI(base.AnalysisGUI):
 
 
 
+########## WORKERS #######################
+
+def winsorize_for_resampling(data):
+  # input is a 2D array of insertion counts for gene (not pre-flattened)
+  shp = data.shape
+  assert len(shp)==2, "winsorize_resampling() expected 2D numpy array"
+  counts = data.flatten().tolist()
+  if len(counts)<3: return data
+  s = sorted(counts,reverse=True)
+  if s[1]==0: return data # don't do anything if there is only 1 non-zero value
+  c2 = [s[1] if x==s[0] else x for x in counts]
+  return numpy.array(c2).reshape(shp)
+
+  # the old way of winsorizing...
+  #unique_counts = numpy.unique(counts)
+  #if (len(unique_counts) < 2): return counts
+  #else:
+  #  n, n_minus_1 = unique_counts[heapq.nlargest(2, range(len(unique_counts)), unique_counts.take)]
+  #  result = [[ n_minus_1 if count == n else count for count in wig] for wig in counts]
+  #  return numpy.array(result)
+
+def resample_gene(ctrl, exp, params):
+    """
+        Runs the resampling test for one gene and returns its row of results.
+        ctrl, exp :: (orf, name, desc, n, k, reads) for the gene in each condition
+        params :: {parameter: value} with the options of the ResamplingMethod
+    """
+    (orf, name, desc, n, k, reads) = ctrl
+    (n_exp, k_exp, reads_exp) = exp[3:]
+
+    if (k == 0 and k_exp == 0) or n == 0 or n_exp == 0:
+        (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist, data1, data2) = (0, 0, 0, 0, 1.00, 1.00, 1.00, [], [0], [0])
+    else:
+        if not params["includeZeros"]:
+            ii_ctrl = numpy.sum(reads,0) > 0
+            ii_exp = numpy.sum(reads_exp,0) > 0
+        else:
+            ii_ctrl = numpy.ones(n) == 1
+            ii_exp = numpy.ones(n_exp) == 1
+
+        #data1 = gene.reads[:,ii_ctrl].flatten() + self.pseudocount # we used to have an option to add pseudocounts to each observation, like this
+        data1 = reads[:,ii_ctrl]###.flatten() #TRI - do not flatten, as of 9/6/22
+        data2 = reads_exp[:,ii_exp]###.flatten()
+        if params["winz"]: data1 = winsorize_for_resampling(data1); data2 = winsorize_for_resampling(data2)
+
+        if params["doLibraryResampling"]:
+            (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist) =  stat_tools.resampling(data1, data2, S=params["samples"], testFunc=stat_tools.F_mean_diff_dict, permFunc=stat_tools.F_shuffle_dict_libraries, adaptive=params["adaptive"], lib_str1=params["ctrl_lib_str"], lib_str2=params["exp_lib_str"],PC=params["pseudocount"],site_restricted=params["site_restricted"])
+        else:
+            (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist) =  stat_tools.resampling(data1, data2, S=params["samples"], testFunc=stat_tools.F_mean_diff_flat, permFunc=stat_tools.F_shuffle_flat, adaptive=params["adaptive"], lib_str1=params["ctrl_lib_str"], lib_str2=params["exp_lib_str"],PC=params["pseudocount"],site_restricted=params["site_restricted"])
+
+    if params["doHistogram"]:
+        import matplotlib.pyplot as plt
+        if testlist:
+            n_bins, bins, patches = plt.hist(testlist, density=1, facecolor='c', alpha=0.75, bins=100)
+        else:
+            n_bins, bins, patches = plt.hist([0,0], density=1, facecolor='c', alpha=0.75, bins=100)
+        plt.xlabel('Delta Mean')
+        plt.ylabel('Probability')
+        plt.title('%s - Histogram of Delta Mean' % orf)
+        plt.axvline(test_obs, color='r', linestyle='dashed', linewidth=3)
+        plt.grid(True)
+        histPath = params["histPath"]
+        genePath = os.path.join(histPath, orf +".png")
+        if not os.path.exists(histPath):
+            os.makedirs(histPath, exist_ok=True)
+        plt.savefig(genePath)
+        plt.clf()
+
+    sum1 = numpy.sum(data1)
+    sum2 = numpy.sum(data2)
+    return [orf, name, desc, n, mean1, mean2, sum1, sum2, test_obs, log2FC, pval_2tail]
+
+def resample_genes(args):
+    """
+        Worker for the process pool: seeds its own random stream, then runs
+        resample_gene() on a chunk of genes.
+        args :: ([(ctrl, exp)], params, seed)
+    """
+    (genes, params, seed) = args
+    numpy.random.seed(seed)
+    return [resample_gene(ctrl, exp, params) for (ctrl, exp) in genes]
+
 ########## CLASS #######################
 
 class ResamplingMethod(base.DualConditionMethod):
@@ -226,6 +309,7 @@ class ResamplingMethod(base.DualConditionMethod):
                 exp_lib_str="",
                 winz = False,
                 site_restricted = False,
+                cpus = 1,
                 wxobj=None, Z = False, diffStrains = False, annotation_path_exp = "", combinedWigParams = None):
 
         base.DualConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldata, expdata, annotation_path, output_file, normalization=normalization, replicates=replicates, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
@@ -243,6 +327,7 @@ class ResamplingMethod(base.DualConditionMethod):
         self.combinedWigParams = combinedWigParams
         self.winz = winz
         self.site_restricted = site_restricted
+        self.cpus = cpus
         self.transit_message("site_restricted=%s" % site_restricted)
 
     @classmethod
@@ -374,7 +459,7 @@ class ResamplingMethod(base.DualConditionMethod):
         output_file = open(output_path, "w")
 
         # check for unrecognized flags
-        flags = "-c -s -n -h -a -ez -PC -l -iN -iC --ctrl_lib --exp_lib -Z -winz -sr".split()
+        flags = "-c -s -n -h -a -ez -PC -l -iN -iC --ctrl_lib --exp_lib -Z -winz -sr -cpus".split()
         for arg in rawargs:
           if arg[0]=='-' and arg not in flags:
             self.transit_error("flag unrecognized: %s" % arg)
@@ -389,6 +474,7 @@ class ResamplingMethod(base.DualConditionMethod):
         excludeZeros = kwargs.get("ez", False)
         includeZeros = not excludeZeros
         site_restricted = kwargs.get("sr", False)
+        cpus = int(kwargs.get("cpus", 1))
         pseudocount = float(kwargs.get("PC", 1.0)) # use -PC (new semantics: for LFCs) instead of -pc (old semantics: fake counts)
 
         Z = True if "Z" in kwargs else False
@@ -420,6 +506,7 @@ class ResamplingMethod(base.DualConditionMethod):
                 exp_lib_str, 
                 winz = winz,
                 site_restricted = site_restricted,
+                cpus = cpus,
                 Z = Z, diffStrains = diffStrains, annotation_path_exp = annotationPathExp, combinedWigParams = combinedWigParams)
 
     def preprocess_data(self, position, data):
@@ -591,23 +678,7 @@ class ResamplingMethod(base.DualConditionMethod):
         self.transit_message("Time: %0.2fs" % (time.time() - start_time)) # maybe append time elapsed to the "Finished Resampling" message?
 
     def winsorize_for_resampling(self, data):
-      # input is a 2D array of insertion counts for gene (not pre-flattened)
-      shp = data.shape
-      assert len(shp)==2, "winsorize_resampling() expected 2D numpy array"
-      counts = data.flatten().tolist()
-      if len(counts)<3: return data
-      s = sorted(counts,reverse=True)
-      if s[1]==0: return data # don't do anything if there is only 1 non-zero value
-      c2 = [s[1] if x==s[0] else x for x in counts]
-      return numpy.array(c2).reshape(shp)
-
-      # the old way of winsorizing...
-      #unique_counts = numpy.unique(counts)
-      #if (len(unique_counts) < 2): return counts
-      #else:
-      #  n, n_minus_1 = unique_counts[heapq.nlargest(2, range(len(unique_counts)), unique_counts.take)]
-      #  result = [[ n_minus_1 if count == n else count for count in wig] for wig in counts]
-      #  return numpy.array(result)
+      return winsorize_for_resampling(data)
 
     def run_resampling(self, G_ctrl, G_exp = None, doLibraryResampling = False, histPath = ""):
         data = []
@@ -615,6 +686,7 @@ class ResamplingMethod(base.DualConditionMethod):
         count = 0
         self.progress_range(N)
 
+        genes = []
         for gene in G_ctrl:
             if gene.orf not in G_exp:
                 if self.diffStrains:
@@ -625,59 +697,45 @@ class ResamplingMethod(base.DualConditionMethod):
                     return ([], [])
 
             gene_exp = G_exp[gene.orf]
-            count+=1
 
             if not self.diffStrains and gene.n != gene_exp.n:
                 self.transit_error("Error: No. of TA sites in Exp and Ctrl data are different")
                 self.transit_error("Make sure all .wig files come from the same strain.")
                 return ([], [])
 
-            if (gene.k == 0 and gene_exp.k == 0) or gene.n == 0 or gene_exp.n == 0:
-                (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist, data1, data2) = (0, 0, 0, 0, 1.00, 1.00, 1.00, [], [0], [0])
-            else:
-                if not self.includeZeros:
-                    ii_ctrl = numpy.sum(gene.reads,0) > 0
-                    ii_exp = numpy.sum(gene_exp.reads,0) > 0
-                else:
-                    ii_ctrl = numpy.ones(gene.n) == 1
-                    ii_exp = numpy.ones(gene_exp.n) == 1
-
-                #data1 = gene.reads[:,ii_ctrl].flatten() + self.pseudocount # we used to have an option to add pseudocounts to each observation, like this
-                data1 = gene.reads[:,ii_ctrl]###.flatten() #TRI - do not flatten, as of 9/6/22
-                data2 = gene_exp.reads[:,ii_exp]###.flatten()
-                if self.winz: data1 = self.winsorize_for_resampling(data1); data2 = self.winsorize_for_resampling(data2)
-
-                if doLibraryResampling:
-                    (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist) =  stat_tools.resampling(data1, data2, S=self.samples, testFunc=stat_tools.F_mean_diff_dict, permFunc=stat_tools.F_shuffle_dict_libraries, adaptive=self.adaptive, lib_str1=self.ctrl_lib_str, lib_str2=self.exp_lib_str,PC=self.pseudocount,site_restricted=self.site_restricted)
-                else:
-                    (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist) =  stat_tools.resampling(data1, data2, S=self.samples, testFunc=stat_tools.F_mean_diff_flat, permFunc=stat_tools.F_shuffle_flat, adaptive=self.adaptive, lib_str1=self.ctrl_lib_str, lib_str2=self.exp_lib_str,PC=self.pseudocount,site_restricted=self.site_restricted)
-
-
-            if self.doHistogram:
-                import matplotlib.pyplot as plt
-                if testlist:
-                    n, bins, patches = plt.hist(testlist, density=1, facecolor='c', alpha=0.75, bins=100)
-                else:
-                    n, bins, patches = plt.hist([0,0], density=1, facecolor='c', alpha=0.75, bins=100)
-                plt.xlabel('Delta Mean')
-                plt.ylabel('Probability')
-                plt.title('%s - Histogram of Delta Mean' % gene.orf)
-                plt.axvline(test_obs, color='r', linestyle='dashed', linewidth=3)
-                plt.grid(True)
-                genePath = os.path.join(histPath, gene.orf +".png")
-                if not os.path.exists(histPath):
-                    os.makedirs(histPath)
-                plt.savefig(genePath)
-                plt.clf()
-
-
-            sum1 = numpy.sum(data1)
-            sum2 = numpy.sum(data2)
-            data.append([gene.orf, gene.name, gene.desc, gene.n, mean1, mean2, sum1, sum2, test_obs, log2FC, pval_2tail])
+            genes.append(((gene.orf, gene.name, gene.desc, gene.n, gene.k, gene.reads), (gene_exp.orf, gene_exp.name, gene_exp.desc, gene_exp.n, gene_exp.k, gene_exp.reads)))
+
+        params = {"samples": self.samples, "adaptive": self.adaptive, "includeZeros": self.includeZeros,
+                "winz": self.winz, "pseudocount": self.pseudocount, "site_restricted": self.site_restricted,
+                "ctrl_lib_str": self.ctrl_lib_str, "exp_lib_str": self.exp_lib_str,
+                "doLibraryResampling": doLibraryResampling, "doHistogram": self.doHistogram, "histPath": histPath}
+
+        if self.cpus > 1:
+            # Genes are split into fixed-size chunks, each with its own seed drawn
+            # from the global random state, so results do not depend on scheduling.
+            chunksize = 20
+            chunks = [genes[i:i+chunksize] for i in range(0, len(genes), chunksize)]
+            seeds = numpy.random.randint(0, 2**31-1, size=len(chunks))
+            pool = multiprocessing.Pool(self.cpus)
+            try:
+                for rows in pool.imap(resample_genes, [(chunk, params, seed) for (chunk, seed) in zip(chunks, seeds)]):
+                    data.extend(rows)
+                    count += len(rows)
+                    # Update progress
+                    text = "Running Resampling Method... %5.1f%%" % (100.0*count/N)
+                    self.progress_update(text, count)
+                pool.close()
+                pool.join()
+            finally:
+                pool.terminate()
+        else:
+            for (ctrl, exp) in genes:
+                data.append(resample_gene(ctrl, exp, params))
+                count+=1
 
-            # Update progress
-            text = "Running Resampling Method... %5.1f%%" % (100.0*count/N)
-            self.progress_update(text, count)
+                # Update progress
+                text = "Running Resampling Method... %5.1f%%" % (100.0*count/N)
+                self.progress_update(text, count)
 
 
         #
@@ -720,6 +778,7 @@ class ResamplingMethod(base.DualConditionMethod):
         -winz           :=  winsorize insertion counts for each gene in each condition 
                             (replace max cnt in each gene with 2nd highest; helps mitigate effect of outliers)
         -sr             :=  site-restricted resampling; more sensitive, might find a few more significant conditionally essential genes"
+        -cpus <int>     :=  Number of processes used to resample genes in parallel. Default: -cpus 1
         """ % (sys.argv[0], sys.argv[0])
 
         # for docs:
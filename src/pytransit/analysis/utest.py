@@ -291,40 +291,33 @@ class UTestMethod(base.DualConditionMethod):
         G = tnseq_tools.Genes(self.ctrldata + self.expdata, self.annotation_path, ignoreCodon=self.ignoreCodon, nterm=self.NTerminus, cterm=self.CTerminus, data=data, position=position)
 
 
-        #u-test
-        data = []
+        #u-test, for all genes at once
         N = len(G)
+        owner = numpy.repeat(numpy.arange(N), numpy.diff(G.gene_offsets))
+        sites = G.site_index
+        if not self.includeZeros:
+            ii = numpy.sum(G.data[:, sites], 0) > 0
+            (owner, sites) = (owner[ii], sites[ii])
+        values = G.data[:, sites].flatten()
+        first = numpy.repeat(numpy.arange(K) < Kctrl, len(sites))
+        owners = numpy.tile(owner, K)
+        (U, pvals) = stat_tools.mannwhitneyu_segments(values, first, owners, N)
+
+        n1 = numpy.bincount(owner, minlength=N)*Kctrl
+        n2 = numpy.bincount(owner, minlength=N)*Kexp
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            means1 = numpy.where(n1 > 0, numpy.bincount(owners, weights=values*first, minlength=N)/n1, 0)
+            means2 = numpy.where(n2 > 0, numpy.bincount(owners, weights=values*~first, minlength=N)/n2, 0)
+
+        data = []
         count = 0
         self.progress_range(N)
-        for gene in G:
+        for i,gene in enumerate(G):
             count+=1
             if gene.k == 0 or gene.n == 0:
                 (test_obs, mean1, mean2, log2FC, u_stat, pval_2tail) = (0, 0, 0, 0, 0.0, 1.00)
             else:
-
-                if not self.includeZeros:
-                    ii = numpy.sum(gene.reads,0) > 0
-                else:
-                    ii = numpy.ones(gene.n) == 1
-
-
-                data1 = gene.reads[:Kctrl,ii].flatten()
-                data2 = gene.reads[Kctrl:,ii].flatten()
-                try:
-                    u_stat, pval_2tail = scipy.stats.mannwhitneyu(data1, data2,
-                        alternative="two-sided")
-                except ValueError as e:
-                    u_stat, pval_2tail = 0.0, 1.00
-
-                n1 = len(data1)
-                n2 = len(data2)
-
-                mean1 = 0
-                if n1 > 0:
-                    mean1 = numpy.mean(data1)
-                mean2 = 0
-                if n2 > 0:
-                    mean2 = numpy.mean(data2)
+                (mean1, mean2, u_stat, pval_2tail) = (means1[i], means2[i], U[i], pvals[i])
 
                 try:
                     # Only adjust log2FC if one of the means is zero
@@ -1,4 +1,7 @@
 import scipy
+import scipy.optimize
+import scipy.special
+import scipy.stats
 import numpy
 import heapq
 import statsmodels.stats.multitest
@@ -7,6 +10,7 @@ import time
 import sys
 import collections
 import functools
+import multiprocessing
 
 hasR = False
 try:
@@ -34,10 +38,380 @@ EOL = "\n"
 DEBUG = False
 GENE = None
 SEPARATOR = '\1' # for making names that combine conditions and interactions; try not to use a char a user might have in a condition name
+BATCH_SIZE = 10 # genes sent to a worker process at a time, with -cpus
 
 transposons = ["", ""]
 columns = []
 
+########## WORKERS #######################
+
+R_ZINB_SIGNIF = """
+zinb_signif = function(
+    df,
+    zinbMod1,
+    zinbMod0,
+    nbMod1,
+    nbMod0,
+    DEBUG = F
+) {
+  print("Starting ZINB in R")
+  suppressMessages(require(pscl))
+  suppressMessages(require(MASS))
+  melted = df
+  #print(head(melted))
+
+  # filter out genes that have low saturation across all conditions, since pscl sometimes does not fit params well (resulting in large negative intercepts and high std errors)
+  NZpercs = aggregate(melted$cnt,by=list(melted$cond),FUN=function(x) { sum(x>0)/length(x) })
+  if (max(NZpercs$x)<0.15) { return(c(pval=1,status="low saturation (<15%) across all conditions (pan-growth-defect) - not analyzed")) }
+
+  sums = aggregate(melted$cnt,by=list(melted$cond),FUN=sum)
+  # to avoid model failing due to singular condition, add fake counts of 1 to all conds if any cond is all 0s
+  if (0 %in% sums[,2]) {
+    # print("adding pseudocounts")
+    for (i in 1:length(sums[,1])) {
+      subset = melted[melted$cond==sums[i,1],]
+      newvec = subset[1,]
+      newvec$cnt = 1 # note: non_zero_mean and NZperc are copied from last dataset in condition
+      #newvec$cnt = as.integer(mean(subset$cnt))+1 # add the mean for each condition as a pseudocount
+      melted = rbind(melted,newvec) }
+  }
+  status = "-"
+  minCount = min(melted$cnt)
+  f1 = ""
+  mod1 = tryCatch(
+    {
+      if (minCount == 0) {
+        f1 = zinbMod1
+        mod = zeroinfl(as.formula(zinbMod1),data=melted,dist="negbin")
+        coeffs = summary(mod)$coefficients
+        # [,1] is col of parms, [,2] is col of stderrs, assume Intercept is always first
+        #if (coeffs$count[,2][1]>0.5) { status = 'warning: high stderr on Intercept for mod1' }
+        mod
+      } else {
+        f1 = nbMod1
+        glm.nb(as.formula(nbMod1),data=melted)
+      }
+    },
+    error=function(err) {
+      status <<- err$message
+      return(NULL)
+    })
+  f0 = ""
+  mod0 = tryCatch( # null model, independent of conditions
+    {
+      if (minCount == 0) {
+        f0 = zinbMod0
+        mod = zeroinfl(as.formula(zinbMod0),data=melted,dist="negbin")
+        coeffs = summary(mod)$coefficients
+        # [,1] is col of parms, [,2] is col of stderrs, assume Intercept is always first
+        #if (coeffs$count[,2][1]>0.5) { status = 'warning: high stderr on Intercept for mod0' }
+        mod
+      } else {
+        f0 = nbMod0
+        glm.nb(as.formula(nbMod0),data=melted)
+      }
+    },
+    error=function(err) {
+      status <<- err$message
+      return(NULL)
+    })
+  if (DEBUG) {
+      print("Model 1:")
+      print(f1)
+      print(summary(mod1))
+      print("Model 0:")
+      print(f0)
+      print(summary(mod0))
+  }
+
+  if (is.null(mod1) | is.null(mod0)) { return (c(1, paste0("Model Error. ", status))) }
+  if ((minCount == 0) && (sum(is.na(coef(summary(mod1))$count[,4]))>0)) { return(c(1, "Has Coefs, but Pvals are NAs (model failure)")) } # rare failure mode - has coefs, but pvals are NA
+  df1 = attr(logLik(mod1),"df"); df0 = attr(logLik(mod0),"df") # should be (2*ngroups+1)-3
+  if (DEBUG) print(sprintf("delta_log_likelihood=%f",logLik(mod1)-logLik(mod0)))
+  pval = pchisq(2*(logLik(mod1)-logLik(mod0)),df=df1-df0,lower.tail=F) # alternatively, could use lrtest()
+  # this gives same answer, but I would need to extract the Pvalue...
+  #require(lmtest)
+  #print(lrtest(mod1,mod0))
+  print("Finished ZINB in R")
+  return (c(pval, status))
+}
+"""
+
+def define_r_zinb_signif():
+    """Defines zinb_signif in the embedded R session, with pscl and MASS loaded, and returns it."""
+    r("suppressMessages(require(pscl)); suppressMessages(require(MASS))")
+    r(R_ZINB_SIGNIF)
+    return globalenv['zinb_signif']
+
+def is_number(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+def melt_data(readCountsForRv, conditions, covariates, interactions, NZMeanByRep, LogZPercByRep):
+    rvSitesLength = len(readCountsForRv[0])
+    repeatAndFlatten = lambda xs: numpy.repeat(xs, rvSitesLength)
+
+    return [
+            numpy.concatenate(readCountsForRv).astype(int),
+            repeatAndFlatten(conditions),
+            list(map(repeatAndFlatten, covariates)),
+            list(map(repeatAndFlatten, interactions)),
+            repeatAndFlatten(NZMeanByRep),
+            repeatAndFlatten(LogZPercByRep)
+           ]
+
+# State of the R session in this process, set by init_zinb_worker
+zinb_worker = {}
+
+def init_zinb_worker(engine, models, covarNames, interactionNames, conditions, covariates, interactions, NZMeanByRep, LogZPercByRep):
+    """
+        Prepares this process for fit_zinb_gene: defines zinb_signif in its
+        R session once (or builds the design matrices for the python engine),
+        and keeps the model formulas and the per-sample data shared by all genes.
+    """
+    zinb_worker["engine"] = engine
+    if engine == "python":
+        init_python_engine(models, covarNames, interactionNames, conditions, covariates, interactions, NZMeanByRep, LogZPercByRep)
+    else:
+        zinb_worker["r_zinb_signif"] = define_r_zinb_signif()
+    zinb_worker["models"] = models
+    zinb_worker["names"] = (covarNames, interactionNames)
+    zinb_worker["samples"] = (conditions, covariates, interactions, NZMeanByRep, LogZPercByRep)
+
+def fit_zinb_gene(readCountsForRv):
+    """
+        Compares the ZINB (or NB) models with and without condition for one gene
+        ([Wigdata]) -> Tuple(Number, Status)
+        Wigdata :: [Number] (counts at the TA sites of the gene)
+    """
+    if zinb_worker["engine"] == "python":
+        return python_zinb_signif(readCountsForRv)
+
+    (covarNames, interactionNames) = zinb_worker["names"]
+    ([readCounts, condition, covarsData, interactionsData, NZmean, logitZPerc]) = melt_data(readCountsForRv, *zinb_worker["samples"])
+    toRFloatOrStrVec = lambda xs: FloatVector([float(x) for x in xs]) if is_number(xs[0]) else StrVector(xs)
+    df_args = {
+        'cnt': IntVector(readCounts),
+        'cond': toRFloatOrStrVec(condition),
+        'NZmean': FloatVector(NZmean),
+        'logitZperc': FloatVector(logitZPerc)
+        }
+    ## Add columns for covariates and interactions if they exist.
+    df_args.update(list(map(lambda t_ic: (t_ic[1], toRFloatOrStrVec(covarsData[t_ic[0]])), enumerate(covarNames))))
+    df_args.update(list(map(lambda t_ic: (t_ic[1], toRFloatOrStrVec(interactionsData[t_ic[0]])), enumerate(interactionNames))))
+
+    melted = DataFrame(df_args)
+    pval, msg = zinb_worker["r_zinb_signif"](melted, *zinb_worker["models"])
+    return (float(pval), msg)
+
+def fit_zinb_genes(batch):
+    # Fits a batch of genes [(index, counts)] in a worker process
+    return [(i, fit_zinb_gene(readCountsForRv)) for (i, readCountsForRv) in batch]
+
+########## PYTHON ENGINE #################
+
+def zinb_loglik(params, y, w, X, offset, Z=None, zoffset=None, gradient=False):
+    """
+        Log-likelihood of negative binomial regression (or zero-inflated, if Z is
+        given) for each row of params, with the counts y weighted by w.
+
+        Each row of params holds the coefficients of the count model (for X,
+        with log link and the given offset), of the zero-inflation model (for Z,
+        with logit link and zoffset) and log(theta). Returns the log-likelihoods
+        and, if gradient is True, their gradients (one row per row of params).
+    """
+    params = numpy.atleast_2d(params)
+    (p, q) = (X.shape[1], 0 if Z is None else Z.shape[1])
+    (B, G) = (params[:, :p], params[:, p:p+q])
+    phi = numpy.clip(params[:, -1], -30, 30)[None, :]
+    theta = numpy.exp(phi)
+    Y = y[:, None]
+
+    eta = numpy.clip(numpy.dot(X, B.T) + offset[:, None], -700, 700)
+    mu = numpy.exp(eta)
+    log_theta_mu = numpy.logaddexp(phi, eta)
+    logf = (scipy.special.gammaln(Y + theta) - scipy.special.gammaln(theta) - scipy.special.gammaln(Y + 1) +
+            theta*(phi - log_theta_mu) + Y*(eta - log_theta_mu))
+
+    if Z is None:
+        (ll, nb_weight) = (logf, 1.0)
+    else:
+        zeta = numpy.dot(Z, G.T) + zoffset[:, None]
+        log_pi = -numpy.logaddexp(0, -zeta)
+        log_1mpi = -numpy.logaddexp(0, zeta)
+        zero = Y == 0
+        ll0 = numpy.logaddexp(log_pi, log_1mpi + logf)
+        ll = numpy.where(zero, ll0, log_1mpi + logf)
+        # Probability that an observed count comes from the NB component
+        nb_weight = numpy.where(zero, numpy.exp(log_1mpi + logf - ll0), 1.0)
+
+    loglik = numpy.dot(w, ll)
+    if not gradient: return loglik
+
+    d_eta = nb_weight * theta*(Y - mu)/(theta + mu)
+    d_phi = nb_weight * theta*(scipy.special.digamma(Y + theta) - scipy.special.digamma(theta) +
+            phi - log_theta_mu + 1 - (theta + Y)/(theta + mu))
+    grads = [numpy.dot((w[:, None]*d_eta).T, X)]
+    if Z is not None:
+        pi = numpy.exp(log_pi)
+        d_zeta = numpy.where(zero, (1 - nb_weight) - pi, -pi)
+        grads.append(numpy.dot((w[:, None]*d_zeta).T, Z))
+    grads.append(numpy.dot(w, d_phi)[:, None])
+    return (loglik, numpy.hstack(grads))
+
+def zinb_cold_start(y, w, X, offset, nparams):
+    # Count coefficients from least squares on the log of the positive counts; no zero inflation, theta=1
+    params = numpy.zeros(nparams)
+    pos = y > 0
+    if numpy.any(pos):
+        sw = numpy.sqrt(w[pos])
+        params[:X.shape[1]] = numpy.linalg.lstsq(X[pos]*sw[:, None], (numpy.log(y[pos]) - offset[pos])*sw, rcond=None)[0]
+    return params
+
+def fit_zinb_model(model, y, w, X, offset, Z=None, zoffset=None, starts=[]):
+    """
+        Maximum likelihood fit of the model (see zinb_loglik), with BFGS.
+
+        The optimization runs from the best of the given starting values (the
+        nested model's solution, say), evaluated in one batch, and from a crude
+        initial estimate, keeping the better optimum: a warm start alone can
+        leave zero-inflation coefficients stranded where the likelihood is flat.
+        The solution of the same model for the previous gene fitted in this
+        process is only tried when both fits fail, so that p-values do not
+        depend on the order in which genes are fitted (or on -cpus).
+
+        Returns:
+            Tuple(params, loglik)
+    """
+    nparams = X.shape[1] + (0 if Z is None else Z.shape[1]) + 1
+    previous = zinb_worker.setdefault("previous", {}).get(model)
+
+    def negloglik(params):
+        (ll, grad) = zinb_loglik(params, y, w, X, offset, Z, zoffset, gradient=True)
+        return (-ll[0], -grad[0])
+
+    def minimize(candidates):
+        with numpy.errstate(all="ignore"):
+            ll = zinb_loglik(numpy.array(candidates), y, w, X, offset, Z, zoffset)
+            if not numpy.any(numpy.isfinite(ll)): return None
+            x0 = candidates[int(numpy.argmax(numpy.where(numpy.isfinite(ll), ll, -numpy.inf)))]
+            fit = scipy.optimize.minimize(negloglik, x0, jac=True, method="BFGS")
+        return fit if numpy.isfinite(fit.fun) else None
+
+    fits = [minimize([zinb_cold_start(y, w, X, offset, nparams)])]
+    if starts: fits.append(minimize(starts))
+    if not any(fit is not None and fit.success for fit in fits) and previous is not None and len(previous) == nparams:
+        fits.append(minimize([previous]))
+    fits = [fit for fit in fits if fit is not None]
+    if not fits: raise ValueError("non-finite log-likelihood")
+    fit = min(fits, key=lambda fit: fit.fun)
+    zinb_worker["previous"][model] = fit.x
+    return (fit.x, -fit.fun)
+
+def zinb_standard_errors(params, y, w, X, offset, Z=None, zoffset=None, h=1e-5):
+    # Standard errors from the inverse of the numerical Hessian, as in summary() of the R fits (NaN where undefined)
+    nparams = len(params)
+    steps = numpy.eye(nparams)*h
+    with numpy.errstate(all="ignore"):
+        grads = zinb_loglik(numpy.vstack([params + steps, params - steps]), y, w, X, offset, Z, zoffset, gradient=True)[1]
+        H = (grads[:nparams] - grads[nparams:])/(2*h)
+        vcov = numpy.linalg.inv(-(H + H.T)/2)
+        return numpy.sqrt(numpy.diag(vcov))
+
+def embed_params(params, names, subnames):
+    # Places the coefficients of a nested model (columns subnames) among the columns names; other coefficients are 0
+    if not set(subnames) <= set(names): return None
+    embedded = numpy.zeros(len(names))
+    for (name, value) in zip(subnames, params): embedded[names.index(name)] = value
+    return embedded
+
+def init_python_engine(models, covarNames, interactionNames, conditions, covariates, interactions, NZMeanByRep, LogZPercByRep):
+    """
+        Builds the design matrices of the models, with one row per sample. As
+        for the R data.frame, numeric columns are used as numbers and other
+        columns as factors.
+    """
+    import pandas, patsy # only needed for -engine python
+    (comp1a, comp1b, comp0a, comp0b, debugFlag) = models
+    columns = {}
+    for (name, values) in [("cond", conditions)] + list(zip(covarNames, covariates)) + list(zip(interactionNames, interactions)):
+        columns[name] = numpy.array([float(x) for x in values]) if is_number(values[0]) else numpy.array(values, dtype=str)
+    designs = {}
+    for (part, rhs) in [("count1", comp1a), ("zero1", comp1b), ("count0", comp0a), ("zero0", comp0b)]:
+        D = patsy.dmatrix(rhs, pandas.DataFrame(columns))
+        designs[part] = (numpy.asarray(D), D.design_info.column_names)
+    (condNames, condIndex) = numpy.unique(numpy.asarray(conditions, dtype=str), return_inverse=True)
+    zinb_worker["designs"] = designs
+    zinb_worker["condIndex"] = condIndex
+    zinb_worker["firstSample"] = numpy.array([list(condIndex).index(c) for c in range(len(condNames))])
+    zinb_worker["offsets"] = (numpy.log(NZMeanByRep), numpy.asarray(LogZPercByRep, dtype=float))
+    zinb_worker["previous"] = {}
+
+def python_zinb_signif(readCountsForRv):
+    """
+        Same test as zinb_signif in R_ZINB_SIGNIF, with the likelihoods
+        computed in python: compares the ZINB models (or NB models, if there
+        are no zeros) with and without condition with a likelihood-ratio test.
+        ([Wigdata]) -> Tuple(Number, Status)
+    """
+    (zinbMod1, zinbMod0, nbMod1, nbMod0, debugFlag) = zinb_worker["models"]
+    designs = zinb_worker["designs"]
+    condIndex = zinb_worker["condIndex"]
+    ncond = len(zinb_worker["firstSample"])
+    readCountsForRv = numpy.asarray(readCountsForRv)
+    sample = numpy.repeat(numpy.arange(len(readCountsForRv)), len(readCountsForRv[0]))
+    cnt = numpy.concatenate(readCountsForRv).astype(int)
+
+    # filter out genes that have low saturation across all conditions
+    NZpercs = numpy.bincount(condIndex[sample], weights=cnt > 0, minlength=ncond)/numpy.bincount(condIndex[sample], minlength=ncond)
+    if NZpercs.max() < 0.15: return (1.0, "low saturation (<15%) across all conditions (pan-growth-defect) - not analyzed")
+
+    # to avoid model failing due to singular condition, add counts of 1 to all conds if any cond is all 0s
+    sums = numpy.bincount(condIndex[sample], weights=cnt, minlength=ncond)
+    if numpy.any(sums == 0):
+        sample = numpy.concatenate([sample, zinb_worker["firstSample"]])
+        cnt = numpy.concatenate([cnt, numpy.ones(ncond, dtype=int)])
+
+    # Rows with the same sample and count add the same term to the likelihood
+    m = cnt.max() + 1
+    (key, w) = numpy.unique(sample*m + cnt, return_counts=True)
+    (sample, y, w) = (key // m, key % m, w.astype(float))
+
+    zinb = y.min() == 0
+    (X1, names1), (X0, names0) = designs["count1"], designs["count0"]
+    if zinb:
+        (Z1, znames1), (Z0, znames0) = designs["zero1"], designs["zero0"]
+        (Z1, Z0) = (Z1[sample], Z0[sample])
+        (offset, zoffset) = (zinb_worker["offsets"][0][sample], zinb_worker["offsets"][1][sample])
+    else:
+        (Z1, Z0, znames1, znames0) = (None, None, [], [])
+        (offset, zoffset) = (numpy.zeros(len(y)), None)
+    (X1, X0) = (X1[sample], X0[sample])
+
+    try:
+        (params0, ll0) = fit_zinb_model(("zinb" if zinb else "nb", 0), y, w, X0, offset, Z0, zoffset)
+        # Starting the full model at the null solution ensures ll1 >= ll0
+        starts = []
+        embedded = embed_params(params0[:-1], names1 + ["zero:" + x for x in znames1], names0 + ["zero:" + x for x in znames0])
+        if embedded is not None: starts.append(numpy.append(embedded, params0[-1]))
+        (params1, ll1) = fit_zinb_model(("zinb" if zinb else "nb", 1), y, w, X1, offset, Z1, zoffset, starts)
+        if zinb: stderrs = zinb_standard_errors(params1, y, w, X1, offset, Z1, zoffset)
+    except (ValueError, numpy.linalg.LinAlgError) as e:
+        return (1.0, "Model Error. %s" % e)
+
+    if debugFlag:
+        print("Model 1:", (zinbMod1 if zinb else nbMod1), "logLik = %f" % ll1)
+        print(dict(zip(names1 + ["zero:" + x for x in znames1] + ["log(theta)"], params1)))
+        print("Model 0:", (zinbMod0 if zinb else nbMod0), "logLik = %f" % ll0)
+        print(dict(zip(names0 + ["zero:" + x for x in znames0] + ["log(theta)"], params0)))
+
+    if zinb and not numpy.all(numpy.isfinite(stderrs[:len(names1)])): return (1.0, "Has Coefs, but Pvals are NAs (model failure)")
+    pval = scipy.stats.chi2.sf(2*(ll1 - ll0), len(params1) - len(params0))
+    return (float(pval), "-")
+
 class ZinbAnalysis(base.TransitAnalysis):
     def __init__(self):
         base.TransitAnalysis.__init__(self, short_name, long_name, short_desc, long_desc, transposons, ZinbMethod)
@@ -48,7 +422,7 @@ class ZinbMethod(base.MultiConditionMethod):
     """
     Zinb
     """
-    def __init__(self, combined_wig, metadata, annotation, normalization, output_file, excluded_conditions=[], included_conditions=[], winz=False, nterm=5.0, cterm=5.0, condition="Condition", covars=[], interactions = [], PC=1, refs=[],prot_table=None):
+    def __init__(self, combined_wig, metadata, annotation, normalization, output_file, excluded_conditions=[], included_conditions=[], winz=False, nterm=5.0, cterm=5.0, condition="Condition", covars=[], interactions = [], PC=1, refs=[],prot_table=None, cpus=1, engine="R"):
         base.MultiConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, combined_wig, metadata, annotation, output_file,
                 normalization=normalization, excluded_conditions=excluded_conditions, included_conditions=included_conditions, nterm=nterm, cterm=cterm)
         self.winz = winz
@@ -57,6 +431,8 @@ class ZinbMethod(base.MultiConditionMethod):
         self.condition = condition
         self.PC = PC
         self.refs = refs
+        self.cpus = cpus
+        self.engine = engine
 
         if prot_table==None: self.prot_table = None
         else:
@@ -71,13 +447,17 @@ class ZinbMethod(base.MultiConditionMethod):
 
     @classmethod
     def fromargs(self, rawargs):
-        if not hasR:
-            print("Error: R and rpy2 (~= 3.0) required to run ZINB analysis.")
+        (args, kwargs) = transit_tools.cleanargs(rawargs)
+
+        engine = kwargs.get("engine", "R")
+        if engine not in ["R", "python"]:
+            self.transit_error("engine must be R or python: %s" % engine)
+            sys.exit(0)
+        if engine == "R" and not hasR:
+            print("Error: R and rpy2 (~= 3.0) required to run ZINB analysis (or use -engine python).")
             print("After installing R, you can install rpy2 using the command \"pip install 'rpy2~=3.0'\"")
             sys.exit(0)
 
-        (args, kwargs) = transit_tools.cleanargs(rawargs)
-
         if (kwargs.get('-help', False) or kwargs.get('h', False)):
             print(ZinbMethod.usage_string())
             sys.exit(0)
@@ -107,16 +487,17 @@ class ZinbMethod(base.MultiConditionMethod):
         excluded_conditions = list(filter(None, kwargs.get("-exclude-conditions", "").split(",")))
         included_conditions = list(filter(None, kwargs.get("-include-conditions", "").split(",")))
         prot_table = kwargs.get("-prot_table",None)
+        cpus = int(kwargs.get("cpus", 1))
 
         # check for unrecognized flags
-        flags = "-n --exclude-conditions --include-conditions -iN -iC -PC --condition --covars --interactions --gene --ref --prot_table -winz".split()
+        flags = "-n --exclude-conditions --include-conditions -iN -iC -PC --condition --covars --interactions --gene --ref --prot_table -winz -cpus -engine".split()
         for arg in rawargs:
           if arg[0]=='-' and arg not in flags:
             self.transit_error("flag unrecognized: %s" % arg)
             print(ZinbMethod.usage_string())
             sys.exit(0)
 
-        return self(combined_wig, metadata, annotation, normalization, output_file, excluded_conditions, included_conditions, winz, NTerminus, CTerminus, condition, covars, interactions, PC, refs,prot_table=prot_table)
+        return self(combined_wig, metadata, annotation, normalization, output_file, excluded_conditions, included_conditions, winz, NTerminus, CTerminus, condition, covars, interactions, PC, refs,prot_table=prot_table,cpus=cpus,engine=engine)
 
     def wigs_to_conditions(self, conditionsByFile, filenamesInCombWig):
         """
@@ -254,112 +635,10 @@ class ZinbMethod(base.MultiConditionMethod):
         return [numpy.array(v).flatten() for v in countsByCondition.values()]
 
     def melt_data(self, readCountsForRv, conditions, covariates, interactions, NZMeanByRep, LogZPercByRep):
-        rvSitesLength = len(readCountsForRv[0])
-        repeatAndFlatten = lambda xs: numpy.repeat(xs, rvSitesLength)
-
-        return [
-                numpy.concatenate(readCountsForRv).astype(int),
-                repeatAndFlatten(conditions),
-                list(map(repeatAndFlatten, covariates)),
-                list(map(repeatAndFlatten, interactions)),
-                repeatAndFlatten(NZMeanByRep),
-                repeatAndFlatten(LogZPercByRep)
-               ]
+        return melt_data(readCountsForRv, conditions, covariates, interactions, NZMeanByRep, LogZPercByRep)
 
     def def_r_zinb_signif(self):
-        r("""
-            zinb_signif = function(
-                df,
-                zinbMod1,
-                zinbMod0,
-                nbMod1,
-                nbMod0,
-                DEBUG = F
-            ) {
-              print("Starting ZINB in R")
-              suppressMessages(require(pscl))
-              suppressMessages(require(MASS))
-              melted = df
-              #print(head(melted))
-
-              # filter out genes that have low saturation across all conditions, since pscl sometimes does not fit params well (resulting in large negative intercepts and high std errors)
-              NZpercs = aggregate(melted$cnt,by=list(melted$cond),FUN=function(x) { sum(x>0)/length(x) })
-              if (max(NZpercs$x)<0.15) { return(c(pval=1,status="low saturation (<15%) across all conditions (pan-growth-defect) - not analyzed")) }
-
-              sums = aggregate(melted$cnt,by=list(melted$cond),FUN=sum)
-              # to avoid model failing due to singular condition, add fake counts of 1 to all conds if any cond is all 0s
-              if (0 %in% sums[,2]) {
-                # print("adding pseudocounts")
-                for (i in 1:length(sums[,1])) {
-                  subset = melted[melted$cond==sums[i,1],]
-                  newvec = subset[1,]
-                  newvec$cnt = 1 # note: non_zero_mean and NZperc are copied from last dataset in condition
-                  #newvec$cnt = as.integer(mean(subset$cnt))+1 # add the mean for each condition as a pseudocount
-                  melted = rbind(melted,newvec) }
-              }
-              status = "-"
-              minCount = min(melted$cnt)
-              f1 = ""
-              mod1 = tryCatch(
-                {
-                  if (minCount == 0) {
-                    f1 = zinbMod1
-                    mod = zeroinfl(as.formula(zinbMod1),data=melted,dist="negbin")
-                    coeffs = summary(mod)$coefficients
-                    # [,1] is col of parms, [,2] is col of stderrs, assume Intercept is always first
-                    #if (coeffs$count[,2][1]>0.5) { status = 'warning: high stderr on Intercept for mod1' }
-                    mod
-                  } else {
-                    f1 = nbMod1
-                    glm.nb(as.formula(nbMod1),data=melted)
-                  }
-                },
-                error=function(err) {
-                  status <<- err$message
-                  return(NULL)
-                })
-              f0 = ""
-              mod0 = tryCatch( # null model, independent of conditions
-                {
-                  if (minCount == 0) {
-                    f0 = zinbMod0
-                    mod = zeroinfl(as.formula(zinbMod0),data=melted,dist="negbin")
-                    coeffs = summary(mod)$coefficients
-                    # [,1] is col of parms, [,2] is col of stderrs, assume Intercept is always first
-                    #if (coeffs$count[,2][1]>0.5) { status = 'warning: high stderr on Intercept for mod0' }
-                    mod
-                  } else {
-                    f0 = nbMod0
-                    glm.nb(as.formula(nbMod0),data=melted)
-                  }
-                },
-                error=function(err) {
-                  status <<- err$message
-                  return(NULL)
-                })
-              if (DEBUG) {
-                  print("Model 1:")
-                  print(f1)
-                  print(summary(mod1))
-                  print("Model 0:")
-                  print(f0)
-                  print(summary(mod0))
-              }
-
-              if (is.null(mod1) | is.null(mod0)) { return (c(1, paste0("Model Error. ", status))) }
-              if ((minCount == 0) && (sum(is.na(coef(summary(mod1))$count[,4]))>0)) { return(c(1, "Has Coefs, but Pvals are NAs (model failure)")) } # rare failure mode - has coefs, but pvals are NA
-              df1 = attr(logLik(mod1),"df"); df0 = attr(logLik(mod0),"df") # should be (2*ngroups+1)-3
-              if (DEBUG) print(sprintf("delta_log_likelihood=%f",logLik(mod1)-logLik(mod0)))
-              pval = pchisq(2*(logLik(mod1)-logLik(mod0)),df=df1-df0,lower.tail=F) # alternatively, could use lrtest()
-              # this gives same answer, but I would need to extract the Pvalue...
-              #require(lmtest)
-              #print(lrtest(mod1,mod0))
-              print("Finished ZINB in R")
-              return (c(pval, status))
-            }
-        """)
-
-        return globalenv['zinb_signif']
+        return define_r_zinb_signif()
 
     def winsorize(self, counts):
       # input is insertion counts for gene: list of lists: n_replicates (rows) X n_TA sites (cols) in gene
@@ -371,11 +650,7 @@ class ZinbMethod(base.MultiConditionMethod):
         return numpy.array(result)
 
     def is_number(self, s):
-        try:
-            float(s)
-            return True
-        except ValueError:
-            return False
+        return is_number(s)
 
     def run_zinb(self, data, genes, NZMeanByRep, LogZPercByRep, RvSiteindexesMap, conditions, covariates, interactions):
         """
@@ -393,7 +668,6 @@ class ZinbMethod(base.MultiConditionMethod):
         count = 0
         self.progress_range(len(genes))
         pvals,Rvs, status = [],[], []
-        r_zinb_signif = self.def_r_zinb_signif()
         self.transit_message("Running analysis...")
         if (self.winz): self.transit_message("Winsorizing insertion count data")
 
@@ -412,71 +686,97 @@ class ZinbMethod(base.MultiConditionMethod):
 
         nbMod1 = "cnt~%s" % (comp1a)
         nbMod0 = "cnt~%s" % (comp0a)
-        toRFloatOrStrVec = lambda xs: FloatVector([float(x) for x in xs]) if self.is_number(xs[0]) else StrVector(xs)
+        debugFlag = True if DEBUG or GENE else False
+        print("zinbMod1", str(zinbMod1))
+        print("zinbMod0", str(zinbMod0))
+        print("nbMod1", str(nbMod1))
+        print("nbMod0", str(nbMod0))
+        print("debugFlag", str(debugFlag))
+        if self.engine == "python": models = (comp1a, comp1b, comp0a, comp0b, debugFlag)
+        else: models = (zinbMod1, zinbMod0, nbMod1, nbMod0, debugFlag)
+        workerArgs = (self.engine, models, self.covars, self.interactions,
+                conditions, covariates, interactions, NZMeanByRep, LogZPercByRep)
+
+        cpus = 1 if GENE else self.cpus
+        if cpus > 1:
+            # With R, each worker is a fresh process with its own embedded R session
+            self.transit_message("Fitting genes in %d worker processes" % cpus)
+            context = multiprocessing.get_context("spawn" if self.engine == "R" else None)
+            pool = context.Pool(cpus, initializer=init_zinb_worker, initargs=workerArgs)
+            pending = collections.deque()
+        else:
+            init_zinb_worker(*workerArgs)
 
-        for gene in genes:
-            count += 1
-            Rv = gene["rv"]
-            ## Single gene case for debugging
-            if (GENE):
-                Rv = None
-                if GENE in RvSiteindexesMap:
-                    Rv = GENE
-                else:
-                    for g in genes:
-                        if (g['gene'] == GENE):
-                            Rv = g["rv"]
-                            break
-                if not Rv:
-                    self.transit_error("Cannot find gene: {0}".format(GENE))
-                    sys.exit(0)
-
-            if (DEBUG):
-               self.transit_message("======================================================================")
-               self.transit_message(gene["rv"]+" "+gene["gene"])
-
-            if (len(RvSiteindexesMap[Rv]) <= 1):
-                status.append("TA sites <= 1, not analyzed")
-                pvals.append(1)
-            else:
-                norm_data = list(map(lambda wigData: wigData[RvSiteindexesMap[Rv]], data))
-                if self.winz: norm_data = self.winsorize(norm_data)
-                ([readCounts, condition, covarsData, interactionsData, NZmean, logitZPerc]) =  self.melt_data(norm_data, conditions, covariates, interactions, NZMeanByRep, LogZPercByRep)
-                if (numpy.sum(readCounts) == 0):
-                    status.append("pan-essential (no counts in all conditions) - not analyzed")
+        def collect(results):
+            for (i, (pval, msg)) in results:
+                pvals[i], status[i] = pval, msg
+            done = len(pvals) - pvals.count(None)
+            self.progress_update("Running ZINB Method... %5.1f%%" % (100.0*done/len(genes)), done)
+
+        try:
+            batch = []
+            for gene in genes:
+                count += 1
+                Rv = gene["rv"]
+                ## Single gene case for debugging
+                if (GENE):
+                    Rv = None
+                    if GENE in RvSiteindexesMap:
+                        Rv = GENE
+                    else:
+                        for g in genes:
+                            if (g['gene'] == GENE):
+                                Rv = g["rv"]
+                                break
+                    if not Rv:
+                        self.transit_error("Cannot find gene: {0}".format(GENE))
+                        sys.exit(0)
+
+                if (DEBUG):
+                   self.transit_message("======================================================================")
+                   self.transit_message(gene["rv"]+" "+gene["gene"])
+
+                if (len(RvSiteindexesMap[Rv]) <= 1):
+                    status.append("TA sites <= 1, not analyzed")
                     pvals.append(1)
                 else:
-                    df_args = {
-                        'cnt': IntVector(readCounts),
-                        'cond': toRFloatOrStrVec(condition),
-                        'NZmean': FloatVector(NZmean),
-                        'logitZperc': FloatVector(logitZPerc)
-                        }
-                    ## Add columns for covariates and interactions if they exist.
-                    df_args.update(list(map(lambda t_ic: (t_ic[1], toRFloatOrStrVec(covarsData[t_ic[0]])), enumerate(self.covars))))
-                    df_args.update(list(map(lambda t_ic: (t_ic[1], toRFloatOrStrVec(interactionsData[t_ic[0]])), enumerate(self.interactions))))
-
-                    melted = DataFrame(df_args)
-                    # r_args = [IntVector(readCounts), StrVector(condition), melted, map(lambda x: StrVector(x), covars), FloatVector(NZmean), FloatVector(logitZPerc)] + [True]
-                    debugFlag = True if DEBUG or GENE else False
-                    #print(f'''melted =''', str(melted))
-                    print("zinbMod1", str(zinbMod1))
-                    print("zinbMod0", str(zinbMod0))
-                    print("nbMod1", str(nbMod1))
-                    print("nbMod0", str(nbMod0))
-                    print("debugFlag", str(debugFlag))
-                    pval, msg = r_zinb_signif(melted, zinbMod1, zinbMod0, nbMod1, nbMod0, debugFlag)
-                    status.append(msg)
-                    pvals.append(float(pval))
-                if (DEBUG or GENE):
-                    self.transit_message("Pval for Gene {0}: {1}, status: {2}".format(Rv, pvals[-1], status[-1]))
-                if (GENE):
-                    self.transit_message("Ran for single gene. Exiting...")
-                    sys.exit(0)
-            Rvs.append(Rv)
-            # Update progress
-            text = "Running ZINB Method... %5.1f%%" % (100.0*count/len(genes))
-            self.progress_update(text, count)
+                    norm_data = numpy.array(list(map(lambda wigData: wigData[RvSiteindexesMap[Rv]], data)))
+                    if self.winz: norm_data = self.winsorize(norm_data)
+                    if (numpy.sum(numpy.concatenate(norm_data).astype(int)) == 0):
+                        status.append("pan-essential (no counts in all conditions) - not analyzed")
+                        pvals.append(1)
+                    elif cpus > 1:
+                        # Filled in when the batch comes back from a worker
+                        status.append(None)
+                        pvals.append(None)
+                        batch.append((len(pvals)-1, norm_data))
+                        if len(batch) == BATCH_SIZE:
+                            pending.append(pool.apply_async(fit_zinb_genes, (batch,)))
+                            batch = []
+                        # Keep a bounded number of batches in flight
+                        while len(pending) > 2*cpus: collect(pending.popleft().get())
+                    else:
+                        pval, msg = fit_zinb_gene(norm_data)
+                        status.append(msg)
+                        pvals.append(pval)
+                    if (DEBUG or GENE):
+                        self.transit_message("Pval for Gene {0}: {1}, status: {2}".format(Rv, pvals[-1], status[-1]))
+                    if (GENE):
+                        self.transit_message("Ran for single gene. Exiting...")
+                        sys.exit(0)
+                Rvs.append(Rv)
+                # Update progress
+                if cpus == 1:
+                    text = "Running ZINB Method... %5.1f%%" % (100.0*count/len(genes))
+                    self.progress_update(text, count)
+
+            if cpus > 1:
+                if batch: pending.append(pool.apply_async(fit_zinb_genes, (batch,)))
+                while pending: collect(pending.popleft().get())
+                pool.close()
+                pool.join()
+        finally:
+            if cpus > 1: pool.terminate()
 
         pvals = numpy.array(pvals)
         mask = numpy.isfinite(pvals)
@@ -519,7 +819,7 @@ class ZinbMethod(base.MultiConditionMethod):
     def Run(self):
         self.transit_message("Starting ZINB analysis")
         start_time = time.time()
-        packnames = ("MASS", "pscl")
+        packnames = ("MASS", "pscl") if self.engine == "R" else ()
         r_packages_needed = [x for x in packnames if not rpackages.isinstalled(x)]
         if (len(r_packages_needed) > 0):
             self.transit_error(
@@ -691,6 +991,8 @@ class ZinbMethod(base.MultiConditionMethod):
         --interactions <covar1,covar2...> := Comma separated list of covariates to include, that interact with the condition for the analysis. Must be factors
         --prot_table <filename>           := for appending annotations of genes
         --gene <RV number or Gene name>   := Run method for one gene and print model output.
+        -cpus <N>                         := Number of worker processes (each with its own R session) fitting genes in parallel. Default: -cpus 1
+        -engine <R|python>                := Fit the models with pscl/MASS in R (through rpy2), or with the python implementation (no R needed). Default: -engine R
 
         """ % (sys.argv[0])
 
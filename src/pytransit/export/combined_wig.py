@@ -163,7 +163,8 @@ class CombinedWigMethod(base.SingleConditionMethod):
             self.ctrldata, self.annotation_path)
         position = position.astype(int)
 
-        hash = transit_tools.get_pos_hash(self.annotation_path)
+        index = tnseq_tools.get_annotation_index(self.annotation_path)
+        genes_at_positions = index.genes_at_positions(position)
         rv2info = transit_tools.get_gene_info(self.annotation_path)
 
         self.transit_message("Normalizing")
@@ -197,7 +198,7 @@ class CombinedWigMethod(base.SingleConditionMethod):
             #self.output.write("%d\t%s\t%s\n" % (position[i], "\t".join(["%1.1f" % c for c in fulldata[:,i]]),",".join(["%s (%s)" % (orf,rv2info.get(orf,["-"])[0]) for orf in hash.get(position[i], [])])   ))
             if self.normalization!='nonorm': vals = "\t".join(["%1.1f" % c for c in fulldata[:,i]])
             else: vals = "\t".join(["%d" % c for c in fulldata[:,i]]) # no decimals if raw counts
-            self.output.write("%d\t%s\t%s\n" % (position[i],vals,",".join(["%s (%s)" % (orf,rv2info.get(orf,["-"])[0]) for orf in hash.get(position[i], [])])   ))
+            self.output.write("%d\t%s\t%s\n" % (position[i],vals,",".join(["%s (%s)" % (orf,rv2info.get(orf,["-"])[0]) for orf in genes_at_positions[i]])   ))
             # Update progress
             text = "Running Export Method... %5.1f%%" % (100.0*i/N)
             if i%1000==0: self.progress_update(text, i)
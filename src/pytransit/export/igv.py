@@ -158,8 +158,6 @@ class IGVMethod(base.SingleConditionMethod):
             self.ctrldata, self.annotation_path)
         position = position.astype(int)
 
-        hash = transit_tools.get_pos_hash(self.annotation_path)
-        rv2info = transit_tools.get_gene_info(self.annotation_path)
 
         self.transit_message("Normalizing")
         self.output.write("#Converted to IGV with TRANSIT.\n")
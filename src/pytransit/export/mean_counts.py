@@ -162,8 +162,6 @@ class MeanCountsMethod(base.SingleConditionMethod):
         (fulldata, factors) = norm_tools.normalize_data(fulldata, self.normalization, self.ctrldata, self.annotation_path)
         position = position.astype(int)
 
-        hash = transit_tools.get_pos_hash(self.annotation_path)
-        rv2info = transit_tools.get_gene_info(self.annotation_path)
 
         self.transit_message("Normalizing")
         self.output.write("#Summarized to Mean Gene Counts with TRANSIT.\n")
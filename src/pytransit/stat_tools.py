@@ -1,5 +1,6 @@
 import sys,math,random
 import numpy
+import scipy.special
 import scipy.stats
 
 
@@ -26,6 +27,56 @@ def sample_trunc_norm_post(data, S, mu0, s20, k0, nu0):
 
 #
 
+def sample_trunc_norm_post_batch(n, ybar, s2, S, mu0, s20, k0, nu0):
+    """Draws S posterior samples of the mean and variance for many genes at once.
+
+    Batch version of sample_trunc_norm_post, taking the sufficient statistics
+    of the data of each gene instead of the data, and drawing the samples of
+    all genes as (genes X S) arrays at once.
+
+    Arguments:
+        n (numpy.ndarray): Number of observations of each gene.
+        ybar (numpy.ndarray): Mean of the observations of each gene.
+        s2 (numpy.ndarray): Variance (ddof=1) of the observations of each gene.
+        S (int): Number of samples.
+        mu0, s20, k0, nu0 (float): Parameters of the (normal-inverse-gamma) prior.
+
+    Returns:
+        tuple: (mu_post, s2_post), arrays of shape (genes X S). Rows of genes
+        whose posterior is undefined (e.g. a single observation) are NaN.
+    """
+    (n, ybar, s2) = (numpy.asarray(n, dtype=float), numpy.asarray(ybar, dtype=float), numpy.asarray(s2, dtype=float))
+    kn = k0+n
+    nun = nu0+n
+    mun = (k0*mu0 + n*ybar)/kn
+    with numpy.errstate(invalid="ignore"):
+        s2n = (1.0/nun) * (nu0*s20 + (n-1)*s2 + (k0*n/kn)*numpy.power(ybar-mu0,2))
+    valid = numpy.isfinite(s2n) & (s2n > 0) & numpy.isfinite(mun)
+    (s2n, mun) = (numpy.where(valid, s2n, 1.0), numpy.where(valid, mun, 0.0))
+
+    s2_post = 1.0/scipy.stats.gamma.rvs((nun/2.0)[:,None], scale=(2.0/(s2n*nun))[:,None], size=(len(n), S))
+
+    # Truncated Normal since counts can't be negative
+    min_mu = 0
+    max_mu = 1000000
+    scale = numpy.sqrt(s2_post/kn[:,None])
+    trunc_a = (min_mu-mun[:,None])/scale
+    trunc_b = (max_mu-mun[:,None])/scale
+
+    # Inverse-CDF sampling (trunc_a <= 0, as counts are not negative), faster than truncnorm.rvs for arrays of bounds
+    cdf_a = scipy.special.ndtr(trunc_a)
+    cdf_b = numpy.ones_like(trunc_b)
+    finite_b = trunc_b < 40 # ndtr is 1 above
+    cdf_b[finite_b] = scipy.special.ndtr(trunc_b[finite_b])
+    U = numpy.random.random((len(n), S))
+    mu_post = mun[:,None] + scale*scipy.special.ndtri(cdf_a + U*(cdf_b - cdf_a))
+    mu_post = numpy.clip(mu_post, min_mu, max_mu)
+    mu_post[~valid] = numpy.nan
+    s2_post[~valid] = numpy.nan
+    return (mu_post, s2_post)
+
+#
+
 def FWER_Bayes(X):
     ii = numpy.argsort(numpy.argsort(X))
     P_NULL = numpy.sort(X)
@@ -55,18 +106,99 @@ def HDI_from_MCMC(posterior_samples, credible_mass=0.95):
     # Computes highest density interval from a sample of representative values,
     # estimated as the shortest credible interval
     # Takes Arguments posterior_samples (samples from posterior) and credible mass (normally .95)
-    sorted_points = sorted(posterior_samples)
-    ciIdxInc = numpy.ceil(credible_mass * len(sorted_points)).astype('int')
-    nCIs = len(sorted_points) - ciIdxInc
-    ciWidth = [0]*nCIs
-    for i in range(0, nCIs):
-        ciWidth[i] = sorted_points[i + ciIdxInc] - sorted_points[i]
-    HDImin = sorted_points[ciWidth.index(min(ciWidth))]
-    HDImax = sorted_points[ciWidth.index(min(ciWidth))+ciIdxInc]
+    (HDImin, HDImax) = HDI_from_MCMC_batch(numpy.atleast_2d(posterior_samples), credible_mass)
+    return(HDImin[0], HDImax[0])
+
+#
+
+def HDI_from_MCMC_batch(posterior_samples, credible_mass=0.95):
+    """Highest density intervals of many posteriors at once (see HDI_from_MCMC).
+
+    Sorts the samples of each row and finds the narrowest window holding
+    credible_mass of them, for all rows together.
+
+    Arguments:
+        posterior_samples (numpy.ndarray): 2D array, with the samples of one posterior per row.
+        credible_mass (float): Probability mass of the interval.
+
+    Returns:
+        tuple: (HDImin, HDImax), arrays with the bounds of the interval of
+        each row (NaN for rows with NaN samples).
+    """
+    sorted_points = numpy.sort(posterior_samples, axis=1)
+    (R, nsamples) = sorted_points.shape
+    ciIdxInc = int(numpy.ceil(credible_mass * nsamples))
+    nCIs = nsamples - ciIdxInc
+    ciWidth = sorted_points[:, ciIdxInc:] - sorted_points[:, :nCIs]
+    best = numpy.argmin(ciWidth, axis=1)
+    rows = numpy.arange(R)
+    HDImin = sorted_points[rows, best]
+    HDImax = sorted_points[rows, best+ciIdxInc]
+    missing = numpy.isnan(sorted_points[:, -1])
+    HDImin[missing] = numpy.nan
+    HDImax[missing] = numpy.nan
     return(HDImin, HDImax)
 
 #
 
+def split_chains(chains):
+    # Splits each chain (row) in half, so that trends within a chain count as disagreement
+    chains = numpy.atleast_2d(numpy.asarray(chains, dtype=float))
+    half = chains.shape[1]//2
+    return numpy.vstack([chains[:, :half], chains[:, half:2*half]])
+
+#
+
+def rhat(chains):
+    """Returns the (split) Gelman-Rubin potential scale reduction factor of MCMC samples.
+    Values close to 1 indicate the chains have converged to the same distribution.
+
+    Arguments:
+        chains (numpy.ndarray): (chains x samples) array; a 1D array is treated as a single chain.
+
+    Returns:
+        float: R-hat, or nan if the samples have no variance.
+    """
+    chains = split_chains(chains)
+    (M, n) = chains.shape
+    W = numpy.mean(numpy.var(chains, axis=1, ddof=1))
+    B = n * numpy.var(numpy.mean(chains, axis=1), ddof=1)
+    if not W > 0: return float("nan")
+    var_plus = (n-1.0)/n * W + B/n
+    return math.sqrt(var_plus/W)
+
+#
+
+def effective_sample_size(chains):
+    """Returns the effective sample size of MCMC samples, combining the autocorrelations
+    of the (split) chains and truncating their sum at the first negative pair (Geyer, 1992).
+
+    Arguments:
+        chains (numpy.ndarray): (chains x samples) array; a 1D array is treated as a single chain.
+
+    Returns:
+        float: Effective sample size, or nan if the samples have no variance.
+    """
+    chains = split_chains(chains)
+    (M, n) = chains.shape
+    X = chains - numpy.mean(chains, axis=1)[:, None]
+    # autocovariances of each chain through the FFT
+    f = numpy.fft.rfft(X, n=2*n, axis=1)
+    acov = numpy.fft.irfft(f * numpy.conjugate(f), axis=1)[:, :n] / n
+    W = numpy.mean(acov[:, 0]) * n/(n-1.0)
+    B = n * numpy.var(numpy.mean(chains, axis=1), ddof=1)
+    if not W > 0: return float("nan")
+    var_plus = (n-1.0)/n * W + B/n
+    rho = 1.0 - (W - numpy.mean(acov, axis=0)) / var_plus
+    rho[0] = 1.0
+    P = rho[:n-1:2] + rho[1:n:2]
+    negative = numpy.nonzero(P <= 0)[0]
+    if len(negative): P = P[:negative[0]]
+    tau = max(-1.0 + 2.0*numpy.sum(P), 1.0/math.log10(M*n)) # bounded as in Stan, for antithetic chains
+    return M*n/tau
+
+#
+
 def transformToRange(X, new_min, new_max, old_min=None, old_max=None):
 
     if old_min == None:
@@ -365,6 +497,67 @@ def BH_fdr_correction(X):
 
 #
 
+def mannwhitneyu_segments(values, first, owner, nsegments, max_exact=8):
+    """Two-sided Mann-Whitney U-tests for many segments (e.g. genes) at once.
+
+    Equivalent to calling scipy.stats.mannwhitneyu(x, y, alternative="two-sided")
+    for each segment, where x and y are the values of the segment in the first
+    and second sample. The values are sorted by (segment, value) once, so that
+    the average ranks, U statistics and tie corrections of all segments are
+    computed as arrays and p-values come from the normal approximation (with
+    continuity correction). Segments where SciPy may use the exact distribution
+    instead (no ties and at most max_exact values in one of the samples) are
+    passed to SciPy. Segments with an empty sample get U=0 and p-value 1.
+
+    Args:
+        values: 1D array with the pooled values of all segments.
+        first: Boolean array, True for the values in the first sample (x).
+        owner: Integer array with the segment of each value (0..nsegments-1).
+        nsegments: Number of segments.
+        max_exact: Largest sample size for which SciPy may use the exact test.
+
+    Returns:
+        tuple: (U, pvals), arrays with the U statistic of the first sample and
+        the two-sided p-value of each segment.
+    """
+    values = numpy.asarray(values, dtype=float)
+    first = numpy.asarray(first, dtype=bool)
+    owner = numpy.asarray(owner, dtype=int)
+    order = numpy.lexsort((values, owner))
+    (v, o, f) = (values[order], owner[order], first[order])
+
+    n1 = numpy.bincount(owner, weights=first, minlength=nsegments)
+    n = numpy.bincount(owner, minlength=nsegments)
+    n2 = n - n1
+    start = numpy.cumsum(n) - n
+
+    # Average rank (within the segment) of each group of tied values
+    newgroup = numpy.ones(len(v), dtype=bool)
+    newgroup[1:] = (v[1:] != v[:-1]) | (o[1:] != o[:-1])
+    groupstart = numpy.flatnonzero(newgroup)
+    ties = numpy.diff(numpy.append(groupstart, len(v)))
+    ranks = numpy.repeat(groupstart - start[o[groupstart]] + (ties + 1)/2.0, ties)
+
+    R1 = numpy.bincount(o, weights=ranks*f, minlength=nsegments)
+    U1 = R1 - n1*(n1 + 1)/2.0
+    U = numpy.maximum(U1, n1*n2 - U1)
+    tie_term = numpy.bincount(o[groupstart], weights=ties**3.0 - ties, minlength=nsegments)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        s = numpy.sqrt(n1*n2/12.0 * ((n + 1) - tie_term/(n*(n - 1.0))))
+        z = (U - n1*n2/2.0 - 0.5)/s
+    pvals = numpy.clip(2*scipy.stats.norm.sf(z), 0.0, 1.0)
+
+    empty = (n1 == 0) | (n2 == 0)
+    (U1[empty], pvals[empty]) = (0.0, 1.0)
+    hasties = numpy.bincount(o[groupstart], weights=ties > 1, minlength=nsegments) > 0
+    for i in numpy.flatnonzero(~empty & ~hasties & (numpy.minimum(n1, n2) <= max_exact)):
+        x = v[start[i]:start[i]+n[i]]
+        fx = f[start[i]:start[i]+n[i]]
+        (U1[i], pvals[i]) = scipy.stats.mannwhitneyu(x[fx], x[~fx], alternative="two-sided")
+    return (U1, pvals)
+
+#
+
 def bayesian_ess_thresholds(Z_raw, ALPHA=0.05):
     """Returns Essentiality Thresholds using a BH-like procedure"""
     Z = numpy.sort(Z_raw)[::-1]
@@ -528,6 +721,78 @@ def F_shuffle_dict_libraries(*args, **kwargs):
 
 #
 
+def permuted_mean_diffs(data, n1, S, site_restricted=False, max_block_size=1000000):
+    """Returns the difference in means for S random permutations of the data.
+
+    Batched equivalent of applying F_shuffle_flat() (or
+    site_restricted_permutation()) and F_mean_diff_flat() S times. Permutations
+    are drawn as a matrix of indexes (argsort of uniform random keys), in blocks
+    of at most max_block_size values, and the statistic is computed for all
+    permutations of a block at once.
+
+    Args:
+        data: 1D array of counts pooled across both conditions, or 2D array
+            (samples X TA sites) if site_restricted.
+        n1: Number of elements (or rows, if site_restricted) in the first
+            condition.
+        S: Number of permutations.
+        site_restricted: Permute counts among samples within each TA site.
+        max_block_size: Maximum number of values permuted at a time.
+
+    Returns:
+        numpy array with the S samples of the test statistic.
+    """
+    samples = numpy.zeros(S)
+    block = max(1, max_block_size // max(data.size, 1))
+    for start in range(0, S, block):
+        B = min(block, S - start)
+        if site_restricted:
+            (nsamples, nTAs) = data.shape
+            index = numpy.argsort(numpy.random.random((B, nsamples, nTAs)), axis=1)
+            perm = data[index, numpy.arange(nTAs)]
+            samples[start:start+B] = numpy.mean(perm[:,n1:,:], axis=(1,2)) - numpy.mean(perm[:,:n1,:], axis=(1,2))
+        else:
+            index = numpy.argsort(numpy.random.random((B, len(data))), axis=1)
+            perm = data[index]
+            samples[start:start+B] = numpy.mean(perm[:,n1:], axis=1) - numpy.mean(perm[:,:n1], axis=1)
+    return samples
+
+#
+
+def rank_product_null_counts(obsRP, K, S, max_block_size=1000000):
+    """Counts, for each observed rank product, the permuted rank products that are <= it.
+
+    The null distribution is obtained by permuting the ranks 1..N (N genes)
+    independently in each of K replicates, S times, and taking the geometric
+    mean of the ranks of each gene. Permutations are drawn in blocks of at
+    most max_block_size ranks (argsort of uniform random keys); the rank
+    products of each block are sorted and all observed values are counted
+    with one binary search, instead of comparing every gene against all S*N
+    permuted values.
+
+    Args:
+        obsRP: 1D array with the observed rank products of the N genes.
+        K: Number of replicates.
+        S: Number of permutations.
+        max_block_size: Maximum number of ranks permuted at a time.
+
+    Returns:
+        numpy array with the number of permuted rank products (out of S*N)
+        less than or equal to each value of obsRP.
+    """
+    obsRP = numpy.asarray(obsRP)
+    N = len(obsRP)
+    counts = numpy.zeros(N, dtype=int)
+    block = max(1, max_block_size // max(K*N, 1))
+    for start in range(0, S, block):
+        B = min(block, S - start)
+        rankperm = numpy.argsort(numpy.random.random((B, K, N)), axis=2) + 1
+        permutations = numpy.power(numpy.prod(rankperm, axis=1, dtype=float), 1.0/K)
+        counts += numpy.searchsorted(numpy.sort(permutations, axis=None), obsRP, side="right")
+    return counts
+
+#
+
 def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
             permFunc=F_shuffle_flat, adaptive=False, lib_str1="", lib_str2="",PC=1,site_restricted=False):
     """Does a permutation test on two sets of data.
@@ -664,6 +929,27 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
           perm[n1:] = data2
 
 
+    # Difference of means with the default permutations can be done in batches
+    if not lib_str1 and testFunc is F_mean_diff_flat and (site_restricted or permFunc is F_shuffle_flat):
+        if adaptive: checkpoints = sorted(set([round(S*0.01), round(S*0.1), S]))
+        else: checkpoints = [S]
+        samples = numpy.zeros(0)
+        for checkpoint in checkpoints:
+            if checkpoint <= len(samples): continue
+            if mean1+mean2 > 0:
+                block = permuted_mean_diffs(perm, n1, checkpoint - len(samples), site_restricted)
+            else:
+                block = numpy.zeros(checkpoint - len(samples))
+            samples = numpy.concatenate((samples, block))
+            if adaptive and numpy.sum(numpy.abs(samples) >= abs(test_obs)) >= round(S*0.01*0.10):
+                break
+
+        s_performed = len(samples)
+        pval_ltail = numpy.sum(samples <= test_obs)/float(s_performed)
+        pval_utail = numpy.sum(samples >= test_obs)/float(s_performed)
+        pval_2tail = numpy.sum(numpy.abs(samples) >= abs(test_obs))/float(s_performed)
+        return (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, samples.tolist())
+
     count_ltail = 0
     count_utail = 0
     count_2tail = 0
@@ -1,10 +1,13 @@
 import sys
 import os
+import re
 import math
 import warnings
+import itertools
+import concurrent.futures
 import numpy
 import scipy.stats
-from functools import total_ordering
+from functools import total_ordering, lru_cache
 
 
 try:
@@ -14,23 +17,53 @@ except ImportError:
     noNorm = True
     warnings.warn("Problem importing the norm_tools.py module. Read-counts will not be normalized. Some functions may not work.")
 
+def rv_siteindexes_ranges(genes, sites, nterm=0.0, cterm=0.0):
+    """Returns the range of TA sites of each gene, as slices into the sorted sites.
+
+    The coordinates within 3bp of the stop codon are excluded, as are the
+    N-terminal and C-terminal fractions given by nterm and cterm.
+
+    Arguments:
+        genes (list): List of genes as returned by read_genes.
+        sites (list): Sorted coordinates of the TA sites.
+        nterm (float): Percentage of the N-terminus to ignore.
+        cterm (float): Percentage of the C-terminus to ignore.
+
+    Returns:
+        tuple: Numpy arrays (lo, hi); the sites of genes[i] are sites[lo[i]:hi[i]].
+    """
+    sites = numpy.asarray(sites)
+    plus = numpy.array([gene["strand"] == "+" for gene in genes], dtype=bool)
+    start = numpy.array([gene["start"] for gene in genes], dtype=int) + numpy.where(plus, 0, 3)
+    end = numpy.array([gene["end"] for gene in genes], dtype=int) - numpy.where(plus, 3, 0)
+    lo = numpy.searchsorted(sites, start, "left")
+    hi = numpy.maximum(numpy.searchsorted(sites, end, "right"), lo)
+
+    # Trimming keeps a contiguous part of each range; compare the sites at
+    # the edges with the same fractions as for every coordinate
+    (offsets, index, owner) = concatenated_ranges(lo, hi)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        frac = (sites[index] - start[owner])/(end - start).astype(float)[owner]
+    keep = ~(frac < (nterm/100.0)) & ~(frac > ((100 - cterm)/100.0))
+    kept = numpy.concatenate([[0], numpy.cumsum(keep)])
+    count = kept[offsets[1:]] - kept[offsets[:-1]]
+    first = numpy.searchsorted(kept, kept[offsets[:-1]] + 1, "left") - 1
+    lo = numpy.zeros(len(genes), dtype=int)
+    lo[count > 0] = index[first[count > 0]]
+    return (lo, lo + count)
+
+#
+
 def rv_siteindexes_map(genes, TASiteindexMap, nterm=0.0, cterm=0.0):
     """
     ([Gene], {TAsite: Siteindex}) -> {Rv: Siteindex}
     """
+    sites = numpy.array(sorted(TASiteindexMap), dtype=int)
+    siteindexes = numpy.array([TASiteindexMap[TA] for TA in sites], dtype=int)
+    (lo, hi) = rv_siteindexes_ranges(genes, sites, nterm=nterm, cterm=cterm)
     RvSiteindexesMap = {}
     for g, gene in enumerate(genes):
-        siteindexes = []
-        start = gene["start"] if gene["strand"] == "+" else gene["start"] + 3
-        end = gene["end"] - 3 if gene["strand"] == "+" else gene["end"]
-        for i in range(start, end + 1):
-            co = i
-            if (co - start)/float(end-start) < (nterm/100.0):
-                continue
-            if (co - start)/float(end-start) > ((100 - cterm)/100.0):
-                continue
-            if co in TASiteindexMap: siteindexes.append(TASiteindexMap[co])
-        RvSiteindexesMap[gene["rv"]] = siteindexes
+        RvSiteindexesMap[gene["rv"]] = siteindexes[lo[g]:hi[g]].tolist()
     return RvSiteindexesMap
 
 # format:
@@ -38,6 +71,79 @@ def rv_siteindexes_map(genes, TASiteindexMap, nterm=0.0, cterm=0.0):
 #   counts lines contain the following columns: TA coord, counts, other info like gene/annotation
 #   for each column of counts, there must be a header line prefixed by "#File: " and then an id or filename
 
+# Parsed wig/combined-wig files are cached as binary .npy sidecars in a hidden
+# directory next to the original file, keyed on the file name, size and mtime.
+use_data_cache = True
+data_cache_dirname = ".transit_cache"
+
+def get_data_cache_path(path, ext=".npy"):
+    """Returns the path of the binary cache file for the given data file.
+
+    Arguments:
+        path (str): Path to a .wig or combined wig file.
+        ext (str): Extension of the cache file.
+
+    Returns:
+        str: Path to the cache file (which may not exist yet).
+    """
+    st = os.stat(path)
+    dirname, basename = os.path.split(os.path.abspath(path))
+    key = "%s.%d.%d" % (basename, st.st_size, st.st_mtime_ns)
+    return os.path.join(dirname, data_cache_dirname, key + ext)
+
+#
+
+def read_data_cache(path):
+    """Returns the cached array for the given data file, or None if there is no
+    up-to-date cache. The array is memory-mapped copy-on-write, so callers may
+    modify it in place without touching the cache.
+
+    Arguments:
+        path (str): Path to a .wig or combined wig file.
+
+    Returns:
+        narray: Memory-mapped array with the cached data (or None).
+    """
+    if not use_data_cache: return None
+    try:
+        return numpy.load(get_data_cache_path(path), mmap_mode="c")
+    except (OSError, ValueError):
+        return None
+
+#
+
+def write_data_cache(path, array, extra_lines=None):
+    """Saves the array as the binary cache of the given data file, removing
+    stale caches of the same file. Failures (e.g. read-only directories) are
+    ignored, since the cache is only an optimization.
+
+    Arguments:
+        path (str): Path to a .wig or combined wig file.
+        array (narray): Array with the parsed data.
+        extra_lines (list): Optional list of strings to store next to the array.
+    """
+    if not use_data_cache: return
+    try:
+        cache_path = get_data_cache_path(path)
+        cache_dir = os.path.dirname(cache_path)
+        key = os.path.basename(cache_path)[:-len(".npy")]
+        stale = re.compile(re.escape(os.path.basename(path)) + r"\.\d+\.\d+\.(npy|txt)$")
+        os.makedirs(cache_dir, exist_ok=True)
+        for fname in os.listdir(cache_dir):
+            if stale.match(fname) and not fname.startswith(key + "."):
+                os.remove(os.path.join(cache_dir, fname))
+        if extra_lines is not None:
+            with open(get_data_cache_path(path, ".txt"), "w") as f:
+                f.writelines("%s\n" % line for line in extra_lines)
+        tmp_path = cache_path + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "wb") as f:
+            numpy.save(f, array)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+#
+
 def read_combined_wig(fname):
     """
         Read the combined wig-file generated by Transit
@@ -46,25 +152,29 @@ def read_combined_wig(fname):
         WigData :: [Number]
         Filename :: String
     """
-    sites,countsByWig,files = [],[],[]
+    cached = read_data_cache(fname)
+    if cached is not None:
+        try:
+            files = [line.rstrip("\n") for line in open(get_data_cache_path(fname, ".txt"))]
+            return (cached[0].astype(int), numpy.asarray(cached[1:]), files)
+        except OSError:
+            pass
+
+    files = []
     with open(fname) as f:
         lines = f.readlines()
         for line in lines:
             if line.startswith("#File: "):
                 files.append(line.rstrip()[7:]) # allows for spaces in filenames
-    countsByWig = [[] for _ in files]
-    for line in lines:
-        if line[0]=='#': continue
-        cols = line.split("\t")[0:1+len(files)]
-        cols = cols[:1+len(files)] # additional columns at end could contain gene info
-        # Read in position as int, and readcounts as float
-        cols = list(map(lambda t_iv: int(t_iv[1]) if t_iv[0] == 0 else float(t_iv[1]), enumerate(cols)))
-        position, wigCounts = cols[0], cols[1:]
-        sites.append(position)
-        for i, c in enumerate(wigCounts):
-            countsByWig[i].append(c)
-
-    return (numpy.array(sites), numpy.array(countsByWig), files)
+    lines = [line for line in lines if line[0] != '#']
+    # Read in position and readcounts; additional columns at end could contain gene info
+    if lines:
+        cols = numpy.loadtxt(lines, delimiter="\t", usecols=range(1+len(files)), comments=None, ndmin=2)
+    else:
+        cols = numpy.zeros((0, 1+len(files)))
+    write_data_cache(fname, cols.T, files)
+
+    return (cols[:,0].astype(int), cols[:,1:].T.copy(), files)
 
 def read_samples_metadata(metadata_file, covarsToRead = [], interactionsToRead = [], condition_name="Condition"):
     """
@@ -120,19 +230,7 @@ def read_genes(fname,descriptions=False):
       (Filename, Options) -> [Gene]
       Gene :: {start, end, rv, gene, strand}
     """
-    genes = []
-    for line in open(fname):
-        w = line.rstrip().split('\t')
-        data = {
-                "start": int(w[1]),
-                "end": int(w[2]),
-                "rv": w[8],
-                "gene": w[7],
-                "strand": w[3]
-                }
-        if descriptions==True: data.append(w[0])
-        genes.append(data)
-    return genes
+    return get_annotation(fname).genes(descriptions)
 
 @total_ordering
 class Gene:
@@ -168,7 +266,7 @@ class Gene:
         .. seealso:: :class:`Genes`
         """
 
-    def __init__(self, orf, name, desc, reads, position, start=0, end=0, strand=""):
+    def __init__(self, orf, name, desc, reads, position, start=0, end=0, strand="", stats=None):
         """Initializes the Gene object.
 
         Arguments:
@@ -180,6 +278,7 @@ class Gene:
             start (int): An integer defining the start coordinate for the gene.
             end (int): An integer defining the end coordinate for the gene.
             strand (str): A string defining the strand of the gene.
+            stats (tuple): Precomputed (k, n, r, s, t). If given, reads and position are used without copying (e.g. views into the data of a Genes object).
 
         Returns:
             Gene: Object of the Gene class with the defined attributes.
@@ -192,27 +291,40 @@ class Gene:
         self.start = start
         self.end = end
         self.strand = strand
+        self._tosses = None
+        self._runs = None
+        if stats is not None:
+            self.reads = reads
+            self.position = position
+            (self.k, self.n, self.r, self.s, self.t) = stats
+            return
+
         self.reads = numpy.array(reads)
         self.position = numpy.array(position, dtype=int)
-        self.tosses = tossify(self.reads)
-        try:
-            self.runs = runs(self.tosses)
-        except Exception as e:
-            print(orf, name, self.tosses)
-            raise e
-
         self.k = int(numpy.sum(self.tosses))
         self.n = len(self.tosses)
-        try:
-            self.r = numpy.max(self.runs)
-        except Exception as e:
-            print(orf, name, self.tosses)
-            print(self.runs)
-            raise e
-
+        self.r = numpy.max(self.runs)
         self.s = self.get_gap_span()
         self.t = self.get_gene_span()
 
+#
+
+    @property
+    def tosses(self):
+        """Sites represented as bernoulli trials with insertions as 1."""
+        if self._tosses is None:
+            self._tosses = tossify(self.reads)
+        return self._tosses
+
+#
+
+    @property
+    def runs(self):
+        """List of the runs of non-insertions, as returned by runs()."""
+        if self._runs is None:
+            self._runs = runs(self.tosses)
+        return self._runs
+
 #
 
     def __getitem__(self, i):
@@ -343,6 +455,11 @@ class Genes:
         include_nc: Boolean determining whether to include non-coding areas.
         orf2index: Dictionary of orf id to index in the genes list.
         genes: List of the Gene objects.
+        data: Numpy array (K x N) with the read-counts at all the sites.
+        position: Numpy array with the coordinates of all the sites.
+        gene_offsets: Numpy array; the sites of gene i are site_index[gene_offsets[i]:gene_offsets[i+1]].
+        site_index: Numpy array with the (consecutive) site indexes of each gene, concatenated.
+        k, n, r, s, t: Numpy arrays with the insertions, sites, max run, gap span and gene span of each gene.
 
 
     :Example:
@@ -459,15 +576,11 @@ class Genes:
         self.cterm = cterm
         self.include_nc = include_nc
 
-        isProt = True
-        filename, file_extension = os.path.splitext(self.annotation)
-        if file_extension.lower() in [".gff", ".gff3"]:
-            isProt = False
-
         self.orf2index = {}
         self.genes = []
 
-        orf2info = get_gene_info(self.annotation)
+        annotation = get_annotation(self.annotation)
+        orf2info = annotation.gene_info()
         if not numpy.any(data):
             if transposon.lower() == "himar1" and not genome:
                 (data, position) = get_data(self.wigList)
@@ -479,7 +592,7 @@ class Genes:
         ii_min = data < self.minread
         data[ii_min] = 0
 
-        hash = get_pos_hash(self.annotation)
+        index = annotation.index
 
         if not noNorm:
             (data, factors) = norm_tools.normalize_data(data, norm, self.wigList, self.annotation)
@@ -492,52 +605,49 @@ class Genes:
         K,N = data.shape
 
         self.data = data
-        orf2posindex = {}
-        visited_list = []
-        for i in range(N):
-            genes_with_coord = hash.get(position[i], [])
-            for gene in genes_with_coord:
-                if gene not in orf2posindex: visited_list.append(gene)
-                if gene not in orf2posindex: orf2posindex[gene] = []
-
-                name,desc,start,end,strand = orf2info.get(gene, ["", "", 0, 0, "+"])
-
-                if strand == "+":
-                    if self.ignoreCodon and position[i] > end - 3:
-                        continue
-                else:
-                    if self.ignoreCodon and position[i] < start + 3:
-                        continue
-
-                if (position[i]-start)/float(end-start) < (self.nterm/100.0):
-                    continue
-
-                if (position[i]-start)/float(end-start) > ((100-self.cterm)/100.0):
-                    continue
-
-                orf2posindex[gene].append(i)
-
-        count = 0
-        for line in open(self.annotation):
-            if line.startswith("#"): continue
-            tmp = line.split("\t")
-
-            if isProt:
-                gene = tmp[8].strip()
-                name,desc,start,end,strand = orf2info.get(gene, ["", "", 0, 0, "+"])
-            else:
-                features = dict([tuple(f.split("=",1)) for f in filter(lambda x: "=" in x, tmp[8].split(";"))])
-                gene = features["ID"]
-                name,desc,start,end,strand = orf2info.get(gene, ["", "", 0, 0, "+"])
-            posindex = orf2posindex.get(gene, [])
-            if posindex:
-                pos_start = orf2posindex[gene][0]
-                pos_end = orf2posindex[gene][-1]
-                self.genes.append(Gene(gene, name, desc, data[:, pos_start:pos_end+1], position[pos_start:pos_end+1], start, end, strand))
+        position = numpy.asarray(position, dtype=int)
+        self.position = position
+        orfs = index.orfs
+        G = len(orfs)
+        info = [orf2info.get(gene, ["", "", 0, 0, "+"]) for gene in orfs]
+        starts = numpy.array([x[2] for x in info], dtype=int)
+        ends = numpy.array([x[3] for x in info], dtype=int)
+        minus = numpy.array([x[4] != "+" for x in info], dtype=bool)
+
+        # Sites in the gene, excluding the ones near the start/stop codon or the termini
+        (site_lo, site_hi) = index.site_ranges(position)
+        (offsets, ii, gene_of) = concatenated_ranges(site_lo, site_hi)
+        pos = position[ii]
+        (start, end) = (starts[gene_of], ends[gene_of])
+        keep = numpy.ones(len(ii), dtype=bool)
+        if self.ignoreCodon:
+            keep &= numpy.where(minus[gene_of], pos >= start + 3, pos <= end - 3)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            frac = (pos-start)/(end-start).astype(float)
+        keep &= ~(frac < (self.nterm/100.0))
+        keep &= ~(frac > ((100-self.cterm)/100.0))
+
+        # Each gene keeps the sites from its first to its last site not excluded
+        (kept_gene, kept_ii) = (gene_of[keep], ii[keep])
+        first = numpy.searchsorted(kept_gene, numpy.arange(G), "left")
+        last = numpy.searchsorted(kept_gene, numpy.arange(G), "right")
+        nonempty = last > first
+        lo = numpy.zeros(G, dtype=int)
+        hi = numpy.zeros(G, dtype=int)
+        lo[nonempty] = kept_ii[first[nonempty]]
+        hi[nonempty] = kept_ii[last[nonempty]-1] + 1
+        (self.gene_offsets, self.site_index, gene_of) = concatenated_ranges(lo, hi)
+
+        (self.k, self.n, self.r, self.s, self.t) = gene_statistics(tossify(data), position, self.gene_offsets, self.site_index, gene_of)
+
+        for g in range(G):
+            (name, desc, start, end, strand) = info[g]
+            stats = (int(self.k[g]), int(self.n[g]), int(self.r[g]), int(self.s[g]), int(self.t[g]))
+            if nonempty[g]:
+                self.genes.append(Gene(orfs[g], name, desc, data[:, lo[g]:hi[g]], position[lo[g]:hi[g]], start, end, strand, stats=stats))
             else:
-                self.genes.append(Gene(gene, name, desc, numpy.array([[]]), numpy.array([]), start, end, strand))
-            self.orf2index[gene] = count
-            count += 1
+                self.genes.append(Gene(orfs[g], name, desc, numpy.array([[]]), numpy.array([], dtype=int), start, end, strand, stats=stats))
+            self.orf2index[orfs[g]] = g
 
 #
 
@@ -547,12 +657,7 @@ class Genes:
         Returns:
             narray: Numpy array with the number of insertions for all genes.
         """
-        G = len(self.genes)
-        K = numpy.zeros(G)
-        for i in range(G):
-            K[i] = self.genes[i].k
-        return K
-
+        return self.k.astype(float)
 #
 
     def local_sites(self):
@@ -561,12 +666,7 @@ class Genes:
         Returns:
             narray: Numpy array with the number of sites for all genes.
         """
-        G = len(self.genes)
-        N = numpy.zeros(G)
-        for i in range(G):
-            N[i] = self.genes[i].n
-        return N
-
+        return self.n.astype(float)
 #
 
     def local_runs(self):
@@ -575,12 +675,7 @@ class Genes:
         Returns:
             narray: Numpy array with the max run of non-insertions for all genes.
         """
-        G = len(self.genes)
-        R = numpy.zeros(G)
-        for i in range(G):
-            R[i] = self.genes[i].r
-        return R
-
+        return self.r.astype(float)
 #
 
     def local_gap_span(self):
@@ -590,12 +685,7 @@ class Genes:
         Returns:
             narray: Numpy array with the span of gap for all genes.
         """
-        G = len(self.genes)
-        S = numpy.zeros(G)
-        for i in range(G):
-            S[i] = self.genes[i].s
-        return S
-
+        return self.s.astype(float)
 #
 
     def local_gene_span(self):
@@ -605,12 +695,7 @@ class Genes:
         Returns:
             narray: Numpy array with the span of gene for all genes.
         """
-        G = len(self.genes)
-        T = numpy.zeros(G)
-        for i in range(G):
-            T[i] = self.genes[i].t
-        return T
-
+        return self.t.astype(float)
 #
 
     def local_reads(self):
@@ -633,12 +718,10 @@ class Genes:
         Returns:
             narray: Numpy array with the density for all genes.
         """
-        G = len(self.genes)
-        theta = numpy.zeros(G)
-        for i in range(G):
-            theta[i] = self.genes[i].theta()
+        theta = numpy.zeros(len(self.genes))
+        ii = self.n > 0
+        theta[ii] = self.k[ii] / self.n[ii].astype(float)
         return theta
-
 #
 
     def local_phis(self):
@@ -647,8 +730,7 @@ class Genes:
         Returns:
             narray: Numpy array with the complement of density for all genes.
         """
-        return 1.0 - self.theta()
-
+        return 1.0 - self.local_thetas()
 #
 
     def global_insertion(self):
@@ -657,12 +739,7 @@ class Genes:
         Returns:
             float: Total sum of reads across all genes.
         """
-        G = len(self.genes)
-        total = 0
-        for i in range(G):
-            total += self.genes[i].k
-        return total
-
+        return int(numpy.sum(self.k))
 #
 
     def global_sites(self):
@@ -671,12 +748,7 @@ class Genes:
         Returns:
             int: Total number of sites across all genes.
         """
-        G = len(self.genes)
-        total = 0
-        for i in range(G):
-            total += self.genes[i].n
-        return total
-
+        return int(numpy.sum(self.n))
 #
 
     def global_run(self):
@@ -725,10 +797,8 @@ class Genes:
         Returns:
             float: Total sum of read-counts accross all genes.
         """
-        reads_total = 0
-        for g in self.genes:
-            reads_total += g.total_reads()
-        return reads_total
+        if not len(self.site_index): return 0
+        return numpy.sum(self.data[:, self.site_index], 1)
 
 #
 
@@ -738,10 +808,7 @@ class Genes:
         Returns:
             list: Sites represented as bernoulli trials with insertions as true.
         """
-        all_tosses = []
-        for g in self.genes:
-            all_tosses.extend(g.tosses)
-        return all_tosses
+        return list(tossify(self.data)[self.site_index])
 
 #
 
@@ -814,6 +881,76 @@ def runindex(runs):
 
 #
 
+def concatenated_ranges(lo, hi):
+    """Concatenates the ranges lo[i]:hi[i] into one index array (CSR-style).
+
+    Arguments:
+        lo (list): Start of each range.
+        hi (list): End (exclusive) of each range.
+
+    Returns:
+        tuple: (offsets, index, owner); range i is index[offsets[i]:offsets[i+1]], and owner holds the range of each element of index.
+    """
+    lengths = numpy.maximum(numpy.asarray(hi) - numpy.asarray(lo), 0)
+    offsets = numpy.zeros(len(lengths)+1, dtype=int)
+    numpy.cumsum(lengths, out=offsets[1:])
+    owner = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    index = numpy.arange(offsets[-1]) - offsets[owner] + numpy.asarray(lo, dtype=int)[owner]
+    return (offsets, index, owner)
+
+#
+
+def gene_statistics(tosses, position, offsets, index, owner):
+    """Returns the insertions, sites, max run, gap span and gene span of all genes at once.
+
+    Equivalent to the k, n, r, s and t attributes of Gene, computed with one
+    run-length encoding over the concatenated sites of all genes.
+
+    Arguments:
+        tosses (list): Sites represented as bernoulli trials (see tossify).
+        position (list): Coordinates of the sites.
+        offsets (list): The sites of gene i are index[offsets[i]:offsets[i+1]].
+        index (list): Site indexes of the genes, concatenated.
+        owner (list): Gene of each element of index.
+
+    Returns:
+        tuple: Numpy arrays (k, n, r, s, t).
+    """
+    G = len(offsets) - 1
+    hits = numpy.asarray(tosses)[index] > 0
+    cumhits = numpy.concatenate([[0], numpy.cumsum(hits)])
+    k = cumhits[offsets[1:]] - cumhits[offsets[:-1]]
+    n = numpy.diff(offsets)
+
+    # Runs of non-insertions, broken at insertions and at gene boundaries
+    zero = ~hits
+    first = numpy.zeros(len(index), dtype=bool)
+    last = numpy.zeros(len(index), dtype=bool)
+    first[offsets[:-1][n > 0]] = True
+    last[offsets[1:][n > 0] - 1] = True
+    run_start = numpy.nonzero(zero & (first | ~numpy.roll(zero, 1)))[0]
+    run_end = numpy.nonzero(zero & (last | ~numpy.roll(zero, -1)))[0]
+    run_length = run_end - run_start + 1
+    run_gene = owner[run_start]
+
+    r = numpy.zeros(G, dtype=int)
+    numpy.maximum.at(r, run_gene, run_length)
+
+    # Span of the last of the longest runs of each gene
+    longest = numpy.full(G, -1)
+    ii_max = numpy.nonzero(run_length == r[run_gene])[0]
+    numpy.maximum.at(longest, run_gene[ii_max], ii_max)
+    s = numpy.zeros(G, dtype=int)
+    ii = longest >= 0
+    s[ii] = position[index[run_end[longest[ii]]]] - position[index[run_start[longest[ii]]]] + 2
+
+    t = numpy.zeros(G, dtype=int)
+    ii = n > 0
+    t[ii] = position[index[offsets[1:][ii] - 1]] - position[index[offsets[:-1][ii]]] + 2
+    return (k, n, r, s, t)
+
+#
+
 def get_file_types(wig_list):
     """Returns the transposon type (himar1/tn5) of the list of wig files.
 
@@ -880,12 +1017,73 @@ def get_unknown_file_types(wig_list, transposons):
 
 #
 
-def get_data(wig_list):
+def read_wig(path, chunksize=1000000):
+    """ Returns a tuple of (position, reads) with the coordinates and read-counts
+        contained in a single .wig file. Header lines (e.g. "#" comments or
+        "variableStep") are skipped. The file is read once, and the numeric
+        columns are parsed in bulk in chunks of lines. The parsed columns are
+        kept in a binary cache so later calls load them without parsing.
+
+    Arguments:
+        path (str): Path to the wig file.
+        chunksize (int): Number of lines to parse at a time.
+
+    Returns:
+        tuple: Two numpy arrays with the coordinates and read-counts of the file.
+    """
+    cached = read_data_cache(path)
+    if cached is not None:
+        return (cached[0].astype(int), numpy.asarray(cached[1]))
+
+    positions, reads = [], []
+    with open(path) as wig_file:
+        while True:
+            chunk = list(itertools.islice(wig_file, chunksize))
+            if not chunk: break
+            lines = [line for line in chunk if line[0] in "0123456789"]
+            if lines:
+                values = numpy.fromstring("".join(lines), sep=" ")
+                if values.size == 2*len(lines):
+                    values = values.reshape(-1, 2)
+                else:
+                    # Lines with extra columns (or trailing comments); parse per column
+                    values = numpy.loadtxt(lines, usecols=(0,1), ndmin=2)
+                positions.append(values[:,0].astype(int))
+                reads.append(values[:,1])
+    if not positions:
+        return (numpy.zeros(0, dtype=int), numpy.zeros(0))
+    (positions, reads) = (numpy.concatenate(positions), numpy.concatenate(reads))
+    write_data_cache(path, numpy.array([positions, reads]))
+    return (positions, reads)
+
+#
+
+def read_wig_list(wig_list, nthreads=1):
+    """ Returns a list of (position, reads) tuples, one for each wig file given.
+
+    Arguments:
+        wig_list (list): List of paths to wig files.
+        nthreads (int): Number of threads used to parse the files concurrently.
+
+    Returns:
+        list: List of tuples with the coordinates and read-counts of each file.
+
+    .. seealso:: :class:`read_wig`
+    """
+    if nthreads > 1 and len(wig_list) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+            return list(executor.map(read_wig, wig_list))
+    return [read_wig(path) for path in wig_list]
+
+#
+
+def get_data(wig_list, nthreads=1):
     """ Returns a tuple of (data, position) containing a matrix of raw read-counts
         , and list of coordinates.
 
     Arguments:
         wig_list (list): List of paths to wig files.
+        nthreads (int): Number of threads used to read the files concurrently.
 
     Returns:
         tuple: Two lists containing data and positions of the wig files given.
@@ -906,14 +1104,11 @@ def get_data(wig_list):
     if not wig_list:
         return (numpy.zeros((1,0)), numpy.zeros(0), [])
 
+    wigs = read_wig_list(wig_list, nthreads)
+
     # Check size of all wig file matches
-    size_list = []
-    for j,path in enumerate(wig_list):
-        T = 0
-        for line in open(path):
-            if line[0] not in "0123456789": continue
-            T+=1
-        size_list.append(T)
+    size_list = [len(pos) for (pos, reads) in wigs]
+    T = size_list[-1]
 
     # If it doesn't match, report an error and quit
     if sum(size_list) != (T * len(size_list)):
@@ -922,37 +1117,20 @@ def get_data(wig_list):
         sys.exit()
 
     data = numpy.zeros((K,T))
-    position = numpy.zeros(T, dtype=int)
-    for j,path in enumerate(wig_list):
-        reads = []
-        i = 0
-        prev_pos = 0
-        for line in open(path):
-            if line[0] not in "0123456789": continue
-            tmp = line.split()
-            pos = int(tmp[0])
-            rd = float(tmp[1])
-            prev_pos = pos
-
-            try:
-                data[j,i] = rd
-            except Exception as e:
-                print("Error: %s" % e)
-                print("")
-                print("Make sure that all wig files have the same number of TA sites (i.e. same strain)")
-                sys.exit()
-            position[i] = pos
-            i+=1
+    for j,(pos, reads) in enumerate(wigs):
+        data[j,:] = reads
+    position = wigs[-1][0]
     return (data, position)
 
 #
 
-def get_data_zero_fill(wig_list):
+def get_data_zero_fill(wig_list, nthreads=1):
     """ Returns a tuple of (data, position) containing a matrix of raw read counts,
         and list of coordinates. Positions that are missing are filled in as zero.
 
     Arguments:
         wig_list (list): List of paths to wig files.
+        nthreads (int): Number of threads used to read the files concurrently.
 
     Returns:
         tuple: Two lists containing data and positions of the wig files given.
@@ -964,64 +1142,38 @@ def get_data_zero_fill(wig_list):
     if not wig_list:
         return (numpy.zeros((1,0)), numpy.zeros(0), [])
 
-    #NOTE:  This might be slow as we need to find the last insertion site
-    #       over all the replicates. This might be an area to attempt to optimize.
-    last_line = ''
-    for wig_name in wig_list:
-        for line in open(wig_name):
-            if line[0] not in "0123456789": continue
-            last_line = line
-        pos = int(last_line.split()[0])
-        T = max(T,pos)
+    wigs = read_wig_list(wig_list, nthreads)
+
+    # The last insertion site over all the replicates defines the size
+    for (pos, reads) in wigs:
+        if len(pos) > 0:
+            T = max(T, pos[-1])
 
     if T == 0:
         return (numpy.zeros((1,0)), numpy.zeros(0), [])
 
     data = numpy.zeros((K,T))
     position = numpy.array(range(T)) + 1#numpy.zeros(T)
-    for j,path in enumerate(wig_list):
-        reads = []
-        i = 0
-        for line in open(path):
-            if line[0] not in "0123456789": continue
-            tmp = line.split()
-            pos = int(tmp[0])
-            rd = float(tmp[1])
-            prev_pos = pos
-            data[j,pos-1] = rd
-            i+=1
+    for j,(pos, reads) in enumerate(wigs):
+        data[j,pos-1] = reads
     return (data, position)
 
 
-def get_data_w_genome(wig_list, genome):
+def get_data_w_genome(wig_list, genome, nthreads=1):
 
     X = read_genome(genome)
-    N = len(X)
-    positions = []
-    pos2index = {}
-    count = 0
-    for i in range(N-1):
-        if X[i:i+2].upper() == "TA":
-            pos = i+1
-            positions.append(pos)
-            pos2index[pos] = count
-            count +=1
-
-    positions = numpy.array(positions)
+    seq = numpy.frombuffer(X.upper().encode(), dtype="S1")
+    positions = numpy.flatnonzero((seq[:-1] == b"T") & (seq[1:] == b"A")) + 1
+
     T = len(positions)
     K = len(wig_list)
     data = numpy.zeros((K,T))
-    for j,path in enumerate(wig_list):
-        for line in open(path):
-            if line[0] not in "0123456789": continue
-            tmp = line.split()
-            pos = int(tmp[0])
-            rd = float(tmp[1])
-            if pos in pos2index:
-                index = pos2index[pos]
-                data[j,index] = rd
-            else:
-                print("Warning: Coordinate %d did not match a TA site in the genome. Ignoring counts." %(pos))
+    for j,(pos, reads) in enumerate(read_wig_list(wig_list, nthreads)):
+        index = numpy.minimum(numpy.searchsorted(positions, pos), max(T-1, 0))
+        matched = (positions[index] == pos) if T else numpy.zeros(len(pos), dtype=bool)
+        for p in pos[~matched]:
+            print("Warning: Coordinate %d did not match a TA site in the genome. Ignoring counts." %(p))
+        data[j,index[matched]] = reads[matched]
     return (data, positions)
 
 #
@@ -1204,6 +1356,214 @@ def get_extended_pos_hash_gff(path, N=None):
 
 
 
+class AnnotationIndex:
+    """Interval index of the genes in an annotation.
+
+    Answers the same queries as the dictionaries returned by get_pos_hash
+    ("genes at a coordinate", "genes in a range") from the sorted start and
+    end coordinates of the genes, using binary search, instead of storing an
+    entry for every nucleotide covered by a gene.
+
+    Attributes:
+        orfs: List of gene ids, in the order of the annotation.
+        starts: Numpy array with the start coordinate of each gene.
+        ends: Numpy array with the end coordinate of each gene.
+    """
+
+    def __init__(self, orfs, starts, ends):
+        self.orfs = list(orfs)
+        self.starts = numpy.array(starts, dtype=int)
+        self.ends = numpy.array(ends, dtype=int)
+        # Genes sorted by start; the running maximum of their ends bounds which
+        # of them can still overlap a coordinate to the right.
+        self.order = numpy.argsort(self.starts, kind="stable")
+        self.sorted_starts = self.starts[self.order]
+        self.max_ends = numpy.maximum.accumulate(self.ends[self.order]) if len(self.orfs) else self.ends
+
+    def __len__(self):
+        return len(self.orfs)
+
+    def _candidates(self, start, end):
+        # Indices (in annotation order) of the genes overlapping [start, end]
+        hi = numpy.searchsorted(self.sorted_starts, end, side="right")
+        lo = numpy.searchsorted(self.max_ends[:hi], start, side="left")
+        ii = self.order[lo:hi]
+        return numpy.sort(ii[self.ends[ii] >= start])
+
+    def genes_at(self, pos):
+        """Returns list of genes that occur at the given coordinate (same as get_pos_hash(path).get(pos, []))."""
+        return [self.orfs[i] for i in self._candidates(pos, pos)]
+
+    def genes_in_range(self, start, end):
+        """Returns sorted list of genes that overlap the given range of coordinates."""
+        return sorted(set([self.orfs[i] for i in self._candidates(start, end)]))
+
+    def site_ranges(self, position):
+        """Returns the range of sites inside each gene.
+
+        Arguments:
+            position (list): Sorted coordinates of the sites.
+
+        Returns:
+            tuple: Numpy arrays (lo, hi) such that position[lo[g]:hi[g]] are the sites in gene g.
+        """
+        position = numpy.asarray(position)
+        lo = numpy.searchsorted(position, self.starts, side="left")
+        hi = numpy.searchsorted(position, self.ends, side="right")
+        return (lo, hi)
+
+    def genes_at_positions(self, position):
+        """Returns a list with the genes that occur at each of the given sorted coordinates."""
+        genes = [[] for pos in position]
+        (lo, hi) = self.site_ranges(position)
+        for g,orf in enumerate(self.orfs):
+            for i in range(lo[g], hi[g]):
+                genes[i].append(orf)
+        return genes
+
+#
+
+def is_gff(path):
+    filename, file_extension = os.path.splitext(path)
+    return file_extension.lower() in [".gff", ".gff3"]
+
+#
+
+def parse_gff_features(column):
+    """Returns dictionary of the attributes in the 9th column of a GFF3 line."""
+    return dict([tuple(f.split("=",1)) for f in filter(lambda x: "=" in x, column.split(";"))])
+
+#
+
+class Annotation:
+    """Genes of an annotation (.prot_table or GFF3), parsed once into columns.
+
+    Use get_annotation(path) to share one parsed copy across a run; the
+    dictionaries and lists returned by get_gene_info, get_pos_hash and
+    read_genes are built from these columns. The columns should be treated
+    as read-only.
+
+    Attributes:
+        path: Path to the annotation.
+        orfs: List of gene ids, in the order of the annotation.
+        names: List of gene names.
+        descs: List of gene descriptions.
+        starts: Numpy array with the start coordinates.
+        ends: Numpy array with the end coordinates.
+        strands: List of strands ("+" or "-").
+        index: AnnotationIndex of the genes.
+    """
+
+    def __init__(self, path, format=None):
+        """Parses the annotation.
+
+        Arguments:
+            path (str): Path to annotation in .prot_table or GFF3 format.
+            format (str): "prot_table" or "gff"; by default, decided from the file extension.
+        """
+        self.path = path
+        if not format: format = "gff" if is_gff(path) else "prot_table"
+        self.format = format
+
+        orfs, names, descs, starts, ends, strands = [], [], [], [], [], []
+        for line in open(path):
+            if line.startswith("#"): continue
+            tmp = line.strip().split("\t")
+            if format == "gff":
+                features = parse_gff_features(tmp[8])
+                if "ID" not in features: continue
+                orf = features["ID"]
+                name = features.get("Name", "-")
+                if name == "-": name = features.get("name", "-")
+
+                desc = features.get("Description", "-")
+                if desc == "-": desc = features.get("description", "-")
+                if desc == "-": desc = features.get("Desc", "-")
+                if desc == "-": desc = features.get("desc", "-")
+                if desc == "-": desc = features.get("product", "-")
+                (start, end, strand) = (int(tmp[3]), int(tmp[4]), tmp[6])
+            else:
+                (orf, name, desc) = (tmp[8], tmp[7], tmp[0])
+                (start, end, strand) = (int(tmp[1]), int(tmp[2]), tmp[3])
+            orfs.append(orf); names.append(name); descs.append(desc)
+            starts.append(start); ends.append(end); strands.append(strand)
+
+        self.orfs = orfs
+        self.names = names
+        self.descs = descs
+        self.starts = numpy.array(starts, dtype=int)
+        self.ends = numpy.array(ends, dtype=int)
+        self.strands = strands
+        self.index = AnnotationIndex(orfs, self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.orfs)
+
+    def gene_info(self):
+        """Returns dictionary of gene id to (name, description, start, end, strand)."""
+        return dict([(orf, (name, desc, int(start), int(end), strand)) for (orf, name, desc, start, end, strand) in zip(self.orfs, self.names, self.descs, self.starts, self.ends, self.strands)])
+
+    def pos_hash(self):
+        """Returns dictionary of every coordinate inside a gene to the list of genes at that coordinate."""
+        hash = {}
+        for (orf, start, end) in zip(self.orfs, self.starts.tolist(), self.ends.tolist()):
+            for pos in range(start, end+1):
+                if pos not in hash: hash[pos] = []
+                hash[pos].append(orf)
+        return hash
+
+    def genes(self, descriptions=False):
+        """Returns list of genes as dictionaries with keys start, end, rv, gene, strand (and desc)."""
+        genes = []
+        for i,orf in enumerate(self.orfs):
+            data = {
+                    "start": int(self.starts[i]),
+                    "end": int(self.ends[i]),
+                    "rv": orf,
+                    "gene": self.names[i],
+                    "strand": self.strands[i]
+                    }
+            if descriptions==True: data["desc"] = self.descs[i]
+            genes.append(data)
+        return genes
+
+#
+
+@lru_cache(maxsize=8)
+def read_annotation(path, format, mtime, size):
+    # Cached by get_annotation; mtime and size make a modified file a new key
+    return Annotation(path, format)
+
+def get_annotation(path, format=None):
+    """Returns the parsed Annotation of the file, shared with previous calls
+    as long as the file has not changed.
+
+    Arguments:
+        path (str): Path to annotation in .prot_table or GFF3 format.
+        format (str): "prot_table" or "gff"; by default, decided from the file extension.
+
+    Returns:
+        Annotation: Parsed annotation.
+    """
+    if not format: format = "gff" if is_gff(path) else "prot_table"
+    stat = os.stat(path)
+    return read_annotation(os.path.abspath(path), format, stat.st_mtime_ns, stat.st_size)
+
+#
+
+def get_annotation_index(path):
+    """Returns an AnnotationIndex of the genes in the annotation.
+
+    Arguments:
+        path (str): Path to annotation in .prot_table or GFF3 format.
+
+    Returns:
+        AnnotationIndex: Index answering which genes occur at a coordinate or range.
+    """
+    return get_annotation(path).index
+
+#
+
 def get_pos_hash_pt(path):
     """Returns a dictionary that maps coordinates to a list of genes that occur at that coordinate.
 
@@ -1213,17 +1573,7 @@ def get_pos_hash_pt(path):
     Returns:
         dict: Dictionary of position to list of genes that share that position.
     """
-    hash = {}
-    for line in open(path):
-        if line.startswith("#"): continue
-        tmp = line.strip().split("\t")
-        orf = tmp[8]
-        start = int(tmp[1])
-        end = int(tmp[2])
-        for pos in range(start, end+1):
-            if pos not in hash: hash[pos] = []
-            hash[pos].append(orf)
-    return hash
+    return get_annotation(path, "prot_table").pos_hash()
 
 #
 
@@ -1236,21 +1586,7 @@ def get_pos_hash_gff(path):
     Returns:
         dict: Dictionary of position to list of genes that share that position.
     """
-    hash = {}
-    for line in open(path):
-        if line.startswith("#"): continue
-        tmp = line.strip().split("\t")
-        features = dict([tuple(f.split("=",1)) for f in filter(lambda x: "=" in x, tmp[8].split(";"))])
-        if "ID" not in features: continue
-        orf = features["ID"]
-        chr = tmp[0]
-        type = tmp[2]
-        start = int(tmp[3])
-        end = int(tmp[4])
-        for pos in range(start, end+1):
-            if pos not in hash: hash[pos] = []
-            hash[pos].append(orf)
-    return hash
+    return get_annotation(path, "gff").pos_hash()
 
 #
 
@@ -1263,11 +1599,7 @@ def get_pos_hash(path):
     Returns:
         dict: Dictionary of position to list of genes that share that position.
     """
-    filename, file_extension = os.path.splitext(path)
-    if file_extension.lower() in [".gff", ".gff3"]:
-        return get_pos_hash_gff(path)
-    else:
-        return get_pos_hash_pt(path)
+    return get_annotation(path).pos_hash()
 
 #
 
@@ -1286,18 +1618,7 @@ def get_gene_info_pt(path):
             - strand
 
     """
-    orf2info = {}
-    for line in open(path):
-        if line.startswith("#"): continue
-        tmp = line.strip().split("\t")
-        orf = tmp[8]
-        name = tmp[7]
-        desc = tmp[0]
-        start = int(tmp[1])
-        end = int(tmp[2])
-        strand = tmp[3]
-        orf2info[orf] = (name, desc, start, end, strand)
-    return orf2info
+    return get_annotation(path, "prot_table").gene_info()
 
 #
 
@@ -1316,30 +1637,7 @@ def get_gene_info_gff(path):
             - strand
 
     """
-    orf2info = {}
-    for line in open(path):
-        if line.startswith("#"): continue
-        tmp = line.strip().split("\t")
-        chr = tmp[0]
-        type = tmp[2]
-        start = int(tmp[3])
-        end = int(tmp[4])
-        length = ((end-start+1)/3)-1
-        strand = tmp[6]
-        features = dict([tuple(f.split("=",1)) for f in filter(lambda x: "=" in x, tmp[8].split(";"))])
-        if "ID" not in features: continue
-        orf = features["ID"]
-        name = features.get("Name", "-")
-        if name == "-": name = features.get("name", "-")
-
-        desc = features.get("Description", "-")
-        if desc == "-": desc = features.get("description", "-")
-        if desc == "-": desc = features.get("Desc", "-")
-        if desc == "-": desc = features.get("desc", "-")
-        if desc == "-": desc = features.get("product", "-")
-
-        orf2info[orf] = (name, desc, start, end, strand)
-    return orf2info
+    return get_annotation(path, "gff").gene_info()
 
 #
 
@@ -1358,11 +1656,7 @@ def get_gene_info(path):
             - strand
 
     """
-    filename, file_extension = os.path.splitext(path)
-    if file_extension.lower() in [".gff", ".gff3"]:
-        return get_gene_info_gff(path)
-    else:
-        return get_gene_info_pt(path)
+    return get_annotation(path).gene_info()
 
 #
 
@@ -1489,17 +1783,7 @@ def ExpectedRuns(n,pnon):
 
     """
     if n<20: # use exact calculation for genes with less than 20 TA sites
-      # Eqn 17-20 in Boyd, https://www.math.ubc.ca/~boyd/bern.runs/bernoulli.html
-      #  recurrence relations for F(n,k) = prob that max run has length k
-      p,q = 1-pnon,pnon
-      F = numpy.ones((n+1,n+1))
-      for k in range(n): F[k+1,k] = 1-numpy.power(q,k+1)
-      for k in range(n+1):
-        for n in range(n+1):
-          if n>=k+2: F[n,k] = F[n-1,k]-p*numpy.power(q,k+1)*F[n-k-2,k]
-      ERn = 0
-      for k in range(1,n+1): ERn += k*(F[n,k]-F[n,k-1])
-      return ERn
+      return ExpectedRuns_table(n, pnon)[n]
 
     pins = 1-pnon
     gamma = getGamma()
@@ -1512,6 +1796,33 @@ def ExpectedRuns(n,pnon):
 
 #
 
+def ExpectedRuns_table(nmax, pnon):
+    """Exact expected value of the maximum run of non-insertions, for every
+    number of sites from 0 to nmax, using the recurrence in Boyd (Eqn 17-20).
+
+    Arguments:
+        nmax (int): Largest number of sites.
+        pnon (float): Floating point number representing the probability of non-insertion.
+
+    Returns:
+        numpy.ndarray: Array of size nmax+1 with the expected maximum run for each n.
+
+    """
+    # Eqn 17-20 in Boyd, https://www.math.ubc.ca/~boyd/bern.runs/bernoulli.html
+    #  recurrence relations for F(n,k) = prob that max run has length <= k
+    p,q = 1-pnon,pnon
+    F = numpy.ones((nmax+1,nmax+1))
+    k = numpy.arange(nmax+1)
+    qk = numpy.power(q,k+1)
+    F[k[:-1]+1,k[:-1]] = 1-qk[:-1]
+    for n in range(2,nmax+1):
+      kk = k[:n-1] # all k with n>=k+2
+      F[n,kk] = F[n-1,kk]-p*qk[kk]*F[n-kk-2,kk]
+    # F[n,k]-F[n,k-1] is 0 for k>n, so the sums can run over all k
+    return numpy.sum(k[1:]*(F[:,1:]-F[:,:-1]), axis=1)
+
+#
+
 def VarR(n,pnon):
     """Variance of the expected run of non-insertons (Schilling, 1990):
 
@@ -1629,7 +1940,7 @@ def get_genes_in_range(pos_hash, start, end):
     """Returns list of genes that occur in a given range of coordinates.
 
     Arguments:
-        pos_hash (dict): Dictionary of position to list of genes.
+        pos_hash (AnnotationIndex): Index of the genes (or dictionary of position to list of genes).
         start (int): Start coordinate of the desired range.
         end (int): End coordinate of the desired range.
 
@@ -1638,6 +1949,9 @@ def get_genes_in_range(pos_hash, start, end):
 
     """
 
+    if isinstance(pos_hash, AnnotationIndex):
+        return pos_hash.genes_in_range(start, end)
+
     genes = set()
     for pos in range(start, end + 1):
         if pos in pos_hash:
@@ -431,7 +431,7 @@ def convertToCombinedWig(dataset_list, annotationPath, outputPath, normchoice="n
     (fulldata, factors) = norm_tools.normalize_data(fulldata, normchoice, dataset_list, annotationPath)
     position = position.astype(int)
 
-    hash = get_pos_hash(annotationPath)
+    genes_at_positions = tnseq_tools.get_annotation_index(annotationPath).genes_at_positions(position)
     rv2info = get_gene_info(annotationPath)
 
     output = open(outputPath, "w")
@@ -450,7 +450,7 @@ def convertToCombinedWig(dataset_list, annotationPath, outputPath, normchoice="n
 
     for i,pos in enumerate(position):
         #output.write("%-10d %s  %s\n" % (position[i], "".join(["%7.1f" % c for c in fulldata[:,i]]),",".join(["%s (%s)" % (orf,rv2info.get(orf,["-"])[0]) for orf in hash.get(position[i], [])])   ))
-        output.write("%d\t%s\t%s\n" % (position[i], "\t".join(["%1.1f" % c for c in fulldata[:,i]]),",".join(["%s (%s)" % (orf,rv2info.get(orf,["-"])[0]) for orf in hash.get(position[i], [])])   ))
+        output.write("%d\t%s\t%s\n" % (position[i], "\t".join(["%1.1f" % c for c in fulldata[:,i]]),",".join(["%s (%s)" % (orf,rv2info.get(orf,["-"])[0]) for orf in genes_at_positions[i]])   ))
     output.close()
 
 
@@ -498,13 +498,14 @@ def convertToGeneCountSummary(dataset_list, annotationPath, outputPath, normchoi
 
 
 
-def get_validated_data(wig_list, wxobj=None):
+def get_validated_data(wig_list, wxobj=None, nthreads=1):
     """ Returns a tuple of (data, position) containing a matrix of raw read-counts
         , and list of coordinates. 
 
     Arguments:
         wig_list (list): List of paths to wig files.
         wxobj (object): wxPython GUI object for warnings
+        nthreads (int): Number of threads used to read the files concurrently.
 
     Returns:
         tuple: Two lists containing data and positions of the wig files given.
@@ -524,13 +525,13 @@ def get_validated_data(wig_list, wxobj=None):
 
     # Regular file with empty sites
     if status == 0:
-        return tnseq_tools.get_data(wig_list)    
+        return tnseq_tools.get_data(wig_list, nthreads)
     # No empty sites, decided to proceed as Himar1
     elif status == 1:
-        return tnseq_tools.get_data_w_genome(wig_list, genome)
+        return tnseq_tools.get_data_w_genome(wig_list, genome, nthreads)
     # No empty sites, decided to proceed as Tn5
     elif status == 2:
-        return tnseq_tools.get_data_zero_fill(wig_list)
+        return tnseq_tools.get_data_zero_fill(wig_list, nthreads)
     # Didn't choose either.... what!?
     else:
         return tnseq_tools.get_data([])
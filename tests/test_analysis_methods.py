@@ -47,12 +47,31 @@ class TestMethods(TransitTestCase):
         G.Run()
         self.assertTrue(os.path.exists(output))
 
+    def test_Gumbel_chains(self):
+        args = [ctrl_data_txt, small_annotation, output, "-s", "1000", "-b", "100", "-chains", "2"]
+        G = GumbelMethod.fromargs(args)
+        G.Run()
+        header = [line for line in open(output) if line.startswith("#")]
+        self.assertTrue(any([line.startswith("#phi R-hat:") for line in header]))
+        self.assertTrue("#Sample Size:\t998\n" in header) # 2 x 500 draws, less the starting values
+
     def test_Binomial(self):
         args = [ctrl_data_txt, small_annotation, output, "-s", "1000", "-b", "100"]
         G = BinomialMethod.fromargs(args)
         G.Run()
         self.assertTrue(os.path.exists(output))
 
+    def test_Binomial_densities(self):
+        import numpy, scipy.stats
+        from pytransit.analysis import binomial
+        x = numpy.random.beta(0.5, 2.0, 100)
+        for (a, b) in [(0.5, 2.0), (3.0, 0.7)]:
+            expected = numpy.sum(numpy.log(scipy.stats.beta.pdf(x, a, b)))
+            self.assertAlmostEqual(binomial.beta_loglik(a, b, len(x), numpy.sum(numpy.log(x)), numpy.sum(numpy.log1p(-x))), expected, places=6)
+            self.assertAlmostEqual(binomial.beta_logpdf(x[0], a, b), numpy.log(scipy.stats.beta.pdf(x[0], a, b)))
+        self.assertAlmostEqual(binomial.gamma_logpdf(3.5, 10.0, 1.0), numpy.log(scipy.stats.gamma.pdf(3.5, 10.0, 1.0)))
+        self.assertEqual(binomial.gamma_logpdf(0.5, 10.0, 1.0), -numpy.inf)
+
     def test_Griffin(self):
         args = [ctrl_data_txt, small_annotation, output, "-s", "1000", "-b", "100"]
         G = GriffinMethod.fromargs(args)
@@ -67,6 +86,50 @@ class TestMethods(TransitTestCase):
         genes_path = output.rsplit(".", 1)[0] + "_genes." + output.rsplit(".", 1)[1]
         self.assertTrue(os.path.exists(genes_path))
 
+    def test_HMM_product(self):
+        args = [ctrl_data_txt, small_annotation, output, "-r", "Product"]
+        G = HMMMethod.fromargs(args)
+        G.Run()
+        self.assertTrue(os.path.exists(output))
+
+        import numpy, scipy.stats
+        B = [scipy.stats.geom(p).pmf for p in [0.99, 0.1, 0.01]]
+        O = numpy.random.geometric(0.05, (3, 50))
+        logb = G.log_emission_matrix(B, O)
+        self.assertEqual(logb.shape, (3, 50))
+        self.assertTrue(numpy.allclose(logb, sum([G.log_emission_matrix(B, O[k]) for k in range(3)])))
+
+    def test_HMM_baum_welch(self):
+        args = [mini_wig, small_annotation, output, "-bw", "5"]
+        G = HMMMethod.fromargs(args)
+        G.Run()
+        self.assertTrue("# Baum-Welch iterations:\t" in open(output).read())
+
+        import numpy
+        numpy.random.seed(0)
+        O = numpy.concatenate([numpy.random.geometric(0.01, 2000), numpy.ones(500), numpy.random.geometric(0.01, 2000)])
+        A = numpy.full((4, 4), 0.01) + numpy.eye(4)*0.96
+        (A, L, PI, iterations) = G.baum_welch(A, numpy.array([0.99, 0.2, 0.05, 0.001]), numpy.ones(4)/4.0, O, 50)
+        self.assertGreater(iterations, 1)
+        self.assertTrue(numpy.allclose(A.sum(1), 1.0))
+        self.assertTrue(numpy.min(numpy.abs(L - 0.01)) < 0.002)
+
+    def test_HMM_kernels(self):
+        import itertools, numpy
+        from pytransit.analysis import hmm
+        numpy.random.seed(0)
+        (T, N) = (6, 3)
+        A = numpy.random.dirichlet(numpy.ones(N), N)
+        b = numpy.random.random((T, N))
+        PI = numpy.random.dirichlet(numpy.ones(N))
+        paths = numpy.array(list(itertools.product(range(N), repeat=T)))
+        probs = numpy.array([PI[q[0]] * b[0, q[0]] * numpy.prod([A[q[t-1], q[t]] * b[t, q[t]] for t in range(1, T)]) for q in paths])
+
+        (alpha, C) = hmm.forward_kernel(A, b, PI)
+        self.assertAlmostEqual(-numpy.sum(numpy.log(C)), numpy.log(probs.sum()))
+        (Q_opt, delta, Q) = hmm.viterbi_kernel(numpy.log(A), numpy.log(b), numpy.log(PI))
+        self.assertEqual(Q_opt.tolist(), paths[probs.argmax()].tolist())
+
 
     def test_resampling(self):
         args = [ctrl_data_txt, exp_data_txt, small_annotation, output, "-l"]
@@ -133,6 +196,20 @@ class TestMethods(TransitTestCase):
                 os.path.isdir(hist_path),
                 "histpath expected: %s" % (hist_path))
 
+    def test_resampling_cpus(self):
+        args = [ctrl_data_txt, exp_data_txt, small_annotation, output, "-s", "1000", "-h", "-cpus", "2"]
+        G = ResamplingMethod.fromargs(args)
+        G.Run()
+        self.assertTrue(os.path.exists(output))
+        self.assertTrue(
+                os.path.isdir(hist_path),
+                "histpath expected: %s" % (hist_path))
+        (sig_pvals, sig_qvals) = (significant_pvals_qvals(output, pcol=-2, qcol=-1))
+        self.assertLessEqual(
+                abs(len(sig_pvals) - 37),
+                3,
+                "sig_pvals expected in range: %s, actual: %d" % ("[34, 40]", len(sig_pvals)))
+
     def test_anova(self):
         args = [combined_wig, samples_metadata, small_annotation, output]
         G = AnovaMethod.fromargs(args)
@@ -149,6 +226,29 @@ class TestMethods(TransitTestCase):
             24,
             "sig_qvals expected: %d, actual: %d" % (24, len(sig_qvals)))
 
+    def test_anova_segments(self):
+        import numpy, scipy.stats
+        numpy.random.seed(0)
+        data = numpy.random.poisson(3, (5, 40)).astype(float)
+        conditions = ["A", "A", "B", "B", "B"]
+        RvSiteindexesMap = {"g1": list(range(0, 10)), "g2": [], "g3": list(range(10, 11)), "g4": list(range(11, 40))}
+        genes = [{"rv": rv} for rv in RvSiteindexesMap]
+        G = AnovaMethod.__new__(AnovaMethod)
+        (G.winz, G.alpha) = (False, 0)
+        G.progress_range = G.progress_update = lambda *args: None
+        MeansByRv = G.means_by_rv(data, RvSiteindexesMap, genes, conditions)
+        (msr, mse, Fstats, pvals, qvals, status) = G.run_anova(data, genes, MeansByRv, RvSiteindexesMap, conditions)
+
+        for rv in ["g1", "g4"]:
+            groups = [data[:2, RvSiteindexesMap[rv]].flatten(), data[2:, RvSiteindexesMap[rv]].flatten()]
+            (F, p) = scipy.stats.f_oneway(*groups)
+            self.assertAlmostEqual(Fstats[rv], F)
+            self.assertAlmostEqual(pvals[rv], p)
+            self.assertAlmostEqual(MeansByRv[rv]["B"], numpy.mean(G.winsorize(data[2:, RvSiteindexesMap[rv]])))
+        self.assertEqual(status["g2"], "TA sites <= 1")
+        self.assertEqual(status["g3"], "TA sites <= 1")
+        self.assertEqual(MeansByRv["g2"]["A"], 0)
+
     @unittest.skipUnless(hasR, "requires R, rpy2")
     def test_zinb(self):
         args = [combined_wig, samples_metadata, small_annotation, output]
@@ -166,6 +266,15 @@ class TestMethods(TransitTestCase):
             30,
             "sig_qvals expected: %d, actual: %d" % (30, len(sig_qvals)))
 
+    @unittest.skipUnless(hasR, "requires R, rpy2")
+    def test_zinb_cpus(self):
+        args = [combined_wig, samples_metadata, small_annotation, output]
+        ZinbMethod.fromargs(args).Run()
+        serial = [line for line in open(output) if not line.startswith("#")]
+        ZinbMethod.fromargs(args + ["-cpus", "2"]).Run()
+        parallel = [line for line in open(output) if not line.startswith("#")]
+        self.assertEqual(serial, parallel)
+
     @unittest.skipUnless(hasR, "requires R, rpy2")
     def test_zinb_covariates(self):
         args = [combined_wig, samples_metadata_covariates, small_annotation, output, "--covars", "batch", "--condition", "NewConditionCol"]
@@ -200,6 +309,40 @@ class TestMethods(TransitTestCase):
             0,
             "sig_qvals expected: %d, actual: %d" % (0, len(sig_qvals)))
 
+    def test_zinb_python_engine(self):
+        args = [combined_wig, samples_metadata, small_annotation, output, "-engine", "python"]
+        ZinbMethod.fromargs(args).Run()
+        (sig_pvals, sig_qvals) = (significant_pvals_qvals(output, pcol=-3, qcol=-2))
+        self.assertLessEqual(
+                abs(len(sig_pvals) - 31),
+                3,
+                "sig_pvals expected in range: %s, actual: %d" % ("[28, 34]", len(sig_pvals)))
+        self.assertLessEqual(
+                abs(len(sig_qvals) - 30),
+                3,
+                "sig_qvals expected in range: %s, actual: %d" % ("[27, 33]", len(sig_qvals)))
+
+        serial = [line for line in open(output) if not line.startswith("#")]
+        ZinbMethod.fromargs(args + ["-cpus", "2"]).Run()
+        parallel = [line for line in open(output) if not line.startswith("#")]
+        self.assertEqual(serial, parallel)
+
+    @unittest.skipUnless(hasR, "requires R, rpy2")
+    def test_zinb_python_engine_matches_R(self):
+        def significant_genes():
+            rows = [line.split("\t") for line in open(output) if not line.startswith("#")]
+            return set([cols[0] for cols in rows if float(cols[-2]) < 0.05]) # padj
+        args = [combined_wig, samples_metadata, small_annotation, output]
+        ZinbMethod.fromargs(args).Run()
+        calls_R = significant_genes()
+        ZinbMethod.fromargs(args + ["-engine", "python"]).Run()
+        calls_python = significant_genes()
+        # the two optimizers may only disagree on genes near the threshold
+        self.assertLessEqual(
+                len(calls_R ^ calls_python),
+                3,
+                "genes called by only one engine: %s" % sorted(calls_R ^ calls_python))
+
     def test_utest(self):
         args = [ctrl_data_txt, exp_data_txt, small_annotation, output]
         G = UTestMethod.fromargs(args)
@@ -26,6 +26,25 @@ class TestTnSeqTools(TransitTestCase):
         self.assertEqual(K, 5)
         self.assertGreater(N, 70000)
 
+    def test_read_data_threaded(self):
+        data,position = tnseq_tools.get_data(all_data_list)
+        data_t,position_t = tnseq_tools.get_data(all_data_list, nthreads=3)
+        self.assertTrue((data == data_t).all())
+        self.assertTrue((position == position_t).all())
+
+        position_1,reads_1 = tnseq_tools.read_wig(ctrl_rep1)
+        self.assertTrue((position_1 == position).all())
+        self.assertTrue((reads_1 == data[0]).all())
+
+    def test_read_combined_wig_cache(self):
+        (sites, data, files) = tnseq_tools.read_combined_wig(combined_wig)
+        self.assertTrue(os.path.exists(tnseq_tools.get_data_cache_path(combined_wig)))
+        (sites_c, data_c, files_c) = tnseq_tools.read_combined_wig(combined_wig)
+        self.assertEqual(files, files_c)
+        self.assertTrue((sites == sites_c).all())
+        self.assertTrue((data == data_c).all())
+        self.assertEqual(data.shape, (len(files), len(sites)))
+
     def test_genes_creation_fromwig(self):
         G = tnseq_tools.Genes(all_data_list, annotation)
         N = len(G)
@@ -62,6 +81,66 @@ class TestTnSeqTools(TransitTestCase):
         self.assertEqual(G[0].name, test_name)
 
 
+    def test_genes_statistics(self):
+        numpy.random.seed(0)
+        data = numpy.random.poisson(0.5, (2, 200)) * (numpy.random.random(200) < 0.3)
+        position = numpy.cumsum(numpy.random.randint(1, 50, 200))
+        (lo, hi) = ([0, 5, 5, 50, 120], [5, 5, 40, 200, 121])
+        (offsets, index, owner) = tnseq_tools.concatenated_ranges(lo, hi)
+        stats = tnseq_tools.gene_statistics(tnseq_tools.tossify(data), position, offsets, index, owner)
+        for g in range(len(lo)):
+            if lo[g] == hi[g]: gene = tnseq_tools.Gene("g", "g", "", numpy.array([[]]), [])
+            else: gene = tnseq_tools.Gene("g", "g", "", data[:, lo[g]:hi[g]], position[lo[g]:hi[g]])
+            self.assertEqual(tuple(x[g] for x in stats), (gene.k, gene.n, gene.r, gene.s, gene.t))
+
+        G = tnseq_tools.Genes([], annotation, data=data.astype(float), position=position)
+        self.assertTrue((G.local_insertions() == [g.k for g in G]).all())
+        self.assertTrue((G.local_runs() == [g.r for g in G]).all())
+
+    def test_rv_siteindexes_ranges(self):
+        sites = numpy.arange(2, 400, 7)
+        genes = [{"rv": "A", "start": 10, "end": 100, "strand": "+"},
+                 {"rv": "B", "start": 50, "end": 300, "strand": "-"},
+                 {"rv": "C", "start": 101, "end": 102, "strand": "+"}]
+        for (nterm, cterm) in [(0, 0), (10, 5), (50, 50)]:
+            (lo, hi) = tnseq_tools.rv_siteindexes_ranges(genes, sites, nterm, cterm)
+            RvSiteindexesMap = tnseq_tools.rv_siteindexes_map(genes, {TA: i for i, TA in enumerate(sites)}, nterm, cterm)
+            for g, gene in enumerate(genes):
+                start = gene["start"] if gene["strand"] == "+" else gene["start"] + 3
+                end = gene["end"] - 3 if gene["strand"] == "+" else gene["end"]
+                expected = [i for i, TA in enumerate(sites) if start <= TA <= end and nterm/100.0 <= (TA-start)/float(end-start) <= (100-cterm)/100.0]
+                self.assertEqual(list(range(lo[g], hi[g])), expected)
+                self.assertEqual(RvSiteindexesMap[gene["rv"]], expected)
+
+    def test_annotation_index(self):
+        index = tnseq_tools.get_annotation_index(annotation)
+        pos_hash = tnseq_tools.get_pos_hash(small_annotation)
+        small_index = tnseq_tools.get_annotation_index(small_annotation)
+        for pos in range(1, max(pos_hash)+100, 97):
+            self.assertEqual(small_index.genes_at(pos), pos_hash.get(pos, []))
+        self.assertEqual(index.genes_at(1), ["Rv0001"])
+        self.assertEqual(index.genes_in_range(1, 4000), ["Rv0001", "Rv0002", "Rv0003"])
+        (start, end) = (min(pos_hash), max(pos_hash))
+        self.assertEqual(tnseq_tools.get_genes_in_range(small_index, start, end), tnseq_tools.get_genes_in_range(pos_hash, start, end))
+
+        data,position = tnseq_tools.get_data(all_data_list)
+        genes = index.genes_at_positions(position)
+        self.assertEqual(len(genes), len(position))
+        self.assertEqual(genes[0], index.genes_at(position[0]))
+
+    def test_annotation_cache(self):
+        A = tnseq_tools.get_annotation(small_annotation)
+        self.assertIs(tnseq_tools.get_annotation(small_annotation), A)
+        self.assertEqual(len(A), len(tnseq_tools.get_gene_info(small_annotation)))
+        genes = tnseq_tools.read_genes(small_annotation, descriptions=True)
+        self.assertEqual([g["rv"] for g in genes], A.orfs)
+        self.assertEqual(genes[0]["desc"], A.descs[0])
+
+        # Mutating a view does not change the cached copy
+        orf2info = tnseq_tools.get_gene_info(small_annotation)
+        orf2info.clear()
+        self.assertEqual(len(tnseq_tools.get_gene_info(small_annotation)), len(A))
+
     def test_file_types(self):
         types = tnseq_tools.get_file_types(all_data_list)
         types = set(types)
@@ -76,6 +155,101 @@ class TestTnSeqTools(TransitTestCase):
         norm_data,factors = norm_tools.normalize_data(data, "TTR")
         self.assertFalse((factors == numpy.ones(N)).all())
 
+#
+
+    def test_resampling_batched(self):
+        numpy.random.seed(0)
+        data1 = numpy.random.poisson(5, (2, 20)).astype(float)
+        data2 = numpy.random.poisson(50, (3, 20)).astype(float)
+        (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail, pval_2tail, testlist) = stat_tools.resampling(data1, data2, S=1000)
+        self.assertEqual(len(testlist), 1000)
+        self.assertAlmostEqual(test_obs, numpy.mean(data2) - numpy.mean(data1))
+        self.assertEqual(pval_2tail, 0.0)
+        self.assertEqual(pval_ltail, 1.0)
+
+        (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail, pval_2tail, testlist) = stat_tools.resampling(data1, data1, S=1000, adaptive=True)
+        self.assertEqual(len(testlist), 10)
+
+        (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail, pval_2tail, testlist) = stat_tools.resampling(data1, data2[:2], S=1000, site_restricted=True)
+        self.assertEqual(len(testlist), 1000)
+        self.assertEqual(pval_2tail, 0.0)
+
+#
+
+    def test_rank_product_null_counts(self):
+        obsRP = numpy.array([1.0, 2.5, 3.0, 4.2, 6.0])
+        numpy.random.seed(0)
+        counts = stat_tools.rank_product_null_counts(obsRP, 2, 50, max_block_size=30)
+        numpy.random.seed(0)
+        permutations = numpy.vstack([numpy.power(numpy.prod(numpy.argsort(numpy.random.random((3, 2, 5)), axis=2) + 1, axis=1), 0.5) for b in range(17)])[:50]
+        self.assertEqual(list(counts), [numpy.sum(permutations <= x) for x in obsRP])
+        self.assertEqual(counts[-1], 50*5)
+
+#
+
+    def test_mannwhitneyu_segments(self):
+        import scipy.stats
+        numpy.random.seed(0)
+        sizes = [3, 12, 30, 40, 7]
+        owner = numpy.repeat(numpy.arange(len(sizes)), sizes)
+        values = numpy.random.poisson(2, len(owner)).astype(float)
+        values[owner == 4] = numpy.random.random(7) # no ties: exact test
+        first = numpy.random.random(len(owner)) < 0.5
+        first[owner == 0] = True # empty second sample
+        (U, pvals) = stat_tools.mannwhitneyu_segments(values, first, owner, len(sizes))
+        self.assertEqual((U[0], pvals[0]), (0.0, 1.0))
+        for i in range(1, len(sizes)):
+            (u, p) = scipy.stats.mannwhitneyu(values[(owner == i) & first], values[(owner == i) & ~first], alternative="two-sided")
+            self.assertAlmostEqual(U[i], u)
+            self.assertAlmostEqual(pvals[i], p)
+
+#
+
+    def test_posterior_batch(self):
+        numpy.random.seed(0)
+        samples = numpy.random.gamma(2.0, 1.0, (5, 101))
+        (HDImin, HDImax) = stat_tools.HDI_from_MCMC_batch(samples, 0.9)
+        for i in range(5):
+            ordered = numpy.sort(samples[i])
+            widths = ordered[91:] - ordered[:10]
+            self.assertEqual((HDImin[i], HDImax[i]), (ordered[numpy.argmin(widths)], ordered[numpy.argmin(widths)+91]))
+            self.assertEqual(stat_tools.HDI_from_MCMC(samples[i], 0.9), (HDImin[i], HDImax[i]))
+
+        data = numpy.random.poisson(20, 30)
+        (mu_post, s2_post) = stat_tools.sample_trunc_norm_post_batch([30, 1], [numpy.mean(data), 5], [numpy.var(data, ddof=1), numpy.nan], 20000, 10.0, 50.0, 1.0, 1.0)
+        self.assertEqual(mu_post.shape, (2, 20000))
+        self.assertAlmostEqual(numpy.mean(mu_post[0]), (10.0 + 30*numpy.mean(data))/31, places=0)
+        self.assertTrue((mu_post[0] >= 0).all())
+        self.assertTrue(numpy.isnan(mu_post[1]).all())
+
+#
+
+    def test_expected_runs_table(self):
+        def expected_runs(n, q):
+            # the original recurrence, one n at a time (Boyd, Eqn 17-20)
+            p = 1-q
+            F = numpy.ones((n+1, n+1))
+            for k in range(n): F[k+1,k] = 1-q**(k+1)
+            for k in range(n+1):
+                for m in range(k+2, n+1): F[m,k] = F[m-1,k]-p*q**(k+1)*F[m-k-2,k]
+            return sum([k*(F[n,k]-F[n,k-1]) for k in range(1, n+1)])
+        for q in [0.05, 0.3, 0.7, 0.95]:
+            table = tnseq_tools.ExpectedRuns_table(19, q)
+            self.assertAlmostEqual(table[1], q)
+            self.assertAlmostEqual(table[2], (1 - (1-q)**2) + q**2)
+            for n in range(20):
+                self.assertAlmostEqual(table[n], expected_runs(n, q), places=12)
+
+#
+
+    def test_mcmc_diagnostics(self):
+        numpy.random.seed(0)
+        chains = numpy.random.normal(size=(4, 1000))
+        self.assertAlmostEqual(stat_tools.rhat(chains), 1.0, places=2)
+        self.assertGreater(stat_tools.effective_sample_size(chains), 3000)
+        self.assertGreater(stat_tools.rhat(chains + numpy.arange(4)[:,None]), 1.1)
+        self.assertLess(stat_tools.effective_sample_size(numpy.cumsum(chains, axis=1)), 100)
+
 #
 
     def test_cleanargs_negative_arguments(self):
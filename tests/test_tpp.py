@@ -7,10 +7,13 @@ sys.path.insert(0, basedir + '/../src/')
 #sys.path.insert(0, '/home/travis/build/mad-lab/transit/src/')
 
 import shutil
+import random
 import unittest
 
 from transit_test import *
-from pytpp.tpp_tools import cleanargs
+from pytpp.tpp_tools import cleanargs, Globals, initialize_globals, extract_reads, read_records
+from pytpp.tpp_tools import mmfind1, mmfind3, mmfind_batch
+from pytpp.tpp_tools import read_counts, template_counts, bwa_sam_lines, open_reads, generate_output
 
 import pytpp.__main__
 
@@ -152,6 +155,111 @@ class TestTPP(TransitTestCase):
         tppMain(*args, **kwargs)
         self.assertTrue(verify_stats("{0}.tn_stats".format(tpp_output_base), MULTICONTIG_AUTO_IDS))
 
+    def test_extract_reads_paired_gzip(self):
+        (args, kwargs) = cleanargs(["-reads1", test_multicontig_reads1, "-reads2", test_multicontig_reads2, "-output", tpp_output_base, "-gzip"])
+        vars = Globals()
+        initialize_globals(vars, args, kwargs)
+        vars.single_end = False
+        vars.trimmed1 = tpp_output_base + ".trimmed1.gz"
+        vars.genomic2 = tpp_output_base + ".genomic2.gz"
+        vars.barcodes1 = tpp_output_base + ".barcodes1"
+        extract_reads(vars)
+        self.assertEqual((vars.tot_reads, vars.tot_tgtta, vars.read_length), (2500, 2402, 125))
+        # no intermediate files without -debug
+        self.assertFalse(os.path.exists(tpp_output_base + ".reads1"))
+        trimmed = list(read_records(vars.trimmed1))
+        genomic = list(read_records(vars.genomic2))
+        self.assertEqual(len(trimmed), vars.tot_tgtta)
+        self.assertEqual([h for (h, s) in trimmed], [h for (h, s) in genomic])
+        self.assertEqual(len(list(read_records(vars.barcodes1, maxreads=10))), 10)
+
+    def test_extract_reads_cpus(self):
+        trimmed = []
+        for cpus in ["1", "2"]:
+            (args, kwargs) = cleanargs(["-reads1", reads1, "-output", tpp_output_base, "-cpus", cpus])
+            vars = Globals()
+            initialize_globals(vars, args, kwargs)
+            vars.single_end = True
+            vars.trimmed1 = tpp_output_base + ".trimmed1"
+            extract_reads(vars)
+            self.assertEqual((vars.tot_reads, vars.tot_tgtta, vars.truncated_reads), (1000, 983, 28))
+            trimmed.append(list(read_records(vars.trimmed1)))
+        self.assertEqual(trimmed[0], trimmed[1])
+
+    def test_mmfind_bit_parallel(self):
+        rng = random.Random(0)
+        for trial in range(500):
+            m, mismatches = rng.randint(1, 32), rng.randint(0, 3)
+            H = "".join(rng.choice("ACGT") for i in range(m))
+            reads = []
+            for r in range(10):
+                G = [rng.choice("ACGTN") for i in range(rng.randint(0, 60))]
+                if len(G) >= m: # plant a copy of H with a few substitutions
+                    i = rng.randint(0, len(G) - m)
+                    G[i:i+m] = H
+                    for k in range(rng.randint(0, 4)): G[i + rng.randrange(m)] = rng.choice("ACGTN")
+                reads.append("".join(G))
+            expected = [mmfind1(G, len(G), H, m, mismatches) for G in reads]
+            self.assertEqual([mmfind3(G, len(G), H, m, mismatches) for G in reads], expected)
+            self.assertEqual(list(mmfind_batch(reads, H, mismatches)), expected)
+            n = rng.randint(0, len(reads[0]))
+            self.assertEqual(mmfind3(reads[0], n, H, m, mismatches), mmfind1(reads[0], n, H, m, mismatches))
+
+    def test_read_counts_from_bwa_stream(self):
+        ref, sam = tpp_output_base + ".fna", tpp_output_base + ".sam"
+        with open(ref, "w") as f: f.write(">chr\nGGTAACCGTAGGTACC\n") # TAs at 3, 9 and 13
+        lines = ["@SQ\tSN:chr\tLN:16\n",
+                 "r1\t0\tchr\t5\t60\t5M\t*\t0\t0\tACCGT\tIIIII\n",
+                 "r2\t16\tchr\t4\t60\t5M\t*\t0\t0\tAACCG\tIIIII\n",
+                 "r3\t4\t*\t0\t0\t*\t*\t0\t0\tACGTA\tIIIII\n"]
+        with open(sam, "w") as f: f.write("".join(lines))
+        vars = Globals()
+        vars.num_replicons, vars.transposon, vars.protocol = 1, "Himar1", "Sassetti"
+        expected = [[[3, 1, 1, 0, 0, 1, 1], [9, 0, 0, 1, 1, 1, 1], [13, 0, 0, 0, 0, 0, 0]]]
+        self.assertEqual([c.tolist() for c in read_counts(ref, sam, vars)], expected)
+        # counting as the "aligner" writes its output, keeping a gzipped copy
+        self.assertEqual([c.tolist() for c in read_counts(ref, bwa_sam_lines(["cat", sam], sam + ".gz"), vars)], expected)
+        self.assertEqual((vars.tot_tgtta, vars.mapped), (3, 2))
+        self.assertEqual(open_reads(sam + ".gz").readlines(), lines)
+
+    def test_template_counts_dedup(self):
+        ref, sam, bcfile = tpp_output_base + ".fna", tpp_output_base + ".sam", tpp_output_base + ".barcodes1"
+        with open(ref, "w") as f: f.write(">chr\nGGTAACCGTAGGTACC\n") # TAs at 3, 9 and 13
+        with open(bcfile, "w") as f: f.write(">r1\nAAAA\n>r2\nAAAA\n>r3\nCCCC\n>r4\nAAAA\n>r5\nAAAA\n>r6\nXXXXXXXXXX\n")
+        with open(sam, "w") as f:
+            f.write("@SQ\tSN:chr\tLN:16\n")
+            for (id, flag, pos, size) in [("r1", 99, 5, 10), ("r2", 99, 5, 10), ("r3", 99, 5, 10), ("r4", 83, 4, -10), ("r5", 83, 4, -12), ("r6", 99, 5, 10)]:
+                f.write("%s\t%d\tchr\t%d\t60\t5M\t=\t1\t%d\tACCGT\tIIIII\n" % (id, flag, pos, size))
+        vars = Globals()
+        vars.num_replicons, vars.transposon = 1, "Himar1"
+        # r2 duplicates r1's template; r6 has no barcode
+        expected = [[3, 3, 2, 0, 0, 3, 2], [9, 0, 0, 2, 2, 2, 2], [13, 0, 0, 0, 0, 0, 0]]
+        (counts,) = template_counts(ref, sam, bcfile, vars)
+        self.assertEqual(counts.tolist(), expected)
+        self.assertEqual((vars.r1, vars.r2, vars.mapped), (6, 6, 5))
+
+    def test_generate_output_from_sam_stream(self):
+        ref, sam = tpp_output_base + ".fna", tpp_output_base + ".sam.gz"
+        with open(ref, "w") as f: f.write(">chr\nGGTAACCGTAGGTACC\n") # TAs at 3, 9 and 13
+        with open_reads(sam, "w") as f:
+            f.write("@SQ\tSN:chr\tLN:16\n")
+            f.write("r1\t0\tchr\t5\t60\t5M\t*\t0\t0\tACCGT\tIIIII\n")
+            f.write("r2\t16\tchr\t4\t60\t5M\t*\t0\t0\tAACCG\tIIIII\n")
+        (args, kwargs) = cleanargs(["-reads1", reads1, "-ref", ref, "-output", tpp_output_base, "-no-sam"])
+        vars = Globals()
+        initialize_globals(vars, args, kwargs)
+        vars.single_end, vars.ref, vars.num_replicons, vars.replicon_ids = True, ref, 1, [""]
+        vars.trimmed1, vars.stats = tpp_output_base + ".trimmed1", tpp_output_base + ".tn_stats"
+        vars.tc, vars.wig = [tpp_output_base + ".counts"], [tpp_output_base + ".wig"]
+        extract_reads(vars)
+        # counts are made as the "aligner" writes its output, without saving a copy
+        vars.sam, vars.sam_command = None, ["gzip", "-dc", sam]
+        generate_output(vars)
+        self.assertEqual(vars.mapped, 2)
+        wig = [line.split() for line in open(vars.wig[0]) if line[0].isdigit()]
+        self.assertEqual(wig, [["3", "1"], ["9", "1"], ["13", "0"]])
+        self.assertFalse(os.path.exists(tpp_output_base + ".sam"))
+
 if __name__ == '__main__':
     unittest.main()
 
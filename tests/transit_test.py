@@ -25,7 +25,7 @@ small_annotation = basedir + "/data/test.prot_table"
 output = basedir + "/testoutput.txt"
 hist_path = output.rsplit(".", 1)[0] + "_histograms"
 tpp_output_base = basedir + "/test_tpp_temp"
-tpp_output_paths = [tpp_output_base + i for i in [".counts", ".reads1", ".sam", ".tn_stats", ".trimmed1", ".trimmed1_failed_trim", ".wig", "_a.counts", "_b.counts", "_c.counts", "_1.counts", "_2.counts", "_3.counts"]]
+tpp_output_paths = [tpp_output_base + i for i in [".counts", ".reads1", ".sam", ".tn_stats", ".trimmed1", ".trimmed1_failed_trim", ".trimmed1.gz", ".genomic2", ".genomic2.gz", ".barcodes1", ".sam.gz", ".fna", ".wig", "_a.counts", "_b.counts", "_c.counts", "_1.counts", "_2.counts", "_3.counts"]]
 
 # For tpp
 reads1 = basedir + "/data/test.fastq"